@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Offline ingestion benchmark with stand-in parser, LLM, embedding model and graph store
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional
+
+import yaml  # type: ignore [import-untyped]
+from llama_index.core import Document
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.graph_stores import SimplePropertyGraphStore
+from llama_index.core.indices.property_graph import SchemaLLMPathExtractor
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.readers.base import BaseReader
+
+from chunking import TokenChunker
+from embedding import EmbeddingStage
+from graph_schema import EXTRACT_PROMPT, CompiledSchema
+from metrics import percentiles
+from parsing import ParsingStage, list_files
+from pipeline import IngestionPipeline
+from scheduler import ExtractionScheduler
+
+logger = logging.getLogger("input_pipeline.benchmark")
+
+WORDS = (
+    "advisory agency bank board budget city claim company contract council "
+    "court data department director district document employee fund grant "
+    "insurance law market member office officer owner permit person plan "
+    "policy program property region report risk service state tax trust"
+).split()
+
+
+def _seeded(*parts: Any) -> random.Random:
+    """Random generator seeded by its arguments, so every run sees the same data"""
+    seed = hashlib.sha256(repr(parts).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(seed[:8], "big"))
+
+
+class FakeParser(BaseReader):
+    """Parser producing `pages` deterministic pages per file after `latency` seconds"""
+
+    def __init__(
+        self, pages: int = 10, words_per_page: int = 400, latency: float = 0.0
+    ):
+        self.pages = pages
+        self.words_per_page = words_per_page
+        self.latency = latency
+
+    def load_data(
+        self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[Document]:
+        documents = []
+        for page in range(self.pages):
+            rng = _seeded(file.name, page)
+            text = " ".join(rng.choices(WORDS, k=self.words_per_page))
+            documents.append(
+                Document(text=text, extra_info={**(extra_info or {}), "page": page + 1})
+            )
+        return documents
+
+    async def aload_data(
+        self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[Document]:
+        await asyncio.sleep(self.latency)
+        return self.load_data(file, extra_info)
+
+
+class FakeLLM(CustomLLM):
+    """LLM answering extraction prompts with triplets derived from the prompt text"""
+
+    entities: List[str]
+    relations: List[str]
+    latency: float = 0.0
+    triplets: int = 5
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="fake-llm")
+
+    def _answer(self, prompt: str) -> str:
+        rng = _seeded(prompt)
+        triplets = []
+        for _ in range(self.triplets):
+            triplets.append(
+                {
+                    "subject": {
+                        "type": rng.choice(self.entities),
+                        "name": rng.choice(WORDS).title(),
+                    },
+                    "relation": {"type": rng.choice(self.relations)},
+                    "object": {
+                        "type": rng.choice(self.entities),
+                        "name": rng.choice(WORDS).title(),
+                    },
+                }
+            )
+        return json.dumps({"triplets": triplets})
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        yield self.complete(prompt, formatted=formatted, **kwargs)
+
+
+class FakeEmbedding(MockEmbedding):
+    """Embedding model taking `latency` seconds per batch"""
+
+    latency: float = 0.0
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return self._get_text_embeddings(texts)
+
+
+async def run_once(files: List[Path], args: argparse.Namespace) -> Dict[str, Any]:
+    """Ingest the files once and measure the run"""
+    with open(args.schema, "r", encoding="utf-8") as file:
+        entities_config = yaml.safe_load(file)
+    entities: List[str] = entities_config["entities"]
+    relations: List[str] = entities_config["relations"]
+    validation_schema = CompiledSchema.compile(
+        entities, entities_config["validation_schema"]
+    )
+    llm = FakeLLM(
+        entities=entities,
+        relations=relations,
+        latency=args.llm_latency,
+        triplets=args.triplets,
+    )
+    kg_extractor = SchemaLLMPathExtractor(
+        llm=llm,
+        possible_entities=Literal[tuple(entities)],
+        possible_relations=Literal[tuple(relations)],
+        extract_prompt=EXTRACT_PROMPT.partial_format(
+            schema=validation_schema.describe()
+        ),
+        # annotated as Dict[str, str], the extractor only uses `in` on it
+        kg_validation_schema={
+            "relationships": validation_schema  # type: ignore [dict-item]
+        },
+        strict=args.strict,
+    )
+    parsing_stage = ParsingStage(
+        {".pdf": FakeParser(args.pages, args.words_per_page, args.parse_latency)},
+        workers=args.parse_workers,
+        max_in_flight=args.parse_workers * 2,
+    )
+    scheduler = ExtractionScheduler(
+        kg_extractor,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_concurrency=args.extract_workers,
+    )
+    chunker = TokenChunker(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    embed_model = FakeEmbedding(embed_dim=args.embed_dim, latency=args.embed_latency)
+    pipeline = IngestionPipeline(
+        scheduler,
+        SimplePropertyGraphStore(),
+        embed_model,
+        transformations=[chunker],
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+        embedding_stage=EmbeddingStage(
+            embed_model,
+            batch_size=args.embed_batch_size,
+            concurrency=args.embed_concurrency,
+        ),
+    )
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    stats = await pipeline.arun(parsing_stage.aiter_parse(files))
+    seconds = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stage_seconds = {
+        "parse": list(parsing_stage.durations.values()),
+        "parse_wait": list(parsing_stage.wait_durations.values()),
+    }
+    stage_seconds.update(stats.stage_seconds)
+    return {
+        "files": stats.files,
+        "documents": stats.documents,
+        "chunks": stats.chunks,
+        "entities": stats.entities,
+        "relations": stats.relations,
+        "seconds": seconds,
+        "documents_per_second": stats.documents / seconds,
+        "chunks_per_second": stats.chunks / seconds,
+        "peak_memory_mb": peak_memory / (1 << 20),
+        "chunk_tokens": percentiles(sorted(chunker.token_counts)),
+        "stages": {
+            stage: percentiles(values) for stage, values in stage_seconds.items()
+        },
+    }
+
+
+def log_result(result: Dict[str, Any]) -> None:
+    """Log the measurements of a run"""
+    logger.info(
+        "%4d files: %6.1f documents/s, %7.1f chunks/s, %.2fs, peak memory %.1f MB",
+        result["files"],
+        result["documents_per_second"],
+        result["chunks_per_second"],
+        result["seconds"],
+        result["peak_memory_mb"],
+    )
+    logger.info(
+        "      %-10s %s",
+        "tokens",
+        ", ".join(
+            f"{name} {value:.0f}" for name, value in result["chunk_tokens"].items()
+        ),
+    )
+    for stage, cuts in result["stages"].items():
+        logger.info(
+            "      %-10s %s",
+            stage,
+            ", ".join(f"{name} {value * 1000:.1f}ms" for name, value in cuts.items()),
+        )
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Run the benchmark for every corpus size"""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(max(args.sizes)):
+            # the fake parser only needs the files to exist
+            (Path(directory) / f"document_{index:05d}.pdf").touch()
+        all_files = list_files(directory, [".pdf"])
+        for size in args.sizes:
+            result = asyncio.run(run_once(all_files[:size], args))
+            log_result(result)
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 50, 100], help="corpus sizes"
+    )
+    arg_parser.add_argument("--pages", type=int, default=10, help="pages per file")
+    arg_parser.add_argument("--words-per-page", type=int, default=400)
+    arg_parser.add_argument("--parse-latency", type=float, default=0.05)
+    arg_parser.add_argument("--llm-latency", type=float, default=0.02)
+    arg_parser.add_argument("--embed-latency", type=float, default=0.01)
+    arg_parser.add_argument("--parse-workers", type=int, default=4)
+    arg_parser.add_argument(
+        "--extract-workers", type=int, default=4, help="maximum concurrency"
+    )
+    arg_parser.add_argument("--requests-per-minute", type=int, default=0)
+    arg_parser.add_argument("--tokens-per-minute", type=int, default=0)
+    arg_parser.add_argument("--chunk-size", type=int, default=1024, help="tokens")
+    arg_parser.add_argument("--chunk-overlap", type=int, default=128, help="tokens")
+    arg_parser.add_argument("--batch-size", type=int, default=32)
+    arg_parser.add_argument("--queue-size", type=int, default=4)
+    arg_parser.add_argument("--triplets", type=int, default=5, help="per chunk")
+    arg_parser.add_argument("--embed-dim", type=int, default=1536)
+    arg_parser.add_argument("--embed-batch-size", type=int, default=64)
+    arg_parser.add_argument(
+        "--embed-concurrency", type=int, default=4, help="batches in flight"
+    )
+    arg_parser.add_argument("--strict", action="store_true")
+    arg_parser.add_argument("--schema", default="entity_relations.yaml")
+    arg_parser.add_argument("--json", help="also write the results to this file")
+    arguments = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    benchmark_results = main(arguments)
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as json_file:
+            json.dump(benchmark_results, json_file, indent=2)
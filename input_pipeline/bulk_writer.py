@@ -0,0 +1,378 @@
+"""
+Bulk writer for Neo4j, batches graph elements into UNWIND MERGE statements
+"""
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import neo4j
+from llama_index.core.graph_stores.types import (
+    TRIPLET_SOURCE_KEY,
+    EntityNode,
+    LabelledNode,
+    Relation,
+)
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+from provenance import DOC_IDS_KEY
+
+logger = logging.getLogger("input_pipeline.bulk_writer")
+
+# same labels and properties Neo4jPropertyGraphStore uses
+UPSERT_CHUNKS = """
+UNWIND $rows AS row
+MERGE (c:__Node__ {id: row.id})
+SET c.text = row.text, c:Chunk
+SET c += row.properties
+WITH c, row
+WHERE row.embedding IS NOT NULL
+CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)
+"""
+
+UPSERT_ENTITIES = """
+UNWIND $rows AS row
+MERGE (e:__Node__ {{id: row.id}})
+SET e += row.properties
+SET e.name = row.name, e:__Entity__:`{label}`
+FOREACH (
+    doc_id IN [doc_id IN coalesce(row.doc_ids, []) WHERE NOT doc_id IN coalesce(e.doc_ids, [])] |
+    SET e.doc_ids = coalesce(e.doc_ids, []) + doc_id
+)
+WITH e, row
+WHERE row.embedding IS NOT NULL
+CALL db.create.setNodeVectorProperty(e, 'embedding', row.embedding)
+"""
+
+# documents of entities written by the graph store
+TAG_ENTITY_DOCUMENTS = """
+UNWIND $rows AS row
+MATCH (e:__Entity__ {id: row.id})
+FOREACH (
+    doc_id IN [doc_id IN row.doc_ids WHERE NOT doc_id IN coalesce(e.doc_ids, [])] |
+    SET e.doc_ids = coalesce(e.doc_ids, []) + doc_id
+)
+"""
+
+UPSERT_MENTIONS = """
+UNWIND $rows AS row
+MATCH (e:__Node__ {id: row.entity_id})
+MERGE (c:__Node__ {id: row.chunk_id})
+MERGE (c)-[:MENTIONS]->(e)
+"""
+
+UPSERT_RELATIONS = """
+UNWIND $rows AS row
+MERGE (source:__Node__ {{id: row.source_id}})
+ON CREATE SET source:Chunk
+MERGE (target:__Node__ {{id: row.target_id}})
+ON CREATE SET target:Chunk
+MERGE (source)-[r:`{label}`]->(target)
+SET r += row.properties
+"""
+
+
+# chunks of other versions of a document, and those written before chunks
+# carried their document id
+STALE_CHUNKS = """
+CALL {
+    MATCH (c:Chunk {doc_id: $doc_id})
+    WHERE $doc_version IS NULL OR c.doc_version <> $doc_version
+    RETURN c
+    UNION
+    MATCH (c:Chunk {file_path: $file_path})
+    WHERE c.doc_id IS NULL
+    RETURN c
+}
+"""
+
+DELETE_STALE_RELATIONS = (
+    STALE_CHUNKS
+    + """
+MATCH (c)-[:MENTIONS]->(:__Entity__)-[r]->(:__Entity__)
+WHERE r.doc_id = $doc_id OR r.triplet_source_id = c.id
+WITH DISTINCT r
+DELETE r
+"""
+)
+
+DELETE_STALE_CHUNKS = (
+    STALE_CHUNKS
+    + """
+OPTIONAL MATCH (c)-[:MENTIONS]->(e:__Entity__)
+WITH collect(DISTINCT c) AS chunks, collect(DISTINCT e) AS entities
+FOREACH (e IN entities | SET e.doc_ids = [d IN coalesce(e.doc_ids, []) WHERE d <> $doc_id])
+FOREACH (c IN chunks | DETACH DELETE c)
+RETURN size(chunks) AS chunks, [e IN entities | e.id] AS entity_ids
+"""
+)
+
+# entities no chunk mentions any more
+DELETE_ORPHANED_ENTITIES = """
+MATCH (e:__Entity__)
+WHERE e.id IN $entity_ids AND NOT (e)<-[:MENTIONS]-(:Chunk)
+DETACH DELETE e
+RETURN count(e) AS entities
+"""
+
+
+def _escape(label: str) -> str:
+    """Escape a label or relationship type for use between backticks"""
+    return label.replace("`", "``")
+
+
+def _clean(properties: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop properties Neo4j can not store"""
+    return {key: value for key, value in properties.items() if value is not None}
+
+
+def _run_batch(
+    tx: neo4j.ManagedTransaction, query: str, rows: List[Dict[str, Any]]
+) -> None:
+    tx.run(query, rows=rows).consume()
+
+
+@dataclass
+class BulkWriteStats:
+    """Rows written per kind and time spent in Neo4j"""
+
+    rows: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    transactions: int = 0
+    seconds: float = 0.0
+
+    @property
+    def total_rows(self) -> int:
+        """Rows of all kinds"""
+        return sum(self.rows.values())
+
+    @property
+    def rows_per_second(self) -> float:
+        """Write throughput"""
+        return self.total_rows / self.seconds if self.seconds else 0.0
+
+
+@dataclass
+class ReplaceResult:
+    """Elements of the previous version of a document removed by a replacement"""
+
+    chunks: int = 0
+    entities: int = 0  # no longer mentioned by any chunk
+
+
+class _Rows:
+    """Rows of graph elements by kind, entities and relations by label"""
+
+    def __init__(self) -> None:
+        self.chunks: List[Dict[str, Any]] = []
+        self.entities: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self.mentions: Set[Tuple[str, str]] = set()
+        self.relations: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    def __len__(self) -> int:
+        return (
+            len(self.chunks)
+            + sum(len(rows) for rows in self.entities.values())
+            + len(self.mentions)
+            + sum(len(rows) for rows in self.relations.values())
+        )
+
+    def add_chunks(self, nodes: Sequence[BaseNode]) -> None:
+        for node in nodes:
+            self.chunks.append(
+                {
+                    "id": node.id_,
+                    "text": node.get_content(metadata_mode=MetadataMode.NONE),
+                    "properties": _clean(node_to_metadata_dict(node, remove_text=True)),
+                    "embedding": node.embedding,
+                }
+            )
+
+    def add_entities(self, kg_nodes: Sequence[LabelledNode]) -> None:
+        for kg_node in kg_nodes:
+            if not isinstance(kg_node, EntityNode):
+                continue
+            properties = _clean(kg_node.properties)
+            self.entities[kg_node.label].append(
+                {
+                    "id": kg_node.id,
+                    "name": kg_node.name,
+                    "properties": properties,
+                    "embedding": kg_node.embedding,
+                    # added to the documents of the entity, not replacing them
+                    "doc_ids": properties.pop(DOC_IDS_KEY, None),
+                }
+            )
+            source_id = kg_node.properties.get(TRIPLET_SOURCE_KEY)
+            if source_id is not None:
+                self.mentions.add((source_id, kg_node.id))
+
+    def add_relations(self, relations: Sequence[Relation]) -> None:
+        for relation in relations:
+            self.relations[relation.label].append(
+                {
+                    "source_id": relation.source_id,
+                    "target_id": relation.target_id,
+                    "properties": _clean(relation.properties),
+                }
+            )
+
+    def statements(self) -> List[Tuple[str, str, List[Dict[str, Any]]]]:
+        """Kind, query and rows of the UNWIND statements, nodes first"""
+        statements: List[Tuple[str, str, List[Dict[str, Any]]]] = []
+        if self.chunks:
+            statements.append(("chunks", UPSERT_CHUNKS, self.chunks))
+        for label, rows in self.entities.items():
+            statements.append(
+                ("entities", UPSERT_ENTITIES.format(label=_escape(label)), rows)
+            )
+        if self.mentions:
+            mentions = [
+                {"chunk_id": chunk_id, "entity_id": entity_id}
+                for chunk_id, entity_id in self.mentions
+            ]
+            statements.append(("mentions", UPSERT_MENTIONS, mentions))
+        for label, rows in self.relations.items():
+            statements.append(
+                ("relations", UPSERT_RELATIONS.format(label=_escape(label)), rows)
+            )
+        return statements
+
+
+class Neo4jBulkWriter:
+    """
+    Accumulate chunks, entities, MENTIONS and extracted relations and flush
+    them with batched UNWIND MERGE statements, one explicit transaction per
+    batch. Entities and relations are grouped by label, so no APOC call is
+    needed per row. A flush always writes nodes before relations.
+
+    `replace_document` writes the elements of one document together with
+    the removal of its previous version in a single transaction instead.
+    """
+
+    def __init__(
+        self,
+        driver: neo4j.Driver,
+        database: Optional[str] = "neo4j",
+        batch_size: int = 1000,
+    ) -> None:
+        self.driver = driver
+        self.database = database
+        self.batch_size = max(1, batch_size)
+        self.stats = BulkWriteStats()
+        self._rows = _Rows()
+
+    @property
+    def pending(self) -> int:
+        """Number of rows waiting to be flushed"""
+        return len(self._rows)
+
+    def add_chunks(self, nodes: Sequence[BaseNode]) -> None:
+        """Queue llama-index nodes as chunk nodes"""
+        self._rows.add_chunks(nodes)
+        self._flush_if_full()
+
+    def add_entities(self, kg_nodes: Sequence[LabelledNode]) -> None:
+        """Queue entity nodes and the MENTIONS from the chunks they were extracted from"""
+        self._rows.add_entities(kg_nodes)
+        self._flush_if_full()
+
+    def add_relations(self, relations: Sequence[Relation]) -> None:
+        """Queue extracted relations"""
+        self._rows.add_relations(relations)
+        self._flush_if_full()
+
+    def _flush_if_full(self) -> None:
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all queued rows, nodes first"""
+        statements = self._rows.statements()
+        self._rows = _Rows()
+        written = 0
+        for kind, query, rows in statements:
+            written += self.write(kind, query, rows)
+        return written
+
+    def write(self, kind: str, query: str, rows: Sequence[Dict[str, Any]]) -> int:
+        """Run an UNWIND statement over rows, one transaction per batch"""
+        start_time = time.perf_counter()
+        with self.driver.session(database=self.database) as session:
+            for index in range(0, len(rows), self.batch_size):
+                batch = list(rows[index : index + self.batch_size])
+                session.execute_write(_run_batch, query, batch)
+                self.stats.rows[kind] += len(batch)
+                self.stats.transactions += 1
+        self.stats.seconds += time.perf_counter() - start_time
+        return len(rows)
+
+    def replace_document(
+        self,
+        doc_id: str,
+        file_path: str,
+        doc_version: Optional[str] = None,
+        nodes: Sequence[BaseNode] = (),
+        kg_nodes: Sequence[LabelledNode] = (),
+        relations: Sequence[Relation] = (),
+    ) -> ReplaceResult:
+        """
+        In one transaction, remove the chunks of a document that are not of
+        `doc_version` with their relations, write the given elements of the
+        document and delete the entities no chunk mentions any more.
+        Without a version the document is only removed.
+
+        A relation belongs to the document that wrote it last; entities
+        record all documents mentioning them in `doc_ids`.
+        """
+        rows = _Rows()
+        rows.add_chunks(nodes)
+        rows.add_entities(kg_nodes)
+        rows.add_relations(relations)
+        statements = rows.statements()
+        parameters = {
+            "doc_id": doc_id,
+            "doc_version": doc_version,
+            "file_path": file_path,
+        }
+
+        def replace(tx: neo4j.ManagedTransaction) -> ReplaceResult:
+            tx.run(DELETE_STALE_RELATIONS, parameters).consume()
+            record = tx.run(DELETE_STALE_CHUNKS, parameters).single()
+            chunks = record["chunks"] if record else 0
+            entity_ids = record["entity_ids"] if record else []
+            for _, query, statement_rows in statements:
+                for index in range(0, len(statement_rows), self.batch_size):
+                    batch = statement_rows[index : index + self.batch_size]
+                    tx.run(query, rows=batch).consume()
+            record = tx.run(DELETE_ORPHANED_ENTITIES, entity_ids=entity_ids).single()
+            return ReplaceResult(
+                chunks=chunks, entities=record["entities"] if record else 0
+            )
+
+        start_time = time.perf_counter()
+        with self.driver.session(database=self.database) as session:
+            result = session.execute_write(replace)
+        self.stats.seconds += time.perf_counter() - start_time
+        self.stats.transactions += 1
+        for kind, _, statement_rows in statements:
+            self.stats.rows[kind] += len(statement_rows)
+        logger.debug(
+            "Replaced %d chunks and %d orphaned entities of %s",
+            result.chunks,
+            result.entities,
+            file_path,
+        )
+        return result
+
+    def log_stats(self) -> None:
+        """Log how much was written and how fast"""
+        logger.info(
+            "Bulk wrote %d rows (%s) in %d transactions, %.1fs, %.0f rows/s",
+            self.stats.total_rows,
+            ", ".join(f"{count} {kind}" for kind, count in self.stats.rows.items()),
+            self.stats.transactions,
+            self.stats.seconds,
+            self.stats.rows_per_second,
+        )
@@ -0,0 +1,208 @@
+"""
+Checkpoint store for resumable knowledge graph builds
+"""
+import json
+import logging
+import sqlite3
+from enum import IntEnum
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core import schema
+from llama_index.core.graph_stores.types import (
+    KG_NODES_KEY,
+    KG_RELATIONS_KEY,
+    EntityNode,
+    Relation,
+)
+from llama_index.core.schema import BaseNode, TextNode
+
+from parsing import ParsedFile
+
+logger = logging.getLogger("input_pipeline.checkpoint")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    document TEXT NOT NULL,
+    PRIMARY KEY (path, position)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    node TEXT NOT NULL,
+    extraction TEXT,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path, position);
+"""
+
+
+class ChunkStatus(IntEnum):
+    """How far a chunk got through the pipeline"""
+
+    CHUNKED = 0
+    EXTRACTED = 1
+    WRITTEN = 2
+
+
+class CheckpointStore:
+    """
+    Record parsed documents, chunks, their extraction results and write status
+    in SQLite, so an interrupted run can continue without parsing or calling
+    the LLM again for work that was already done.
+    """
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        if not resume:
+            self.connection.executescript(
+                "DROP TABLE IF EXISTS files;"
+                "DROP TABLE IF EXISTS documents;"
+                "DROP TABLE IF EXISTS chunks;"
+            )
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Close the database"""
+        self.connection.close()
+
+    def has_file(self, path: Path, content_hash: str) -> bool:
+        """Whether the documents of this version of a file are checkpointed"""
+        row = self.connection.execute(
+            "SELECT content_hash FROM files WHERE path = ?", (str(path),)
+        ).fetchone()
+        return row is not None and row[0] == content_hash
+
+    def save_documents(
+        self, path: Path, content_hash: str, documents: Sequence[schema.Document]
+    ) -> None:
+        """Checkpoint the parsed documents of a file"""
+        self.forget(path)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO documents (path, position, document) VALUES (?, ?, ?)",
+                [
+                    (str(path), position, document.to_json())
+                    for position, document in enumerate(documents)
+                ],
+            )
+            self.connection.execute(
+                "INSERT INTO files (path, content_hash) VALUES (?, ?)",
+                (str(path), content_hash),
+            )
+
+    def load_documents(self, path: Path) -> List[schema.Document]:
+        """Parsed documents of a file"""
+        rows = self.connection.execute(
+            "SELECT document FROM documents WHERE path = ? ORDER BY position",
+            (str(path),),
+        )
+        return [schema.Document.from_json(document) for (document,) in rows]
+
+    def forget(self, path: Path) -> None:
+        """Drop everything checkpointed for a file"""
+        with self.connection:
+            for table in ("files", "documents", "chunks"):
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE path = ?", (str(path),)
+                )
+
+    async def checkpointed(
+        self,
+        files: Sequence[Path],
+        content_hashes: Dict[str, str],
+        parse: Optional[AsyncIterator[ParsedFile]] = None,
+    ) -> AsyncIterator[ParsedFile]:
+        """
+        Yield the checkpointed documents of `files`, then the files coming out
+        of `parse`, checkpointing the latter as they pass.
+        """
+        for path in files:
+            yield path, self.load_documents(path)
+        if parse is None:
+            return
+        async for path, documents in parse:
+            if documents:
+                self.save_documents(path, content_hashes[str(path)], documents)
+            yield path, documents
+
+    def save_chunks(self, path: Path, nodes: Sequence[BaseNode]) -> None:
+        """Checkpoint the chunks of a file"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO chunks (id, path, position, node, status) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (node.id_, str(path), position, node.to_json(), ChunkStatus.CHUNKED)
+                    for position, node in enumerate(nodes)
+                ],
+            )
+
+    def load_chunks(self, path: Path) -> List[Tuple[BaseNode, ChunkStatus]]:
+        """Checkpointed chunks of a file with their status, extraction results restored"""
+        rows = self.connection.execute(
+            "SELECT node, extraction, status FROM chunks WHERE path = ? ORDER BY position",
+            (str(path),),
+        )
+        chunks: List[Tuple[BaseNode, ChunkStatus]] = []
+        for node_json, extraction, status in rows:
+            node = TextNode.from_json(node_json)
+            restore_extraction(node, extraction)
+            chunks.append((node, ChunkStatus(status)))
+        return chunks
+
+    def save_extractions(self, nodes: Sequence[BaseNode]) -> None:
+        """Checkpoint the extraction results of chunks"""
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE chunks SET extraction = ?, status = ? WHERE id = ?",
+                [
+                    (dump_extraction(node), ChunkStatus.EXTRACTED, node.id_)
+                    for node in nodes
+                ],
+            )
+
+    def mark_written(self, node_ids: Sequence[str]) -> None:
+        """Record that chunks have been written to the graph store"""
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE chunks SET status = ? WHERE id = ?",
+                [(ChunkStatus.WRITTEN, node_id) for node_id in node_ids],
+            )
+
+
+def dump_extraction(node: BaseNode) -> str:
+    """Serialize the entities and relations extracted from a chunk"""
+    return json.dumps(
+        {
+            KG_NODES_KEY: [
+                kg_node.model_dump() for kg_node in node.metadata.get(KG_NODES_KEY, [])
+            ],
+            KG_RELATIONS_KEY: [
+                relation.model_dump()
+                for relation in node.metadata.get(KG_RELATIONS_KEY, [])
+            ],
+        }
+    )
+
+
+def restore_extraction(node: BaseNode, extraction: Optional[str]) -> None:
+    """Put serialized extraction results back into the metadata of a chunk"""
+    if extraction is None:
+        return
+    data = json.loads(extraction)
+    node.metadata[KG_NODES_KEY] = [
+        EntityNode(**kg_node) for kg_node in data[KG_NODES_KEY]
+    ]
+    node.metadata[KG_RELATIONS_KEY] = [
+        Relation(**relation) for relation in data[KG_RELATIONS_KEY]
+    ]
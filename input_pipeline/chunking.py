@@ -0,0 +1,135 @@
+"""
+Token-aware chunking of page documents
+"""
+import logging
+import re
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, List, Sequence, Tuple
+
+import tiktoken
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.schema import BaseNode, MetadataMode, NodeRelationship, TextNode
+
+logger = logging.getLogger("input_pipeline.chunking")
+
+# split after paragraphs, lines and sentences, keeping the separators
+PIECE_BOUNDARY = re.compile(r"(?<=\n\n)|(?<=[.!?]\s)")
+
+PAGE_SEPARATOR = "\n\n"
+
+# page numbers of a chunk, for citations only
+PAGE_METADATA_KEYS = ["page_start", "page_end"]
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str) -> tiktoken.Encoding:
+    """Tiktoken encoding of a model, loaded once per process"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenChunker(NodeParser):
+    """
+    Merge and split page documents into chunks of about `chunk_size` tokens,
+    consecutive chunks sharing up to `chunk_overlap` tokens.
+
+    Pages are consumed one at a time and cut into paragraphs and sentences,
+    only the pieces of the chunk being built are held. Sentences longer than
+    a chunk are cut at token boundaries. A chunk takes the metadata of the
+    page it starts on and records the pages it spans. The token counts of the
+    chunks produced are kept for the run report.
+    """
+
+    chunk_size: int = Field(default=1024, gt=0, description="Tokens per chunk")
+    chunk_overlap: int = Field(
+        default=128, ge=0, description="Tokens shared by consecutive chunks"
+    )
+    model: str = Field(default="gpt-4", description="Model of the tokenizer")
+
+    _token_counts: List[int] = PrivateAttr(default_factory=list)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenChunker"
+
+    @property
+    def token_counts(self) -> List[int]:
+        """Tokens of every chunk produced so far"""
+        return self._token_counts
+
+    def _pieces(self, text: str) -> Iterator[Tuple[str, int]]:
+        encoder = get_encoder(self.model)
+        for piece in PIECE_BOUNDARY.split(text):
+            if not piece:
+                continue
+            tokens = encoder.encode(piece)
+            if len(tokens) <= self.chunk_size:
+                yield piece, len(tokens)
+                continue
+            for index in range(0, len(tokens), self.chunk_size):
+                window = tokens[index : index + self.chunk_size]
+                yield encoder.decode(window), len(window)
+
+    def _chunk(self, pieces: Sequence[Tuple[str, int, int, BaseNode]]) -> TextNode:
+        text = "".join(piece for piece, _, _, _ in pieces).strip()
+        # whitespace, e.g. a separator carried over as overlap, is not part of
+        # the pages the chunk spans
+        spanned = [piece for piece in pieces if piece[0].strip()] or pieces
+        _, _, page_start, page = spanned[0]
+        page_end = spanned[-1][2]
+        node = TextNode(
+            text=text,
+            extra_info={
+                **page.metadata,
+                "page_start": page_start,
+                "page_end": page_end,
+            },
+            excluded_embed_metadata_keys=[
+                *page.excluded_embed_metadata_keys,
+                *PAGE_METADATA_KEYS,
+            ],
+            excluded_llm_metadata_keys=[
+                *page.excluded_llm_metadata_keys,
+                *PAGE_METADATA_KEYS,
+            ],
+            relationships={NodeRelationship.SOURCE: page.as_related_node_info()},
+        )
+        self._token_counts.append(sum(tokens for _, tokens, _, _ in pieces))
+        return node
+
+    def iter_chunks(self, pages: Iterable[BaseNode]) -> Iterator[TextNode]:
+        """Chunks of the pages of one file, in order"""
+        # piece, tokens, page number, page
+        buffer: List[Tuple[str, int, int, BaseNode]] = []
+        buffer_tokens = 0
+        # whether the buffer holds more than the overlap of the last chunk
+        fresh = False
+        for page_number, page in enumerate(pages, start=1):
+            text = page.get_content(metadata_mode=MetadataMode.NONE)
+            if not text.strip():
+                continue
+            if not text.endswith(PAGE_SEPARATOR):
+                text += PAGE_SEPARATOR
+            for piece, tokens in self._pieces(text):
+                while buffer and buffer_tokens + tokens > self.chunk_size:
+                    if fresh:
+                        yield self._chunk(buffer)
+                        while buffer and buffer_tokens > self.chunk_overlap:
+                            buffer_tokens -= buffer.pop(0)[1]
+                        fresh = False
+                    else:
+                        # the overlap does not leave room for the next piece
+                        buffer_tokens -= buffer.pop(0)[1]
+                buffer.append((piece, tokens, page_number, page))
+                buffer_tokens += tokens
+                fresh = True
+        if fresh:
+            yield self._chunk(buffer)
+
+    def _parse_nodes(
+        self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any
+    ) -> List[BaseNode]:
+        return list(self.iter_chunks(nodes))
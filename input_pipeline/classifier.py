@@ -0,0 +1,217 @@
+"""
+Local classification of chunks before knowledge graph extraction
+"""
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Sequence
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.graph_stores.types import KG_NODES_KEY, KG_RELATIONS_KEY
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+logger = logging.getLogger("input_pipeline.classifier")
+
+# lines of tables of contents, page furniture and legal footers
+BOILERPLATE_LINES = [
+    r"^(table of )?contents$",
+    r"(\.\s?){3,}\s*\d{1,4}$",  # entry with dot leaders and page number
+    # page numbers on a line of their own: "page 3", "3 of 12", "- 3 -"; bare
+    # numbers and numbers after spaces are as likely to be table cells
+    r"^(page\s+\d{1,4}(\s+of\s+\d{1,4})?|\d{1,4}\s+of\s+\d{1,4}|[-–]\s*\d{1,4}\s*[-–])$",
+    r"all rights reserved",
+    r"^(copyright|©|\(c\))\s",
+    r"^(confidential|disclaimer)\b",
+]
+
+WORD = re.compile(r"\w+")
+
+
+@dataclass
+class ClassifierStats:
+    """Chunks classified, skipped as boilerplate and entity types advertised"""
+
+    chunks: int = 0
+    skipped: int = 0
+    entity_types: int = 0
+
+    @property
+    def mean_entity_types(self) -> float:
+        """Entity types advertised per extracted chunk"""
+        extracted = self.chunks - self.skipped
+        return self.entity_types / extracted if extracted else 0.0
+
+
+class ChunkClassifier:
+    """
+    Tag chunks with the entity types their keywords suggest, without any
+    model call.
+
+    An entity type is suggested when at least `min_hits` of its keywords
+    occur in a chunk; types without keywords are always suggested, and all
+    types are when none matched. A chunk is boilerplate when fewer than
+    `min_words` words are left or at least `boilerplate_share` of its lines
+    look like a table of contents, page furniture or a legal footer.
+    """
+
+    def __init__(
+        self,
+        entities: Sequence[str],
+        keywords: Mapping[str, Optional[Sequence[str]]],
+        boilerplate: Sequence[str] = (),
+        min_hits: int = 1,
+        min_words: int = 5,
+        boilerplate_share: float = 0.6,
+    ) -> None:
+        self.entities = list(entities)
+        unknown = set(keywords) - set(entities)
+        if unknown:
+            raise ValueError(
+                f"Keywords for unknown entities {', '.join(sorted(unknown))}"
+            )
+        self.always = frozenset(
+            entity for entity in entities if not keywords.get(entity)
+        )
+        # one alternation per entity, longest keywords first so phrases win
+        self.patterns = {
+            entity: re.compile(
+                r"\b("
+                + "|".join(
+                    re.escape(keyword.lower())
+                    for keyword in sorted(entity_keywords, key=len, reverse=True)
+                )
+                + r")\b"
+            )
+            for entity, entity_keywords in keywords.items()
+            if entity_keywords
+        }
+        self.boilerplate = re.compile(
+            "|".join(
+                f"(?:{pattern})" for pattern in [*BOILERPLATE_LINES, *boilerplate]
+            ),
+            re.IGNORECASE,
+        )
+        self.min_hits = min_hits
+        self.min_words = min_words
+        self.boilerplate_share = boilerplate_share
+
+    def is_boilerplate(self, text: str) -> bool:
+        """Whether a chunk has nothing worth extracting"""
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        boilerplate_lines = [line for line in lines if self.boilerplate.search(line)]
+        if len(boilerplate_lines) >= self.boilerplate_share * len(lines):
+            return True
+        words = sum(
+            len(WORD.findall(line))
+            for line in lines
+            if not self.boilerplate.search(line)
+        )
+        return words < self.min_words
+
+    def entity_types(self, text: str) -> FrozenSet[str]:
+        """Entity types suggested by the keywords of a chunk"""
+        text = text.lower()
+        matched = {
+            entity
+            for entity, pattern in self.patterns.items()
+            if len(pattern.findall(text)) >= self.min_hits
+        }
+        if not matched:
+            return frozenset(self.entities)
+        return self.always | matched
+
+    def classify(self, text: str) -> Optional[FrozenSet[str]]:
+        """Suggested entity types of a chunk, None for boilerplate"""
+        if self.is_boilerplate(text):
+            return None
+        return self.entity_types(text)
+
+
+class ClassifyingExtractor(TransformComponent):
+    """
+    Extract triplets from every chunk with an extractor advertising only the
+    entity types the classifier suggests for it. Boilerplate chunks get an
+    empty extraction without an LLM call.
+
+    Extractors are made by `make_extractor` once per set of entity types.
+    """
+
+    classifier: ChunkClassifier
+    make_extractor: Callable[[FrozenSet[str]], TransformComponent]
+
+    _extractors: Dict[FrozenSet[str], TransformComponent] = PrivateAttr(
+        default_factory=dict
+    )
+    _stats: ClassifierStats = PrivateAttr(default_factory=ClassifierStats)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ClassifyingExtractor"
+
+    @property
+    def stats(self) -> ClassifierStats:
+        """Chunks classified, skipped and entity types advertised"""
+        return self._stats
+
+    def extractor(self, entity_types: FrozenSet[str]) -> TransformComponent:
+        """Extractor for a set of entity types"""
+        if entity_types not in self._extractors:
+            self._extractors[entity_types] = self.make_extractor(entity_types)
+        return self._extractors[entity_types]
+
+    @property
+    def full_extractor(self) -> TransformComponent:
+        """Extractor advertising all entity types"""
+        return self.extractor(frozenset(self.classifier.entities))
+
+    @property
+    def extract_prompt(self) -> Any:
+        """Prompt of the extractor advertising all entity types"""
+        return getattr(self.full_extractor, "extract_prompt", None)
+
+    @property
+    def max_triplets_per_chunk(self) -> int:
+        """Triplet limit of the extractors"""
+        return getattr(self.full_extractor, "max_triplets_per_chunk", 10)
+
+    def _group(self, nodes: Sequence[BaseNode]) -> Dict[FrozenSet[str], List[BaseNode]]:
+        groups: Dict[FrozenSet[str], List[BaseNode]] = {}
+        for node in nodes:
+            self._stats.chunks += 1
+            entity_types = self.classifier.classify(
+                node.get_content(metadata_mode=MetadataMode.NONE)
+            )
+            if entity_types is None:
+                self._stats.skipped += 1
+                node.metadata[KG_NODES_KEY] = []
+                node.metadata[KG_RELATIONS_KEY] = []
+                continue
+            self._stats.entity_types += len(entity_types)
+            groups.setdefault(entity_types, []).append(node)
+        return groups
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        by_id = {node.id_: node for node in nodes}
+        for entity_types, group in self._group(nodes).items():
+            for node in self.extractor(entity_types)(group, **kwargs):
+                by_id[node.id_] = node
+        return [by_id[node.id_] for node in nodes]
+
+    async def acall(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        by_id = {node.id_: node for node in nodes}
+        for entity_types, group in self._group(nodes).items():
+            for node in await self.extractor(entity_types).acall(group, **kwargs):
+                by_id[node.id_] = node
+        return [by_id[node.id_] for node in nodes]
+
+    def log_stats(self) -> None:
+        """Log skipped chunks and the entity types advertised"""
+        logger.info(
+            "Classified %d chunks: %d skipped as boilerplate, %.1f of %d entity "
+            "types advertised on average by %d extractors",
+            self._stats.chunks,
+            self._stats.skipped,
+            self._stats.mean_entity_types,
+            len(self.classifier.entities),
+            len(self._extractors),
+        )
@@ -0,0 +1,278 @@
+"""
+Batched, concurrent embedding stage with a persistent vector cache
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, cast
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from quantization import Precision, dequantize, quantize
+
+logger = logging.getLogger("input_pipeline.embedding")
+
+# bump when the way vectors are stored changes
+CACHE_VERSION = "1"
+
+# file suffix of the rows of every precision
+SUFFIXES = {"float32": "f32", "float16": "f16", "int8": "i8"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    key TEXT PRIMARY KEY,
+    row INTEGER NOT NULL
+);
+"""
+
+
+class EmbeddingCache:
+    """
+    Map texts to their embeddings, keyed by the text and the embedding model.
+
+    The vectors are appended as rows of the cache `precision` to
+    `vectors.f32`, `vectors.f16` or `vectors.i8` in the cache directory and
+    read through a memory map, an SQLite index maps keys to rows. int8 rows
+    have their scale in `scales.f32`, a `precision` of None opens a cache in
+    the one it holds. Rows are written before they are indexed, so an
+    interrupted run leaves at most unreferenced rows behind.
+    """
+
+    def __init__(
+        self, path: str, model: str, precision: Optional[Precision] = "float32"
+    ) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._namespace = "\0".join((CACHE_VERSION, model))
+        self.connection = sqlite3.connect(self.path / "index.sqlite")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+        self.dimension: Optional[int] = (
+            int(meta["dimension"]) if "dimension" in meta else None
+        )
+        # caches written before the precision was recorded hold float32 rows
+        stored = cast(
+            Optional[Precision],
+            meta.get("precision", "float32" if self.dimension else None),
+        )
+        if precision is not None and stored is not None and stored != precision:
+            self.connection.close()
+            raise ValueError(
+                f"The cache in {self.path} holds {stored} vectors, not {precision}"
+            )
+        # None reads a cache in the precision it was written in
+        self.precision: Precision = precision or stored or "float32"
+        self.dtype = np.dtype(self.precision)
+        self.vectors_path = self.path / f"vectors.{SUFFIXES[self.precision]}"
+        self.vectors_path.touch()
+        self.scales_path: Optional[Path] = None
+        if self.precision == "int8":
+            self.scales_path = self.path / "scales.f32"
+            self.scales_path.touch()
+        self._vectors: Optional[np.memmap] = None
+        self._scales: Optional[np.memmap] = None
+        if self.dimension is not None:
+            # drop rows only partially written by an interrupted run
+            rows = self.rows
+            os.truncate(self.vectors_path, rows * self.dimension * self.dtype.itemsize)
+            if self.scales_path is not None:
+                os.truncate(self.scales_path, rows * 4)
+
+    def close(self) -> None:
+        """Close the index and the memory maps"""
+        self._vectors = None
+        self._scales = None
+        self.connection.close()
+
+    def key(self, text: str) -> str:
+        """Cache key of a text"""
+        digest = hashlib.sha256(self._namespace.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def rows(self) -> int:
+        """Vectors stored"""
+        if self.dimension is None:
+            return 0
+        rows = self.vectors_path.stat().st_size // (
+            self.dimension * self.dtype.itemsize
+        )
+        if self.scales_path is not None:
+            rows = min(rows, self.scales_path.stat().st_size // 4)
+        return rows
+
+    def _map(self, min_rows: int) -> Tuple[np.memmap, Optional[np.memmap]]:
+        # the files only grow, remap once they hold rows the maps do not cover
+        vectors = self._vectors
+        if vectors is None or len(vectors) < min_rows:
+            rows = self.rows
+            vectors = self._vectors = np.memmap(
+                self.vectors_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(rows, self.dimension or 0),
+            )
+            if self.scales_path is not None:
+                self._scales = np.memmap(
+                    self.scales_path, dtype=np.float32, mode="r", shape=(rows,)
+                )
+        return vectors, self._scales
+
+    def vectors(self) -> np.ndarray:
+        """All vectors stored, as float32"""
+        if not self.rows:
+            return np.empty((0, self.dimension or 0), dtype=np.float32)
+        vectors, scales = self._map(self.rows)
+        return dequantize(vectors, scales)
+
+    def get(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Vectors of the keys found in the cache, as float32"""
+        if self.dimension is None:
+            return {}
+        rows: Dict[str, int] = {}
+        unique_keys = list(set(keys))
+        # stay below the SQLite limit of host parameters
+        for index in range(0, len(unique_keys), 500):
+            batch = unique_keys[index : index + 500]
+            rows.update(
+                self.connection.execute(
+                    "SELECT key, row FROM vectors "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        if not rows:
+            return {}
+        vectors, scales = self._map(max(rows.values()) + 1)
+        found = list(rows.items())
+        indices = [row for _, row in found]
+        array = dequantize(
+            vectors[indices], None if scales is None else scales[indices]
+        )
+        return {key: vector for (key, _), vector in zip(found, array)}
+
+    @staticmethod
+    def _append(path: Path, data: bytes) -> None:
+        with open(path, "ab") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def put(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Append vectors in the cache precision and index them by their keys"""
+        if not keys:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = array.shape[1]
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO meta (key, value) VALUES (?, ?)",
+                    [
+                        ("dimension", str(self.dimension)),
+                        ("precision", self.precision),
+                    ],
+                )
+        elif array.shape[1] != self.dimension:
+            raise ValueError(
+                f"Embeddings have {array.shape[1]} dimensions, the cache in "
+                f"{self.path} holds {self.dimension}"
+            )
+        first_row = self.rows
+        codes, scales = quantize(array, self.precision)
+        self._append(self.vectors_path, codes.tobytes())
+        if self.scales_path is not None and scales is not None:
+            self._append(self.scales_path, scales.tobytes())
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO vectors (key, row) VALUES (?, ?)",
+                [(key, first_row + offset) for offset, key in enumerate(keys)],
+            )
+
+
+@dataclass
+class EmbeddingStats:
+    """Texts embedded, answered from the cache and embedding API calls"""
+
+    texts: int = 0
+    cache_hits: int = 0
+    calls: int = 0
+
+
+class EmbeddingStage:
+    """
+    Embed texts in batches of `batch_size`, with up to `concurrency` batches
+    in flight. Texts found in the `cache` and repeated texts are embedded
+    only once.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: Optional[int] = None,
+        concurrency: int = 4,
+    ) -> None:
+        self.embed_model = embed_model
+        self.cache = cache
+        self.batch_size = max(1, batch_size or embed_model.embed_batch_size)
+        self.concurrency = max(1, concurrency)
+        self.stats = EmbeddingStats()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            # the model splits batches larger than its own batch size
+            self.stats.calls += math.ceil(
+                len(texts) / self.embed_model.embed_batch_size
+            )
+            return await self.embed_model.aget_text_embedding_batch(texts)
+
+    async def aembed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Embeddings of the texts, in input order"""
+        self.stats.texts += len(texts)
+        embeddings: Dict[str, List[float]] = {}
+        keys: Dict[str, str] = {}
+        if self.cache is not None:
+            keys = {text: self.cache.key(text) for text in texts}
+            cached = self.cache.get(list(keys.values()))
+            for text, key in keys.items():
+                if key in cached:
+                    embeddings[text] = cached[key].tolist()
+            self.stats.cache_hits += sum(1 for text in texts if text in embeddings)
+
+        missing = list(dict.fromkeys(text for text in texts if text not in embeddings))
+        batches = [
+            missing[index : index + self.batch_size]
+            for index in range(0, len(missing), self.batch_size)
+        ]
+        results = await asyncio.gather(*map(self._embed_batch, batches))
+        for batch, vectors in zip(batches, results):
+            embeddings.update(zip(batch, vectors))
+            if self.cache is not None:
+                self.cache.put([keys[text] for text in batch], vectors)
+        return [embeddings[text] for text in texts]
+
+    def log_stats(self) -> None:
+        """Log texts, cache hits and calls"""
+        logger.info(
+            "Embeddings: %d texts, %d from the cache, %d calls",
+            self.stats.texts,
+            self.stats.cache_hits,
+            self.stats.calls,
+        )
@@ -0,0 +1,362 @@
+"""
+Entity resolution: find near-duplicate entities of a label and merge them
+"""
+import logging
+import re
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import neo4j
+import numpy as np
+
+from bulk_writer import Neo4jBulkWriter
+
+logger = logging.getLogger("input_pipeline.entity_resolution")
+
+# words that do not tell organizations apart
+NAME_STOPWORDS = {
+    "ag",
+    "co",
+    "company",
+    "corp",
+    "corporation",
+    "gmbh",
+    "inc",
+    "incorporated",
+    "limited",
+    "llc",
+    "ltd",
+    "plc",
+    "sa",
+    "the",
+}
+
+WORD = re.compile(r"\w+")
+
+LOAD_ENTITIES = """
+MATCH (e:__Entity__)
+WHERE e.id > $after
+RETURN e.id AS id, e.name AS name,
+       [label IN labels(e) WHERE NOT label IN ['__Entity__', '__Node__', 'Chunk']][0]
+           AS label,
+       e.embedding AS embedding,
+       COUNT { (e)--() } AS degree
+ORDER BY e.id
+LIMIT $limit
+"""
+
+COUNT_GRAPH = """
+RETURN COUNT { (:__Entity__) } AS entities, COUNT { ()-[]->() } AS relationships
+"""
+
+# the first node of a cluster is kept with its properties, the relationships
+# of the others are moved to it and parallel ones merged; relationships
+# between duplicates would become loops and are dropped. The documents
+# mentioning any of the duplicates are kept in doc_ids, like their names in
+# aliases
+MERGE_ENTITIES = """
+UNWIND $rows AS cluster
+CALL {
+    WITH cluster
+    UNWIND range(0, size(cluster.ids) - 1) AS position
+    MATCH (e:__Entity__ {id: cluster.ids[position]})
+    WITH e ORDER BY position
+    RETURN collect(e) AS nodes
+}
+WITH cluster, nodes,
+     apoc.coll.toSet(reduce(ids = [], e IN nodes | ids + coalesce(e.doc_ids, [])))
+         AS doc_ids
+WHERE size(nodes) > 1
+CALL apoc.refactor.mergeNodes(nodes, {properties: 'discard', mergeRels: true})
+YIELD node
+SET node.aliases = apoc.coll.toSet(coalesce(node.aliases, []) + cluster.aliases),
+    node.doc_ids = doc_ids
+WITH node
+OPTIONAL MATCH (node)-[loop]->(node)
+DELETE loop
+"""
+
+
+def normalize_name(name: str) -> str:
+    """Lower case words of a name without accents, punctuation and legal forms"""
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    words = WORD.findall(
+        "".join(char for char in decomposed if not unicodedata.combining(char))
+    )
+    return " ".join([word for word in words if word not in NAME_STOPWORDS] or words)
+
+
+def trigrams(text: str) -> Set[str]:
+    """Character trigrams of a normalized name, spaces removed"""
+    text = text.replace(" ", "")
+    if len(text) < 3:
+        return {text}
+    return {text[index : index + 3] for index in range(len(text) - 2)}
+
+
+def acronym(normalized: str) -> str:
+    """Initials of a normalized name of several words"""
+    words = normalized.split()
+    return "".join(word[0] for word in words) if len(words) > 1 else ""
+
+
+@dataclass
+class Entity:
+    """Entity node as seen by the resolution"""
+
+    id: str
+    name: str
+    label: Optional[str]
+    embedding: Optional[np.ndarray]
+    degree: int = 0
+    normalized: str = field(init=False)
+    trigrams: Set[str] = field(init=False, repr=False)
+    acronym: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.normalized = normalize_name(self.name)
+        self.trigrams = trigrams(self.normalized)
+        self.acronym = acronym(self.normalized)
+
+    def blocking_keys(self) -> Set[str]:
+        """Keys of the blocks the entity is compared within, besides its name"""
+        keys = {f"gram:{gram}" for gram in self.trigrams}
+        # "ibm" and "international business machines" share a block
+        keys.add(f"acronym:{self.acronym or self.normalized.replace(' ', '')}")
+        return keys
+
+
+@dataclass
+class ResolutionStats:
+    """Comparisons made, duplicates merged and size of the graph around it"""
+
+    entities_before: int = 0
+    entities_after: int = 0
+    relationships_before: int = 0
+    relationships_after: int = 0
+    candidate_pairs: int = 0
+    clusters: int = 0
+    merged: int = 0  # duplicates merged into another entity
+    seconds: float = 0.0
+
+    @property
+    def entity_reduction(self) -> float:
+        """Share of the entities removed"""
+        if not self.entities_before:
+            return 0.0
+        return 1 - self.entities_after / self.entities_before
+
+    @property
+    def relationship_reduction(self) -> float:
+        """Share of the relationships removed"""
+        if not self.relationships_before:
+            return 0.0
+        return 1 - self.relationships_after / self.relationships_before
+
+
+class _UnionFind:
+    def __init__(self) -> None:
+        self.parents: Dict[str, str] = {}
+
+    def find(self, item: str) -> str:
+        root = self.parents.setdefault(item, item)
+        while root != self.parents[root]:
+            root = self.parents[root]
+        while item != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, first: str, second: str) -> None:
+        self.parents[self.find(first)] = self.find(second)
+
+
+def _normalized(embedding: Optional[Iterable[float]]) -> Optional[np.ndarray]:
+    if embedding is None:
+        return None
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def load_entities(
+    driver: neo4j.Driver, database: Optional[str] = None, page_size: int = 5000
+) -> List[Entity]:
+    """Entities of the graph with their embedding and number of relationships"""
+    entities: List[Entity] = []
+    after = ""
+    while True:
+        records, _, _ = driver.execute_query(
+            LOAD_ENTITIES, after=after, limit=page_size, database_=database
+        )
+        if not records:
+            return entities
+        after = max(record["id"] for record in records)
+        entities.extend(
+            Entity(
+                id=record["id"],
+                name=record["name"] or record["id"],
+                label=record["label"],
+                embedding=_normalized(record["embedding"]),
+                degree=record["degree"],
+            )
+            for record in records
+        )
+
+
+def find_duplicates(
+    entities: Iterable[Entity],
+    similarity: float = 0.9,
+    name_similarity: float = 0.5,
+    max_block: int = 100,
+    stats: Optional[ResolutionStats] = None,
+) -> List[List[Entity]]:
+    """
+    Clusters of duplicate entities of the same label, each led by the entity
+    to keep: the one with the most relationships, then the longest name.
+
+    Entities with equal normalized names are duplicates. Other entities are
+    only compared within blocks sharing a name trigram or acronym, blocks
+    larger than `max_block` are skipped.
+    Two compared entities are duplicates when the cosine similarity of their
+    embeddings reaches `similarity` and their names share `name_similarity`
+    of their trigrams or one is the acronym of the other.
+    """
+    stats = stats if stats is not None else ResolutionStats()
+    by_id = {entity.id: entity for entity in entities}
+    blocks: Dict[str, List[Entity]] = {}
+    for entity in by_id.values():
+        for key in entity.blocking_keys():
+            blocks.setdefault(f"{entity.label}\0{key}", []).append(entity)
+
+    union_find = _UnionFind()
+    # equal normalized names need no comparison, however many there are
+    names: Dict[Tuple[Optional[str], str], str] = {}
+    for entity in by_id.values():
+        first_id = names.setdefault((entity.label, entity.normalized), entity.id)
+        union_find.union(entity.id, first_id)
+    compared: Set[Tuple[str, str]] = set()
+    for block in blocks.values():
+        if len(block) < 2 or len(block) > max_block:
+            continue
+        for first, second in combinations(block, 2):
+            pair = (
+                (first.id, second.id) if first.id < second.id else (second.id, first.id)
+            )
+            if pair in compared:
+                continue
+            compared.add(pair)
+            if union_find.find(first.id) == union_find.find(second.id):
+                continue
+            if _duplicates(first, second, similarity, name_similarity):
+                union_find.union(first.id, second.id)
+    stats.candidate_pairs += len(compared)
+
+    clusters: Dict[str, List[Entity]] = {}
+    for entity_id in union_find.parents:
+        clusters.setdefault(union_find.find(entity_id), []).append(by_id[entity_id])
+    duplicates = [
+        sorted(
+            cluster, key=lambda entity: (-entity.degree, -len(entity.name), entity.id)
+        )
+        for cluster in clusters.values()
+        if len(cluster) > 1
+    ]
+    stats.clusters += len(duplicates)
+    stats.merged += sum(len(cluster) - 1 for cluster in duplicates)
+    return duplicates
+
+
+def _is_acronym(entity: Entity, other: Entity) -> bool:
+    return bool(entity.acronym) and entity.acronym == other.normalized
+
+
+def _duplicates(
+    first: Entity, second: Entity, similarity: float, name_similarity: float
+) -> bool:
+    if first.normalized == second.normalized:
+        return True
+    if first.embedding is None or second.embedding is None:
+        return False
+    if first.embedding.shape != second.embedding.shape:
+        return False
+    names_match = (
+        len(first.trigrams & second.trigrams) / len(first.trigrams | second.trigrams)
+        >= name_similarity
+        or _is_acronym(first, second)
+        or _is_acronym(second, first)
+    )
+    return names_match and float(first.embedding @ second.embedding) >= similarity
+
+
+def _count(driver: neo4j.Driver, database: Optional[str]) -> Tuple[int, int]:
+    records, _, _ = driver.execute_query(COUNT_GRAPH, database_=database)
+    if not records:
+        return 0, 0
+    return records[0]["entities"], records[0]["relationships"]
+
+
+def resolve_entities(
+    driver: neo4j.Driver,
+    database: Optional[str] = None,
+    similarity: float = 0.9,
+    name_similarity: float = 0.5,
+    max_block: int = 100,
+    batch_size: int = 100,
+    dry_run: bool = False,
+) -> ResolutionStats:
+    """
+    Merge the duplicate entities `find_duplicates` reports into the entity
+    kept, with apoc.refactor.mergeNodes moving their relationships and
+    mentions, and record the names merged as `aliases`. Clusters are merged
+    `batch_size` per transaction; a `dry_run` only logs them.
+    """
+    start_time = time.perf_counter()
+    stats = ResolutionStats()
+    stats.entities_before, stats.relationships_before = _count(driver, database)
+    clusters = find_duplicates(
+        load_entities(driver, database),
+        similarity=similarity,
+        name_similarity=name_similarity,
+        max_block=max_block,
+        stats=stats,
+    )
+    for cluster in clusters:
+        logger.debug(
+            "Merging %s into %s",
+            ", ".join(repr(entity.name) for entity in cluster[1:]),
+            repr(cluster[0].name),
+        )
+    if not dry_run and clusters:
+        writer = Neo4jBulkWriter(driver, database=database, batch_size=batch_size)
+        writer.write(
+            "merges",
+            MERGE_ENTITIES,
+            [
+                {
+                    "ids": [entity.id for entity in cluster],
+                    "aliases": [entity.name for entity in cluster[1:]],
+                }
+                for cluster in clusters
+            ],
+        )
+    stats.entities_after, stats.relationships_after = _count(driver, database)
+    stats.seconds = time.perf_counter() - start_time
+    logger.info(
+        "Entity resolution%s: %d candidate pairs, %d duplicates in %d clusters, "
+        "entities %d -> %d (-%.1f%%), relationships %d -> %d (-%.1f%%) in %.1fs",
+        " (dry run)" if dry_run else "",
+        stats.candidate_pairs,
+        stats.merged,
+        stats.clusters,
+        stats.entities_before,
+        stats.entities_after,
+        stats.entity_reduction * 100,
+        stats.relationships_before,
+        stats.relationships_after,
+        stats.relationship_reduction * 100,
+        stats.seconds,
+    )
+    return stats
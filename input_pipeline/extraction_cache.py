@@ -0,0 +1,229 @@
+"""
+Persistent cache of knowledge graph extraction results
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence, Tuple
+
+from llama_index.core.graph_stores.types import (
+    KG_NODES_KEY,
+    KG_RELATIONS_KEY,
+    EntityNode,
+    Relation,
+)
+from llama_index.core.schema import BaseNode, MetadataMode
+
+logger = logging.getLogger("input_pipeline.extraction_cache")
+
+# bump when the way extraction results are stored changes
+CACHE_VERSION = "1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extractions (
+    key TEXT PRIMARY KEY,
+    extraction TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS extractions_accessed ON extractions (accessed);
+"""
+
+
+@dataclass
+class ExtractionCacheStats:
+    """Cache hits, misses and evictions of a run"""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of lookups answered from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def _strip(properties: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the properties the extractor copied from the chunk metadata"""
+    return {key: value for key, value in properties.items() if key not in metadata}
+
+
+class ExtractionCache:
+    """
+    Map chunks to the entities and relations extracted from them, keyed by
+    the text the LLM saw, the schema, the model and the prompt version.
+
+    The chunk metadata the extractor copies into every entity and relation is
+    not stored but taken from the chunk a result is restored into. The key
+    covers the metadata the LLM sees, the file path among it, so entries are
+    shared by equal chunks of the same file, e.g. of a modified document,
+    not by those of different files. The least recently used entries are
+    evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        schema_hash: str,
+        model: str,
+        prompt_version: str,
+        max_bytes: int = 512 << 20,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = ExtractionCacheStats()
+        self._namespace = "\0".join((CACHE_VERSION, schema_hash, model, prompt_version))
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Close the database"""
+        self.connection.close()
+
+    def key(self, node: BaseNode) -> str:
+        """Cache key of a chunk, the same before and after its extraction"""
+        # the extraction results in the metadata are not part of the text
+        node = node.model_copy(
+            update={
+                "excluded_llm_metadata_keys": [
+                    *node.excluded_llm_metadata_keys,
+                    KG_NODES_KEY,
+                    KG_RELATIONS_KEY,
+                ]
+            }
+        )
+        text = node.get_content(metadata_mode=MetadataMode.LLM)
+        digest = hashlib.sha256(self._namespace.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def lookup(
+        self, nodes: Sequence[BaseNode]
+    ) -> Tuple[List[BaseNode], List[BaseNode]]:
+        """
+        Restore cached extraction results into the metadata of chunks and
+        return the chunks that were found and those that were not
+        """
+        keys = {node.id_: self.key(node) for node in nodes}
+        cached: Dict[str, str] = {}
+        unique_keys = list(set(keys.values()))
+        # stay below the SQLite limit of host parameters
+        for index in range(0, len(unique_keys), 500):
+            batch = unique_keys[index : index + 500]
+            rows = self.connection.execute(
+                "SELECT key, extraction FROM extractions "
+                f"WHERE key IN ({', '.join('?' * len(batch))})",
+                batch,
+            )
+            cached.update(rows)
+
+        hits: List[BaseNode] = []
+        misses: List[BaseNode] = []
+        for node in nodes:
+            extraction = cached.get(keys[node.id_])
+            if extraction is None:
+                misses.append(node)
+                continue
+            data = json.loads(extraction)
+            metadata = {
+                key: value
+                for key, value in node.metadata.items()
+                if key not in (KG_NODES_KEY, KG_RELATIONS_KEY)
+            }
+            kg_nodes = [EntityNode(**kg_node) for kg_node in data[KG_NODES_KEY]]
+            relations = [Relation(**relation) for relation in data[KG_RELATIONS_KEY]]
+            for kg_node in kg_nodes:
+                kg_node.properties.update(metadata)
+            for relation in relations:
+                relation.properties.update(metadata)
+            node.metadata[KG_NODES_KEY] = kg_nodes
+            node.metadata[KG_RELATIONS_KEY] = relations
+            hits.append(node)
+
+        if hits:
+            with self.connection:
+                self.connection.executemany(
+                    "UPDATE extractions SET accessed = ? WHERE key = ?",
+                    [(time.time(), keys[node.id_]) for node in hits],
+                )
+        self.stats.hits += len(hits)
+        self.stats.misses += len(misses)
+        return hits, misses
+
+    def store(self, nodes: Sequence[BaseNode]) -> None:
+        """Cache the extraction results in the metadata of chunks"""
+        rows = []
+        now = time.time()
+        for node in nodes:
+            metadata = node.metadata
+            extraction = json.dumps(
+                {
+                    KG_NODES_KEY: [
+                        {
+                            **kg_node.model_dump(),
+                            "properties": _strip(kg_node.properties, metadata),
+                        }
+                        for kg_node in metadata.get(KG_NODES_KEY, [])
+                    ],
+                    KG_RELATIONS_KEY: [
+                        {
+                            **relation.model_dump(),
+                            "properties": _strip(relation.properties, metadata),
+                        }
+                        for relation in metadata.get(KG_RELATIONS_KEY, [])
+                    ],
+                }
+            )
+            rows.append((self.key(node), extraction, len(extraction), now))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO extractions (key, extraction, size, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        self._evict()
+
+    @property
+    def size(self) -> int:
+        """Bytes of cached extraction results"""
+        (size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM extractions"
+        ).fetchone()
+        return size
+
+    def _evict(self) -> None:
+        excess = self.size - self.max_bytes
+        if excess <= 0:
+            return
+        # make some room, so not every store has to evict again
+        excess += self.max_bytes // 10
+        keys = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM extractions ORDER BY accessed"
+        ):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.connection:
+            self.connection.executemany("DELETE FROM extractions WHERE key = ?", keys)
+        self.stats.evictions += len(keys)
+
+    def log_stats(self) -> None:
+        """Log hits, misses and evictions"""
+        logger.info(
+            "Extraction cache: %d hits, %d misses (%.0f%% hit rate), "
+            "%d evictions, %.1f MB",
+            self.stats.hits,
+            self.stats.misses,
+            100 * self.stats.hit_rate,
+            self.stats.evictions,
+            self.size / (1 << 20),
+        )
@@ -0,0 +1,156 @@
+"""
+Compiled validation schema for the knowledge graph extractor
+"""
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from llama_index.core import PromptTemplate
+
+Triple = Tuple[str, str, str]
+
+# relations of a source entity, either a plain list (any target entity) or a
+# mapping of relation to its allowed target entities (none for any)
+SourceRelations = Union[List[str], Mapping[str, Optional[List[str]]]]
+ValidationSchema = Mapping[str, SourceRelations]
+
+# the default prompt of SchemaLLMPathExtractor with the schema description
+EXTRACT_PROMPT = PromptTemplate(
+    "Give the following text, extract the knowledge graph according to the provided schema. "
+    "Try to limit the output to {max_triplets_per_chunk} extracted paths.\n"
+    "Allowed relations per subject type, with the allowed object types where "
+    "they are restricted:\n"
+    "{schema}\n"
+    "-------\n"
+    "{text}\n"
+    "-------\n"
+)
+
+
+class CompiledSchema:
+    """
+    Allowed (source, relation, target) triples, stored as a relation set per
+    source entity plus target sets for constrained relations, so a triple is
+    checked with two hash lookups instead of a scan over the cartesian product.
+
+    Pass it as `kg_validation_schema={"relationships": schema}`, the
+    extractor only uses `in` on it.
+    """
+
+    def __init__(
+        self,
+        entities: List[str],
+        relations: Dict[str, FrozenSet[str]],
+        targets: Dict[Tuple[str, str], FrozenSet[str]],
+    ) -> None:
+        self.entities = frozenset(entities)
+        self._entity_order = list(entities)
+        self._relations = relations
+        self._targets = targets
+
+    @classmethod
+    def compile(
+        cls, entities: List[str], validation_schema: ValidationSchema
+    ) -> "CompiledSchema":
+        """Compile the `validation_schema` section of entity_relations.yaml"""
+        known = set(entities)
+        relations: Dict[str, FrozenSet[str]] = {}
+        targets: Dict[Tuple[str, str], FrozenSet[str]] = {}
+        for source, source_relations in validation_schema.items():
+            if source not in known:
+                raise ValueError(f"Unknown source entity {source} in validation schema")
+            if isinstance(source_relations, Mapping):
+                relations[source] = frozenset(source_relations)
+                for relation, relation_targets in source_relations.items():
+                    if relation_targets is None:
+                        continue
+                    unknown = set(relation_targets) - known
+                    if unknown:
+                        raise ValueError(
+                            f"Unknown target entities {', '.join(sorted(unknown))} "
+                            f"for {source} {relation} in validation schema"
+                        )
+                    targets[(source, relation)] = frozenset(relation_targets)
+            else:
+                relations[source] = frozenset(source_relations or [])
+        return cls(entities, relations, targets)
+
+    def restrict(self, entities: Iterable[str]) -> "CompiledSchema":
+        """Schema of the triples between the given entities only"""
+        kept = frozenset(entities)
+        relations: Dict[str, FrozenSet[str]] = {}
+        targets: Dict[Tuple[str, str], FrozenSet[str]] = {}
+        for source, source_relations in self._relations.items():
+            if source not in kept:
+                continue
+            allowed = set()
+            for relation in source_relations:
+                allowed_targets = self._targets.get((source, relation))
+                if allowed_targets is not None:
+                    allowed_targets &= kept
+                    if not allowed_targets:
+                        continue
+                    targets[(source, relation)] = allowed_targets
+                allowed.add(relation)
+            relations[source] = frozenset(allowed)
+        return CompiledSchema(
+            [entity for entity in self._entity_order if entity in kept],
+            relations,
+            targets,
+        )
+
+    @property
+    def relations(self) -> FrozenSet[str]:
+        """Relations of any source entity"""
+        return frozenset().union(*self._relations.values())
+
+    def allows(self, source: str, relation: str, target: str) -> bool:
+        """Whether the schema allows a triple"""
+        if target not in self.entities:
+            return False
+        if relation not in self._relations.get(source, ()):
+            return False
+        allowed_targets = self._targets.get((source, relation))
+        return allowed_targets is None or target in allowed_targets
+
+    def __contains__(self, triple: object) -> bool:
+        if not isinstance(triple, tuple) or len(triple) != 3:
+            return False
+        return self.allows(*triple)
+
+    def __iter__(self) -> Iterator[Triple]:
+        for source, relations in self._relations.items():
+            for relation in sorted(relations):
+                allowed_targets = self._targets.get((source, relation))
+                for target in self._entity_order:
+                    if allowed_targets is None or target in allowed_targets:
+                        yield source, relation, target
+
+    def __len__(self) -> int:
+        return sum(
+            len(self._targets.get((source, relation), self.entities))
+            for source, relations in self._relations.items()
+            for relation in relations
+        )
+
+    def describe(self) -> str:
+        """Compact description of the schema for the extraction prompt"""
+        lines = []
+        for source, relations in self._relations.items():
+            parts = []
+            for relation in sorted(relations):
+                allowed_targets = self._targets.get((source, relation))
+                if allowed_targets is None:
+                    parts.append(relation)
+                else:
+                    parts.append(f"{relation} -> {'|'.join(sorted(allowed_targets))}")
+            lines.append(f"{source}: {', '.join(parts)}")
+        return "\n".join(lines)
@@ -2,20 +2,32 @@
 """
 Build knowledge graph from Markdown files
 """
-import pickle
+import argparse
+import asyncio
 import time
-from typing import Any, Dict, List, Tuple, TypedDict
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Literal,
+    NotRequired,
+    Optional,
+    TypedDict,
+    Union,
+)
 import logging
 
 
 import yaml  # type: ignore [import-untyped]
-from llama_index.core import (  # type: ignore [import-untyped]
-    PropertyGraphIndex,
-    Settings,
-    SimpleDirectoryReader,
-    schema,
-)
+from llama_index.core import Settings  # type: ignore [import-untyped]
 from llama_index.core.indices.property_graph import SchemaLLMPathExtractor
+from llama_index.core.node_parser import MarkdownNodeParser, SentenceSplitter
+from llama_index.core.readers.base import BaseReader
+from llama_index.core.schema import TransformComponent
 from llama_index.embeddings.azure_openai import (  # type: ignore [import-untyped]
     AzureOpenAIEmbedding,
 )
@@ -25,28 +37,47 @@ from llama_index.graph_stores.neo4j import (  # type: ignore [import-untyped]
 from llama_index.llms.azure_openai import AzureOpenAI  # type: ignore [import-untyped]
 from llama_parse import LlamaParse, ResultType  # type: ignore [import-untyped]
 
+from bulk_writer import Neo4jBulkWriter
+from checkpoint import CheckpointStore
+from classifier import ChunkClassifier, ClassifyingExtractor
+from chunking import TokenChunker
+from embedding import EmbeddingCache, EmbeddingStage
+from entity_resolution import ResolutionStats, resolve_entities
+from extraction_cache import ExtractionCache
+from graph_schema import EXTRACT_PROMPT, CompiledSchema, ValidationSchema
+from manifest import IngestManifest, schema_sha256
+from metrics import RunReport, TokenCounter
 from module_settings import settings, logger
-
-Triple = Tuple[str, str, str]
+from neo4j_schema import bootstrap_schema
+from parsing import MarkdownFileReader, ParsedFile, ParsingStage, list_files
+from pipeline import IngestionPipeline, PipelineStats
+from provenance import document_id, document_version
+from scheduler import ExtractionScheduler
+from snapshot import export_graph, import_graph
 
 
 class EntitiesConfig(TypedDict):
     entities: List[str]
     relations: List[str]
-    validation_schema: Dict[str, List[str]]
+    validation_schema: ValidationSchema
+    # keywords per entity for the chunk classifier, and boilerplate lines
+    keywords: NotRequired[Dict[str, Optional[List[str]]]]
+    boilerplate: NotRequired[List[str]]
 
 
 graph_store = Neo4jPropertyGraphStore(
     username=settings.neo4j_username,
     password=settings.neo4j_password.get_secret_value(),
     url=settings.neo4j_uri,
+    database=settings.neo4j_database,
 )
 
 logger.debug("Setting up parser")
 # set up parser
 parser = LlamaParse(
     # result_type=ResultType.MD,
-    split_by_page=True,  # force to split by page
+    split_by_page=True,  # pages, merged and split to chunks by the TokenChunker
+    ignore_errors=False,  # let the parsing stage retry failed files
     api_key=settings.llama_cloud_api_key.get_secret_value(),
 )
 
@@ -76,31 +107,154 @@ Settings.embed_model = embed_model
 
 
 def build_knowledge_graph(
-    documents: list[schema.Document],
-    kg_extractor: SchemaLLMPathExtractor,
+    parsed_files: AsyncIterator[ParsedFile],
+    kg_extractor: Union[SchemaLLMPathExtractor, ExtractionScheduler],
+    on_file_written: Optional[Callable[[Path], None]] = None,
+    checkpoint: Optional[CheckpointStore] = None,
+    extraction_cache: Optional[ExtractionCache] = None,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    transformations: Optional[List[TransformComponent]] = None,
+    report: Optional[RunReport] = None,
+    document_versions: Optional[Dict[str, str]] = None,
     show_progress: bool = True,
-) -> None:
-    """Build knowledge graph from documents and store in graph store"""
+    document_paths: Optional[Dict[str, str]] = None,
+) -> PipelineStats:
+    """Build knowledge graph from parsed documents and store in graph store"""
     logger.debug("Building knowledge graph ...")
-    PropertyGraphIndex.from_documents(
-        llm=llm,
-        documents=documents,
-        kg_extractor=[kg_extractor],
-        embed_model=embed_model,
-        property_graph_store=graph_store,
+    replace_documents = settings.replace_documents and document_versions is not None
+    bulk_writer: Optional[Neo4jBulkWriter] = None
+    if settings.bulk_write or replace_documents:
+        bulk_writer = Neo4jBulkWriter(
+            graph_store.client,
+            database=settings.neo4j_database,
+            batch_size=settings.bulk_write_batch_size,
+        )
+    embedding_stage = EmbeddingStage(
+        embed_model,
+        cache=embedding_cache,
+        batch_size=settings.embedding_batch_size,
+        concurrency=settings.embedding_concurrency,
+    )
+    pipeline = IngestionPipeline(
+        kg_extractor,
+        graph_store,
+        embed_model,
+        transformations=transformations,
+        batch_size=settings.pipeline_batch_size,
+        queue_size=settings.pipeline_queue_size,
+        on_file_written=on_file_written,
+        bulk_writer=bulk_writer,
+        checkpoint=checkpoint,
+        extraction_cache=extraction_cache,
+        embedding_stage=embedding_stage,
+        document_versions=document_versions,
+        replace_documents=replace_documents,
         show_progress=show_progress,
+        document_paths=document_paths,
+    )
+    stats = asyncio.run(pipeline.arun(parsed_files))
+    if report is not None:
+        report.add_pipeline_stats(stats)
+    if bulk_writer is not None:
+        bulk_writer.log_stats()
+        if report is not None:
+            report.add_bulk_write_stats(bulk_writer.stats)
+    if extraction_cache is not None:
+        extraction_cache.log_stats()
+    embedding_stage.log_stats()
+    return stats
+
+
+def remove_documents(file_paths: List[str]) -> None:
+    """Remove the chunks, relations and orphaned entities of documents from the graph store"""
+    if not file_paths:
+        return
+    writer = Neo4jBulkWriter(graph_store.client, database=settings.neo4j_database)
+    chunks = entities = 0
+    for file_path in file_paths:
+        result = writer.replace_document(document_id(file_path), file_path)
+        chunks += result.chunks
+        entities += result.entities
+    logger.info(
+        "Removed %d chunks and %d orphaned entities of %d documents",
+        chunks,
+        entities,
+        len(file_paths),
     )
 
 
+def source_pdf(markdown_file: Path) -> Path:
+    """PDF file a Markdown file of to_markdowns.py was converted from"""
+    return Path(settings.pdf_path) / f"{markdown_file.stem}.pdf"
+
+
 def load_entities(file_path: str) -> EntitiesConfig:
     """Load suggested entities for the knowledge graph from a file"""
     with open(file_path, "r", encoding="utf-8") as file:
         return yaml.safe_load(file)
 
 
-def main():
+def export_snapshot(directory: str) -> None:
+    """Dump the knowledge graph to Arrow files"""
+    info = export_graph(
+        graph_store.client,
+        directory,
+        settings.embedding_dimension,
+        database=settings.neo4j_database,
+    )
+    logger.info(
+        "Exported %s to %s",
+        ", ".join(f"{count} {kind}" for kind, count in info.rows.items()),
+        directory,
+    )
+
+
+def import_snapshot(directory: str) -> None:
+    """Load a knowledge graph dumped by export_snapshot"""
+    bootstrap_schema(
+        graph_store.client,
+        database=settings.neo4j_database,
+        embedding_dimension=settings.embedding_dimension,
+        timeout=settings.neo4j_index_timeout,
+        quantization=settings.neo4j_vector_quantization,
+    )
+    info = import_graph(
+        graph_store.client,
+        directory,
+        database=settings.neo4j_database,
+        batch_size=settings.bulk_write_batch_size,
+    )
+    logger.info("Imported the snapshot of %s from %s", info.created_at, directory)
+
+
+def resolve_graph_entities(dry_run: bool = False) -> ResolutionStats:
+    """Merge near-duplicate entities of the knowledge graph"""
+    return resolve_entities(
+        graph_store.client,
+        database=settings.neo4j_database,
+        similarity=settings.entity_resolution_similarity,
+        name_similarity=settings.entity_resolution_name_similarity,
+        max_block=settings.entity_resolution_max_block,
+        dry_run=dry_run,
+    )
+
+
+def main(resume: bool = False, source: str = "pdf"):
     """Main function"""
 
+    report = RunReport()
+    token_counter = TokenCounter(settings.azure_openai_model)
+    token_counter.attach(llm, embed_model)
+
+    # constraints and indexes the MERGEs and lookups rely on
+    bootstrap_schema(
+        graph_store.client,
+        database=settings.neo4j_database,
+        embedding_dimension=settings.embedding_dimension,
+        timeout=settings.neo4j_index_timeout,
+        quantization=settings.neo4j_vector_quantization,
+    )
+
     entities_config: EntitiesConfig  # type: ignore [annotation-unchecked]
     entities_config = load_entities("entity_relations.yaml")
 
@@ -109,67 +263,297 @@ def main():
     relations: List[str] = entities_config["relations"]  # type: ignore [annotation-unchecked]
     logger.info("Loaded %d entities", len(entities))  # type: ignore [annotation-unchecked]
 
-    validation_schema: Dict[str, List[str]]  # type: ignore [annotation-unchecked]
-    validation_schema = entities_config["validation_schema"]  # type: ignore [annotation-unchecked]
-
-    # Convert validation_schema to a List[Triple]
-    triples: List[Triple] = []  # type: ignore [annotation-unchecked]
-    for entity, relations_list in validation_schema.items():
-        for relation in relations_list:
-            # Assuming the target entities are all entities
-            for target_entity in entities:
-                triples.append((entity, relation, target_entity))
-
-    # Use Any to bypass type checking or use type: ignore
-    possible_entities: Any = entities  # type: ignore [annotation-unchecked]
-    possible_relations: Any = relations  # type: ignore [annotation-unchecked]
+    # relation sets per source entity, targets only where they are restricted
+    validation_schema = CompiledSchema.compile(
+        entities, entities_config["validation_schema"]
+    )
+    logger.info("Validation schema allows %d triples", len(validation_schema))
 
     # Use the schema to validate the relationships
     if logging.getLogger().isEnabledFor(logging.DEBUG):
-        for entity, relations in validation_schema.items():
-            # Log the entity and its associated relations
-            logger.debug("Validating %s -> %s", entity, ", ".join(relations))
+        for line in validation_schema.describe().splitlines():
+            logger.debug("Validating %s", line)
+
+    def make_extractor(entity_types: FrozenSet[str]) -> SchemaLLMPathExtractor:
+        """Knowledge graph extractor advertising the given entity types only"""
+        schema = validation_schema.restrict(entity_types)
+        # Use Any to bypass type checking or use type: ignore
+        possible_entities: Any = [e for e in entities if e in entity_types]
+        possible_relations: Any = [r for r in relations if r in schema.relations]
+        if settings.extraction_strict:
+            # the strict extractor validates types against Literal types
+            possible_entities = Literal[tuple(possible_entities)]
+            possible_relations = Literal[tuple(possible_relations)]
+        return SchemaLLMPathExtractor(
+            llm=llm,
+            possible_entities=possible_entities,
+            possible_relations=possible_relations,
+            extract_prompt=EXTRACT_PROMPT.partial_format(schema=schema.describe()),
+            # annotated as Dict[str, str], the extractor only uses `in` on it
+            kg_validation_schema={"relationships": schema},  # type: ignore [dict-item]
+            # if false, allows for values outside of the schema
+            # useful for using the schema as a suggestion
+            strict=settings.extraction_strict,
+        )
 
     logger.debug("Setting up knowledge graph extractor")
     # Knowledge graph
-    kg_extractor = SchemaLLMPathExtractor(
-        llm=llm,
-        possible_entities=possible_entities,
-        possible_relations=possible_relations,
-        kg_validation_schema=triples,
-        # if false, allows for values outside of the schema
-        # useful for using the schema as a suggestion
-        strict=False,
-    )
-
-    # Use Llama-Parser to extract text from PDF files
-    file_extractor = {".pdf": parser}
-    # only load pdf files
-    required_exts = [".pdf"]
-    documents: list[schema.Document] = []  # type: ignore [annotation-unchecked]
-    documents = SimpleDirectoryReader(
-        settings.pdf_path,
-        file_extractor=file_extractor,
-        required_exts=required_exts,
-        recursive=False,
-    ).load_data()
-    logger.debug("Loaded %d documents", len(documents))
-
-    # Save documents for further inspection
-    if logging.getLogger().isEnabledFor(logging.DEBUG):
-        with open("documents.pkl", "wb") as file:
-            # Use pickle.dump to serialize and save the documents
-            logger.debug("Saving documents to disk")
-            pickle.dump(documents, file, protocol=pickle.HIGHEST_PROTOCOL)
+    kg_extractor: Union[SchemaLLMPathExtractor, ClassifyingExtractor]
+    kg_extractor = make_extractor(frozenset(entities))
+    if settings.extraction_classify:
+        # only advertise the entity types the keywords of a chunk suggest,
+        # and skip boilerplate chunks
+        kg_extractor = ClassifyingExtractor(
+            classifier=ChunkClassifier(
+                entities,
+                entities_config.get("keywords") or {},
+                boilerplate=entities_config.get("boilerplate") or [],
+            ),
+            make_extractor=make_extractor,
+        )
+
+    transformations: Optional[List[TransformComponent]] = None
+    chunker: Optional[TokenChunker] = None
+    if source == "markdown":
+        # Markdown from to_markdowns.py, chunked along its headings and
+        # long sections split further
+        file_extractor: Dict[str, BaseReader] = {".md": MarkdownFileReader()}
+        required_exts = [".md"]
+        source_path = settings.markdown_path
+        transformations = [
+            MarkdownNodeParser(),
+            SentenceSplitter(
+                chunk_size=settings.chunk_size, chunk_overlap=settings.chunk_overlap
+            ),
+        ]
+    else:
+        # Use Llama-Parser to extract text from PDF files
+        file_extractor = {".pdf": parser}
+        # pages merged and split to the token budget of the extractor
+        chunker = TokenChunker(
+            chunk_size=settings.chunk_size,
+            chunk_overlap=settings.chunk_overlap,
+            model=settings.azure_openai_model,
+        )
+        transformations = [chunker]
+        # only load pdf files
+        required_exts = [".pdf"]
+        source_path = settings.pdf_path
 
-    build_knowledge_graph(documents, kg_extractor, show_progress=False)
+    files = list_files(source_path, required_exts)
+    # a Markdown file is a version of the document of its PDF, so switching
+    # the source replaces the documents instead of adding them again
+    document_paths: Dict[str, str] = {}
+    if source == "markdown":
+        document_paths = {str(path): str(source_pdf(path)) for path in files}
+
+    def document_path(path: Path) -> str:
+        return document_paths.get(str(path), str(path))
+
+    # only ingest new or modified documents
+    manifest = IngestManifest(settings.manifest_path)
+    schema_hash = schema_sha256(entities_config)
+    changes = manifest.diff(
+        files, schema_hash, settings.azure_openai_model, entry_key=document_path
+    )
+    if source == "markdown" and Path(settings.pdf_path).is_dir():
+        # PDFs not converted yet keep the version of an earlier PDF run
+        pdf_files = {str(path) for path in list_files(settings.pdf_path, [".pdf"])}
+        changes.removed = [key for key in changes.removed if key not in pdf_files]
+    logger.info(
+        "%d new, %d modified, %d unchanged and %d removed files",
+        len(changes.new),
+        len(changes.modified),
+        len(changes.unchanged),
+        len(changes.removed),
+    )
+    # continue files an interrupted run already parsed, and rebuild all
+    # others from scratch, including whatever that run wrote of them
+    checkpoint = CheckpointStore(settings.checkpoint_path, resume=resume)
+    resumed = [
+        path
+        for path in changes.to_ingest
+        if checkpoint.has_file(path, changes.content_hashes[str(path)])
+    ]
+    to_parse = [path for path in changes.to_ingest if path not in resumed]
+    if resumed:
+        logger.info("Resuming %d files from %s", len(resumed), checkpoint.path)
+    if settings.replace_documents:
+        # new and modified files replace their previous version as they are
+        # written, removed files go now
+        remove_documents(changes.removed)
+    else:
+        remove_documents(changes.removed + [document_path(path) for path in to_parse])
+    document_versions = {
+        key: document_version(content_hash, schema_hash, settings.azure_openai_model)
+        for key, content_hash in changes.content_hashes.items()
+    }
+    for key in changes.removed:
+        manifest.forget(key)
+    manifest.save()
+
+    parsing_stage = ParsingStage(
+        file_extractor,
+        workers=settings.parse_workers,
+        max_in_flight=settings.parse_max_in_flight,
+        retries=settings.parse_retries,
+        backoff=settings.parse_backoff,
+        timeout=settings.parse_timeout,
+    )
+    extraction_cache: Optional[ExtractionCache] = None
+    if settings.extraction_cache:
+        extraction_cache = ExtractionCache(
+            settings.extraction_cache_path,
+            schema_hash,
+            settings.azure_openai_model,
+            # a changed prompt or triplet limit changes the extraction results
+            schema_sha256(
+                [
+                    kg_extractor.extract_prompt.get_template(),
+                    kg_extractor.max_triplets_per_chunk,
+                    settings.extraction_classify,
+                ]
+            ),
+            max_bytes=settings.extraction_cache_max_mb << 20,
+        )
+    embedding_cache: Optional[EmbeddingCache] = None
+    if settings.embedding_cache:
+        embedding_cache = EmbeddingCache(
+            settings.embedding_cache_path,
+            settings.azure_openai_embedding_model,
+            precision=settings.embedding_cache_precision,
+        )
+
+    # requests and tokens per minute of the deployment, concurrency adapted
+    # to 429s and latency
+    scheduler = ExtractionScheduler(
+        kg_extractor,
+        requests_per_minute=settings.extraction_requests_per_minute,
+        tokens_per_minute=settings.extraction_tokens_per_minute,
+        max_concurrency=settings.extraction_max_concurrency,
+        min_concurrency=settings.extraction_min_concurrency,
+        target_latency=settings.extraction_target_latency,
+        max_retries=settings.extraction_max_retries,
+    )
+
+    parsed_files = checkpoint.checkpointed(
+        resumed, changes.content_hashes, parsing_stage.aiter_parse(to_parse)
+    )
+
+    def record_file(path: Path) -> None:
+        if path not in parsing_stage.failed:
+            manifest.record(
+                Path(document_path(path)),
+                changes.content_hashes[str(path)],
+                schema_hash,
+                settings.azure_openai_model,
+            )
+
+    try:
+        stats = build_knowledge_graph(
+            parsed_files,
+            scheduler,
+            on_file_written=record_file,
+            checkpoint=checkpoint,
+            extraction_cache=extraction_cache,
+            embedding_cache=embedding_cache,
+            transformations=transformations,
+            report=report,
+            document_versions=document_versions,
+            show_progress=False,
+            document_paths=document_paths,
+        )
+    finally:
+        manifest.save()
+        checkpoint.close()
+        if extraction_cache is not None:
+            extraction_cache.close()
+        if embedding_cache is not None:
+            embedding_cache.close()
+    logger.info(
+        "Ingested %d files: %d documents, %d chunks, %d new entities, %d relations",
+        stats.files,
+        stats.documents,
+        stats.chunks,
+        stats.entities,
+        stats.relations,
+    )
+    if parsing_stage.failed:
+        logger.error(
+            "Failed to parse %d files: %s",
+            len(parsing_stage.failed),
+            ", ".join(path.name for path in parsing_stage.failed),
+        )
+
+    scheduler.log_stats()
+    if isinstance(kg_extractor, ClassifyingExtractor):
+        kg_extractor.log_stats()
+    if settings.entity_resolution:
+        # duplicates of the non-strict extraction across chunks and files
+        report.add_resolution_stats(resolve_graph_entities())
+    report.add_parse_durations(parsing_stage.durations, parsing_stage.wait_durations)
+    if chunker is not None:
+        report.add_chunk_sizes(chunker.token_counts)
+    report.failed_files = [str(path) for path in parsing_stage.failed]
+    report.add_tokens(token_counter)
+    report.finish()
+    report.log()
+    report.write_json(settings.metrics_report_path)
+    if settings.metrics_pushgateway_url:
+        try:
+            report.push(settings.metrics_pushgateway_url, settings.metrics_job)
+        except OSError as e:
+            logger.warning("Could not push metrics: %s", e)
 
     logger.info("Done")
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run from its checkpoint",
+    )
+    arg_parser.add_argument(
+        "--source",
+        choices=["markdown", "pdf"],
+        default=settings.ingest_source,
+        help="build the graph from the PDFs or the Markdown files converted from them",
+    )
+    mode_group = arg_parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--export",
+        metavar="DIRECTORY",
+        help="dump the knowledge graph to Arrow files instead of ingesting",
+    )
+    mode_group.add_argument(
+        "--import",
+        dest="import_",
+        metavar="DIRECTORY",
+        help="load a knowledge graph dumped with --export instead of ingesting",
+    )
+    mode_group.add_argument(
+        "--resolve-entities",
+        action="store_true",
+        help="merge near-duplicate entities of the graph instead of ingesting",
+    )
+    arg_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="with --resolve-entities, only log the duplicates found",
+    )
+    args = arg_parser.parse_args()
+
     start_time = time.time()
-    main()
+    if args.export:
+        export_snapshot(args.export)
+    elif args.import_:
+        import_snapshot(args.import_)
+    elif args.resolve_entities:
+        resolve_graph_entities(dry_run=args.dry_run)
+    else:
+        main(resume=args.resume, source=args.source)
     mins, secs = divmod(time.time() - start_time, 60)
     hrs, mins = divmod(mins, 60)
     logger.info("Execution time: %02d:%02d:%02d", hrs, mins, secs)
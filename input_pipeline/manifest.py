@@ -0,0 +1,120 @@
+"""
+Incremental ingestion manifest
+"""
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence, TypedDict
+
+logger = logging.getLogger("input_pipeline.manifest")
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class ManifestEntry(TypedDict):
+    content_hash: str
+    schema_hash: str
+    model: str
+    ingested_at: str
+
+
+@dataclass
+class ManifestDiff:
+    """Files of a run grouped by what has to happen to them"""
+
+    new: List[Path] = field(default_factory=list)
+    modified: List[Path] = field(default_factory=list)
+    unchanged: List[Path] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    content_hashes: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def to_ingest(self) -> List[Path]:
+        """New and modified files, in input order"""
+        return sorted([*self.new, *self.modified])
+
+
+def file_sha256(path: Path) -> str:
+    """Hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def schema_sha256(config: Any) -> str:
+    """Hash a (yaml) configuration independently of key order"""
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class IngestManifest:
+    """Persistent map of ingested files to the content, schema and model they were built with"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, ManifestEntry] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file)
+            logger.debug("Loaded manifest with %d entries", len(self.entries))
+
+    def diff(
+        self,
+        files: Sequence[Path],
+        schema_hash: str,
+        model: str,
+        entry_key: Callable[[Path], str] = str,
+    ) -> ManifestDiff:
+        """
+        Compare the files on disk with the manifest, whose entries are keyed
+        by `entry_key` of a file, by default its path. Content hashes are
+        keyed by the path.
+        """
+        result = ManifestDiff()
+        seen = set()
+        for path in files:
+            key = entry_key(path)
+            seen.add(key)
+            content_hash = file_sha256(path)
+            result.content_hashes[str(path)] = content_hash
+            entry = self.entries.get(key)
+            if entry is None:
+                result.new.append(path)
+            elif (
+                entry["content_hash"] != content_hash
+                or entry["schema_hash"] != schema_hash
+                or entry["model"] != model
+            ):
+                result.modified.append(path)
+            else:
+                result.unchanged.append(path)
+        result.removed = sorted(key for key in self.entries if key not in seen)
+        return result
+
+    def record(
+        self, path: Path, content_hash: str, schema_hash: str, model: str
+    ) -> None:
+        """Mark a file as ingested"""
+        self.entries[str(path)] = ManifestEntry(
+            content_hash=content_hash,
+            schema_hash=schema_hash,
+            model=model,
+            ingested_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        )
+
+    def forget(self, key: str) -> None:
+        """Drop a file from the manifest"""
+        self.entries.pop(key, None)
+
+    def save(self) -> None:
+        """Write the manifest atomically"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.entries, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,383 @@
+"""
+Run report of the input pipeline: stage timings, token usage and write counts
+"""
+import json
+import logging
+import os
+import statistics
+import time
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from llama_index.core.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.core.callbacks.schema import CBEventType
+
+from bulk_writer import BulkWriteStats
+from chunking import get_encoder
+from entity_resolution import ResolutionStats
+from pipeline import PipelineStats
+
+logger = logging.getLogger("input_pipeline.metrics")
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    """p50, p90 and p99 of a sample"""
+    if not values:
+        return {}
+    if len(values) == 1:
+        return {"p50": values[0], "p90": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p90": cuts[89], "p99": cuts[98]}
+
+
+class TokenCounter(TokenCountingHandler):
+    """
+    Token counting callback handler keeping running totals only, the stock
+    handler keeps every prompt and chunk text of a run in memory
+    """
+
+    def __init__(
+        self, model: str, tokenizer: Optional[Callable[[str], List]] = None
+    ) -> None:
+        # only used when a response does not report its token usage
+        if tokenizer is None:
+            tokenizer = get_encoder(model).encode
+        super().__init__(tokenizer=tokenizer)
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        super().on_event_end(event_type, payload, event_id, **kwargs)
+        self.llm_calls += len(self.llm_token_counts)
+        self.prompt_tokens += self.prompt_llm_token_count
+        self.completion_tokens += self.completion_llm_token_count
+        self.embedding_tokens += self.total_embedding_token_count
+        self.reset_counts()
+
+    def attach(self, *components: Any) -> None:
+        """Register with the callback managers of LLMs and embedding models"""
+        managers: List[CallbackManager] = []
+        for component in components:
+            manager = component.callback_manager
+            if all(manager is not other for other in managers):
+                managers.append(manager)
+        for manager in managers:
+            manager.add_handler(self)
+
+
+@dataclass
+class RunReport:
+    """Measurements of one ingestion run"""
+
+    started_at: str = field(
+        default_factory=lambda: datetime.now(timezone.utc).isoformat(timespec="seconds")
+    )
+    seconds: float = 0.0
+    files: int = 0
+    documents: int = 0
+    chunks: int = 0
+    entities: int = 0
+    relations: int = 0
+    failed_files: List[str] = field(default_factory=list)
+    # raw durations per stage, summarized in the report
+    stage_seconds: Dict[str, List[float]] = field(default_factory=dict)
+    # per file: parse, parse wait and chunk seconds, chunk count
+    file_stats: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    # distribution of the tokens per chunk
+    chunk_tokens: Dict[str, float] = field(default_factory=dict)
+    llm_calls: int = 0
+    llm_prompt_tokens: int = 0
+    llm_completion_tokens: int = 0
+    embedding_calls: int = 0
+    embedding_texts: int = 0
+    embedding_cache_hits: int = 0
+    embedding_tokens: int = 0
+    # rows written to Neo4j per kind, and transactions or upsert calls
+    neo4j_writes: Dict[str, int] = field(default_factory=dict)
+    # entities and relationships before and after entity resolution
+    entity_resolution: Dict[str, int] = field(default_factory=dict)
+    _start_time: float = field(default_factory=time.perf_counter, repr=False)
+
+    def finish(self) -> None:
+        """Stop the clock"""
+        self.seconds = time.perf_counter() - self._start_time
+
+    def add_tokens(self, counter: TokenCounter) -> None:
+        """Take over the totals of a token counter"""
+        self.llm_calls = counter.llm_calls
+        self.llm_prompt_tokens = counter.prompt_tokens
+        self.llm_completion_tokens = counter.completion_tokens
+        self.embedding_tokens = counter.embedding_tokens
+
+    def add_pipeline_stats(self, stats: PipelineStats) -> None:
+        """Take over the counters and timings of a pipeline run"""
+        self.files = stats.files
+        self.documents = stats.documents
+        self.chunks = stats.chunks
+        self.entities = stats.entities
+        self.relations = stats.relations
+        self.embedding_calls = stats.embedding_calls
+        self.embedding_texts = stats.embedding_texts
+        self.embedding_cache_hits = stats.embedding_cache_hits
+        self.neo4j_writes.update(stats.writes)
+        for stage, values in stats.stage_seconds.items():
+            self.stage_seconds.setdefault(stage, []).extend(values)
+        for path, file_stats in stats.file_stats.items():
+            self.file_stats.setdefault(path, {}).update(file_stats)
+
+    def add_parse_durations(
+        self,
+        durations: Dict[Path, float],
+        wait_durations: Optional[Dict[Path, float]] = None,
+    ) -> None:
+        """Take over the parse time per file, and the time it waited for a worker"""
+        self.stage_seconds.setdefault("parse", []).extend(durations.values())
+        for path, seconds in durations.items():
+            self.file_stats.setdefault(str(path), {})["parse_seconds"] = seconds
+        if wait_durations is None:
+            return
+        self.stage_seconds.setdefault("parse_wait", []).extend(wait_durations.values())
+        for path, seconds in wait_durations.items():
+            self.file_stats.setdefault(str(path), {})["parse_wait_seconds"] = seconds
+
+    def add_chunk_sizes(self, token_counts: Sequence[int]) -> None:
+        """Summarize the tokens per chunk"""
+        if not token_counts:
+            return
+        self.chunk_tokens = {
+            "count": len(token_counts),
+            "min": min(token_counts),
+            "mean": sum(token_counts) / len(token_counts),
+            "max": max(token_counts),
+            **percentiles(sorted(token_counts)),
+        }
+
+    def add_bulk_write_stats(self, stats: BulkWriteStats) -> None:
+        """Take over the row and transaction counts of the bulk writer"""
+        self.neo4j_writes.update(stats.rows)
+        self.neo4j_writes["transactions"] = stats.transactions
+
+    def add_resolution_stats(self, stats: ResolutionStats) -> None:
+        """Take over the graph size around entity resolution"""
+        self.entity_resolution = {
+            "entities_before": stats.entities_before,
+            "entities_after": stats.entities_after,
+            "relationships_before": stats.relationships_before,
+            "relationships_after": stats.relationships_after,
+            "merged": stats.merged,
+        }
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        """Count, total and percentiles of the durations per stage"""
+        return {
+            stage: {
+                "count": len(values),
+                "sum": sum(values),
+                **percentiles(values),
+            }
+            for stage, values in self.stage_seconds.items()
+            if values
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Report as JSON serializable dictionary"""
+        report = asdict(self)
+        report.pop("_start_time")
+        report["stages"] = self.stages()
+        report.pop("stage_seconds")
+        return report
+
+    def write_json(self, path: str) -> None:
+        """Write the report atomically"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
+        os.replace(tmp_path, path)
+
+    def to_prometheus(self) -> str:
+        """Report in the Prometheus text exposition format"""
+        lines: List[str] = []
+
+        def metric(
+            name: str, kind: str, help_text: str, samples: Dict[str, float]
+        ) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples.items():
+                lines.append(f"{name}{labels} {value}")
+
+        metric(
+            "ingest_run_seconds",
+            "gauge",
+            "Wall-clock time of the run",
+            {"": self.seconds},
+        )
+        metric(
+            "ingest_items",
+            "gauge",
+            "Items ingested by the run",
+            {
+                f'{{kind="{kind}"}}': getattr(self, kind)
+                for kind in ("files", "documents", "chunks", "entities", "relations")
+            },
+        )
+        metric(
+            "ingest_failed_files",
+            "gauge",
+            "Files that could not be parsed",
+            {"": len(self.failed_files)},
+        )
+        stage_samples: Dict[str, float] = {}
+        for stage, summary in self.stages().items():
+            for quantile in ("p50", "p90", "p99"):
+                quantile_label = f"0.{quantile[1:]}"
+                stage_samples[
+                    f'{{stage="{stage}",quantile="{quantile_label}"}}'
+                ] = summary[quantile]
+        metric(
+            "ingest_stage_seconds",
+            "summary",
+            "Duration of a stage per file or batch",
+            stage_samples,
+        )
+        for stage, summary in self.stages().items():
+            lines.append(
+                f'ingest_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]}'
+            )
+            lines.append(
+                f'ingest_stage_seconds_count{{stage="{stage}"}} {summary["count"]}'
+            )
+        if self.chunk_tokens:
+            metric(
+                "ingest_chunk_tokens",
+                "summary",
+                "Tokens per chunk",
+                {
+                    f'{{quantile="0.{quantile[1:]}"}}': self.chunk_tokens[quantile]
+                    for quantile in ("p50", "p90", "p99")
+                },
+            )
+            lines.append(
+                f"ingest_chunk_tokens_sum "
+                f'{self.chunk_tokens["mean"] * self.chunk_tokens["count"]}'
+            )
+            lines.append(f'ingest_chunk_tokens_count {self.chunk_tokens["count"]}')
+        metric(
+            "ingest_llm_tokens",
+            "gauge",
+            "LLM tokens used by the run",
+            {
+                '{kind="prompt"}': self.llm_prompt_tokens,
+                '{kind="completion"}': self.llm_completion_tokens,
+            },
+        )
+        metric(
+            "ingest_llm_calls",
+            "gauge",
+            "LLM calls of the run",
+            {"": self.llm_calls},
+        )
+        metric(
+            "ingest_embedding_calls",
+            "gauge",
+            "Embedding API calls of the run",
+            {"": self.embedding_calls},
+        )
+        metric(
+            "ingest_embedding_cache_hits",
+            "gauge",
+            "Texts whose embedding was found in the cache",
+            {"": self.embedding_cache_hits},
+        )
+        metric(
+            "ingest_embedding_tokens",
+            "gauge",
+            "Embedding tokens used by the run",
+            {"": self.embedding_tokens},
+        )
+        metric(
+            "ingest_neo4j_writes",
+            "gauge",
+            "Rows written to Neo4j and the transactions or upserts used",
+            {f'{{kind="{kind}"}}': count for kind, count in self.neo4j_writes.items()},
+        )
+        if self.entity_resolution:
+            metric(
+                "ingest_entity_resolution",
+                "gauge",
+                "Graph size before and after entity resolution, duplicates merged",
+                {
+                    f'{{kind="{kind}"}}': count
+                    for kind, count in self.entity_resolution.items()
+                },
+            )
+        return "\n".join(lines) + "\n"
+
+    def push(self, url: str, job: str, timeout: float = 10.0) -> None:
+        """Push the report to a Prometheus pushgateway"""
+        request = urllib.request.Request(
+            f"{url.rstrip('/')}/metrics/job/{job}",
+            data=self.to_prometheus().encode("utf-8"),
+            method="PUT",
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+    def log(self) -> None:
+        """Log a summary of the report"""
+        logger.info(
+            "Run took %.1fs: %d files, %d chunks, %d LLM calls with %d prompt and "
+            "%d completion tokens, %d embedding calls with %d tokens, "
+            "%d embeddings from the cache",
+            self.seconds,
+            self.files,
+            self.chunks,
+            self.llm_calls,
+            self.llm_prompt_tokens,
+            self.llm_completion_tokens,
+            self.embedding_calls,
+            self.embedding_tokens,
+            self.embedding_cache_hits,
+        )
+        if self.chunk_tokens:
+            logger.info(
+                "Chunks of %d to %d tokens, mean %.0f, p50 %.0f, p90 %.0f, p99 %.0f",
+                self.chunk_tokens["min"],
+                self.chunk_tokens["max"],
+                self.chunk_tokens["mean"],
+                self.chunk_tokens["p50"],
+                self.chunk_tokens["p90"],
+                self.chunk_tokens["p99"],
+            )
+        if self.entity_resolution:
+            logger.info(
+                "Entity resolution merged %d duplicates: entities %d -> %d, "
+                "relationships %d -> %d",
+                self.entity_resolution["merged"],
+                self.entity_resolution["entities_before"],
+                self.entity_resolution["entities_after"],
+                self.entity_resolution["relationships_before"],
+                self.entity_resolution["relationships_after"],
+            )
+        for stage, summary in self.stages().items():
+            logger.info(
+                "Stage %-10s %5d x, %8.1fs total, p50 %.2fs, p90 %.2fs, p99 %.2fs",
+                stage,
+                summary["count"],
+                summary["sum"],
+                summary["p50"],
+                summary["p90"],
+                summary["p99"],
+            )
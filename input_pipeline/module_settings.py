@@ -1,6 +1,7 @@
 """ module settings """
 
 import logging
+from typing import Literal, Optional
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -21,13 +22,78 @@ class ModelSettings(BaseSettings):
     azure_openai_embedding_model: str
     azure_openai_endpoint: str
     azure_openai_model: str = "gpt-4-turbo"
+    # batched UNWIND writes instead of the graph store upserts
+    bulk_write: bool = False
+    bulk_write_batch_size: int = 1000  # rows per transaction
+    # chunks and extraction results of the current run, for --resume
+    checkpoint_path: str = "ingest_checkpoint.sqlite"
+    # tokens per chunk of PDF pages, and shared by consecutive chunks
+    chunk_overlap: int = 128
+    chunk_size: int = 1024
+    # texts per embedding request and requests in flight
+    embedding_batch_size: int = 64
+    # vectors by text and embedding model across runs
+    embedding_cache: bool = True
+    embedding_cache_path: str = "embedding_cache"
+    # float16 or int8 with a scale per vector take 1/2 or about 1/4 of the
+    # float32 cache; cached vectors are written to Neo4j as read back, so
+    # the service rescores with these lossy vectors
+    embedding_cache_precision: Literal["float32", "float16", "int8"] = "float32"
+    embedding_concurrency: int = 4
+    embedding_dimension: int = 1536  # of the vector indexes
+    # merge near-duplicate entities of a label after every run
+    entity_resolution: bool = False
+    entity_resolution_max_block: int = 100  # entities compared with each other
+    entity_resolution_name_similarity: float = 0.5  # shared name trigrams
+    entity_resolution_similarity: float = 0.9  # cosine of the embeddings
+    # extraction results by chunk, schema, model and prompt across runs
+    extraction_cache: bool = True
+    extraction_cache_max_mb: int = 512
+    extraction_cache_path: str = "extraction_cache.sqlite"
+    # advertise only the entity types suggested by the keywords in
+    # entity_relations.yaml and skip boilerplate chunks
+    extraction_classify: bool = True
+    # concurrent extraction requests, adapted to 429s and latency; at most
+    # PIPELINE_BATCH_SIZE run at the same time
+    extraction_max_concurrency: int = 16
+    extraction_max_retries: int = 5  # per chunk, on 429
+    extraction_min_concurrency: int = 1
+    extraction_requests_per_minute: int = 0  # 0 for no limit
+    # drop extracted triples the validation schema does not allow
+    extraction_strict: bool = False
+    extraction_target_latency: float = 30.0  # seconds
+    extraction_tokens_per_minute: int = 0  # 0 for no limit
+    # build the graph from "pdf" files or the "markdown" files converted from them
+    ingest_source: Literal["markdown", "pdf"] = "pdf"
     llama_cloud_api_key: SecretStr
     logging_level: str = "INFO"
+    manifest_path: str = "ingest_manifest.json"
     markdown_path: str
+    metrics_job: str = "input_pipeline"
+    # Prometheus pushgateway for the run report, e.g. http://localhost:9091
+    metrics_pushgateway_url: Optional[str] = None
+    metrics_report_path: str = "ingest_report.json"
+    neo4j_database: str = "neo4j"  # database of the graph store and the writers
+    neo4j_index_timeout: int = 300  # seconds to wait for indexes to come online
+    # quantized vector indexes (Neo4j 5.23+), the stored embeddings keep the
+    # precision they were written in
+    neo4j_vector_quantization: bool = True
     neo4j_password: SecretStr
     neo4j_uri: str
     neo4j_username: str
+    # concurrent parsing stage
+    parse_backoff: float = 2.0  # seconds, doubled on every retry
+    parse_max_in_flight: int = 8  # files submitted ahead of the one being emitted
+    parse_retries: int = 3
+    parse_timeout: float = 900.0  # seconds per attempt
+    parse_workers: int = 4
     pdf_path: str
+    # streaming pipeline
+    pipeline_batch_size: int = 32  # chunks per extraction and write batch
+    pipeline_queue_size: int = 4  # batches buffered between two stages
+    # new and modified documents are written through the bulk writer together
+    # with the removal of their previous version, in one transaction each
+    replace_documents: bool = True
 
 
 settings = ModelSettings()  # type: ignore [call-arg]
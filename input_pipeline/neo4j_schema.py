@@ -0,0 +1,218 @@
+"""
+Idempotent bootstrap of the Neo4j constraints and indexes the graph relies on
+
+The pipeline owns the schema, the service only checks the indexes it queries
+(service/app/engine/neo4j_schema.py) and never drops or creates them.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import neo4j
+
+logger = logging.getLogger("input_pipeline.neo4j_schema")
+
+# uniqueness constraints back the MERGEs on ids with range indexes
+CONSTRAINTS = [
+    "CREATE CONSTRAINT node_id IF NOT EXISTS "
+    "FOR (n:__Node__) REQUIRE n.id IS UNIQUE",
+    "CREATE CONSTRAINT entity_id IF NOT EXISTS "
+    "FOR (n:__Entity__) REQUIRE n.id IS UNIQUE",
+    "CREATE CONSTRAINT chunk_id IF NOT EXISTS FOR (n:Chunk) REQUIRE n.id IS UNIQUE",
+]
+
+INDEXES = [
+    # exact lookups of entities by name, e.g. WHERE e.name IN $names
+    "CREATE INDEX entity_name IF NOT EXISTS FOR (n:__Entity__) ON (n.name)",
+    # CONTAINS, STARTS WITH and ENDS WITH on entity names
+    "CREATE TEXT INDEX entity_name_text IF NOT EXISTS FOR (n:__Entity__) ON (n.name)",
+    # removal of the chunks of a document written without its id
+    "CREATE INDEX chunk_file_path IF NOT EXISTS FOR (n:Chunk) ON (n.file_path)",
+    # replacement of a document by its id
+    "CREATE INDEX chunk_doc_id IF NOT EXISTS FOR (n:Chunk) ON (n.doc_id)",
+]
+
+# the name of the entity index is the one Neo4jPropertyGraphStore queries
+VECTOR_INDEXES = {"entity": "__Entity__", "chunk": "Chunk"}
+
+CREATE_VECTOR_INDEX = """
+CREATE VECTOR INDEX `{name}` IF NOT EXISTS FOR (n:`{label}`) ON (n.embedding)
+OPTIONS {{indexConfig: {{
+    `vector.dimensions`: {dimension},
+    `vector.similarity_function`: 'cosine'{quantization}
+}}}}
+"""
+
+# int8 copies of the vectors in the index, the node properties stay float32
+QUANTIZATION_OPTION = ",\n    `vector.quantization.enabled`: {enabled}"
+
+DROP_INDEX = "DROP INDEX `{name}` IF EXISTS"
+
+SHOW_INDEXES = """
+SHOW INDEXES
+YIELD name, type, labelsOrTypes, properties, state, populationPercent, options
+RETURN name, type, labelsOrTypes, properties, state, populationPercent, options
+ORDER BY name
+"""
+
+
+@dataclass
+class IndexState:
+    """State of an index as reported by SHOW INDEXES"""
+
+    name: str
+    type: str
+    labels: List[str]
+    properties: List[str]
+    state: str
+    population: float
+    options: Dict[str, Any]
+
+    @property
+    def online(self) -> bool:
+        """Whether the index is ready to be used"""
+        return self.state == "ONLINE"
+
+    @property
+    def dimension(self) -> Optional[int]:
+        """Dimension of a vector index"""
+        config = (self.options or {}).get("indexConfig") or {}
+        return config.get("vector.dimensions")
+
+    @property
+    def quantized(self) -> Optional[bool]:
+        """Whether a vector index holds quantized vectors"""
+        config = (self.options or {}).get("indexConfig") or {}
+        return config.get("vector.quantization.enabled")
+
+
+def index_states(
+    driver: neo4j.Driver, database: Optional[str] = None
+) -> List[IndexState]:
+    """Indexes of the database and their state"""
+    records, _, _ = driver.execute_query(SHOW_INDEXES, database_=database)
+    return [
+        IndexState(
+            name=record["name"],
+            type=record["type"],
+            labels=record["labelsOrTypes"] or [],
+            properties=record["properties"] or [],
+            state=record["state"],
+            population=record["populationPercent"],
+            options=record["options"] or {},
+        )
+        for record in records
+    ]
+
+
+def vector_option_changes(
+    state: IndexState, embedding_dimension: int, quantization: Optional[bool]
+) -> List[str]:
+    """Options of a vector index differing from the configured ones"""
+    changes = []
+    if state.dimension != embedding_dimension:
+        changes.append(f"dimension {state.dimension} -> {embedding_dimension}")
+    if (
+        quantization is not None
+        and state.quantized is not None
+        and state.quantized != quantization
+    ):
+        changes.append(f"quantization {state.quantized} -> {quantization}")
+    return changes
+
+
+def bootstrap_schema(
+    driver: neo4j.Driver,
+    database: Optional[str] = None,
+    embedding_dimension: int = 1536,
+    timeout: int = 300,
+    quantization: Optional[bool] = None,
+) -> List[IndexState]:
+    """
+    Create the constraints and range, text and vector indexes if they do not
+    exist, wait up to `timeout` seconds for them to come online and log
+    their state. Indexes that exist are left as they are, except vector
+    indexes with another dimension or quantization: Neo4jPropertyGraphStore
+    creates the entity index without options when it is constructed, so
+    these are dropped and created again with the configured ones.
+
+    `quantization` turns the quantization of new vector indexes on or off,
+    None keeps the default of the server.
+    """
+    for statement in CONSTRAINTS + INDEXES:
+        driver.execute_query(statement, database_=database)
+    options = [""]
+    if quantization is not None:
+        # servers before 5.23 reject the option, retry without it
+        options.insert(0, QUANTIZATION_OPTION.format(enabled=str(quantization).lower()))
+    existing = {
+        state.name: state
+        for state in index_states(driver, database)
+        if state.type == "VECTOR"
+    }
+    for name, label in VECTOR_INDEXES.items():
+        if name in existing:
+            changes = vector_option_changes(
+                existing[name], embedding_dimension, quantization
+            )
+            if not changes:
+                logger.info("Vector index %s has the configured options", name)
+                continue
+            logger.warning("Recreating vector index %s: %s", name, ", ".join(changes))
+            driver.execute_query(DROP_INDEX.format(name=name), database_=database)
+        for option in options:
+            try:
+                driver.execute_query(
+                    CREATE_VECTOR_INDEX.format(
+                        name=name,
+                        label=label,
+                        dimension=int(embedding_dimension),
+                        quantization=option,
+                    ),
+                    database_=database,
+                )
+                break
+            except neo4j.exceptions.ClientError as e:
+                if option:
+                    continue
+                # vector indexes need Neo4j 5.11 or later
+                logger.warning("Could not create vector index %s: %s", name, e.message)
+
+    try:
+        driver.execute_query(
+            "CALL db.awaitIndexes($timeout)", timeout=timeout, database_=database
+        )
+    except neo4j.exceptions.ClientError as e:
+        logger.warning("Indexes not online after %ds: %s", timeout, e.message)
+
+    states = index_states(driver, database)
+    for state in states:
+        logger.info(
+            "Index %s: %s on %s(%s), %s %.0f%%",
+            state.name,
+            state.type,
+            ":".join(state.labels),
+            ", ".join(state.properties),
+            state.state,
+            state.population,
+        )
+        if not state.online:
+            logger.warning("Index %s is %s", state.name, state.state)
+        if state.dimension is not None and state.dimension != embedding_dimension:
+            logger.warning(
+                "Vector index %s has %d dimensions, embeddings have %d",
+                state.name,
+                state.dimension,
+                embedding_dimension,
+            )
+        if (
+            quantization is not None
+            and state.quantized is not None
+            and state.quantized != quantization
+        ):
+            logger.warning(
+                "Vector index %s has quantization %s, the server did not change it",
+                state.name,
+                "enabled" if state.quantized else "disabled",
+            )
+    return states
@@ -0,0 +1,174 @@
+"""
+Concurrent, bounded document parsing stage
+"""
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from collections import deque
+from pathlib import Path
+from typing import AsyncIterator, Deque, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core import SimpleDirectoryReader, schema
+from llama_index.core.readers.base import BaseReader
+from llama_index.core.readers.file.base import default_file_metadata_func
+
+logger = logging.getLogger("input_pipeline.parsing")
+
+ParsedFile = Tuple[Path, List[schema.Document]]
+
+# same keys SimpleDirectoryReader hides from embeddings and LLM prompts
+EXCLUDED_METADATA_KEYS = [
+    "file_name",
+    "file_type",
+    "file_size",
+    "creation_date",
+    "last_modified_date",
+    "last_accessed_date",
+]
+
+
+class MarkdownFileReader(BaseReader):
+    """Read a Markdown file into a single document, headings left for the node parser"""
+
+    def load_data(
+        self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[schema.Document]:
+        text = Path(file).read_text(encoding="utf-8")
+        return [schema.Document(text=text, extra_info=extra_info or {})]
+
+    async def aload_data(
+        self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[schema.Document]:
+        return await asyncio.to_thread(self.load_data, file, extra_info)
+
+
+def list_files(directory: str, required_exts: Sequence[str]) -> List[Path]:
+    """List the files of a directory (non recursive) with one of the given extensions"""
+    exts = {ext.lower() for ext in required_exts}
+    return sorted(
+        path
+        for path in Path(directory).iterdir()
+        if path.is_file()
+        and not path.name.startswith(".")
+        and path.suffix.lower() in exts
+    )
+
+
+class ParsingStage:
+    """
+    Parse files concurrently through the async API of their readers.
+
+    `workers` bounds the number of parser calls running at the same time,
+    `max_in_flight` bounds how many files may be submitted ahead of the one
+    currently being emitted. Files are emitted in input order, every file is
+    retried with exponential backoff and skipped once all attempts failed.
+    """
+
+    def __init__(
+        self,
+        file_extractor: Dict[str, BaseReader],
+        workers: int = 4,
+        max_in_flight: int = 8,
+        retries: int = 3,
+        backoff: float = 2.0,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.file_extractor = file_extractor
+        self.workers = max(1, workers)
+        self.max_in_flight = max(self.workers, max_in_flight)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.failed: List[Path] = []
+        # seconds the parser spent on a file over all attempts, and seconds
+        # the file waited for a worker
+        self.durations: Dict[Path, float] = {}
+        self.wait_durations: Dict[Path, float] = {}
+
+    async def parse_file(
+        self, path: Path, semaphore: Optional[asyncio.Semaphore] = None
+    ) -> List[schema.Document]:
+        """Parse a single file, retrying with exponential backoff"""
+        attempt = 0
+        self.durations[path] = self.wait_durations[path] = 0.0
+        while True:
+            wait_start = time.perf_counter()
+            try:
+                # only hold a worker slot while the parser is busy, not while backing off
+                async with semaphore or contextlib.nullcontext():
+                    start_time = time.perf_counter()
+                    self.wait_durations[path] += start_time - wait_start
+                    try:
+                        documents = await asyncio.wait_for(
+                            SimpleDirectoryReader.aload_file(
+                                path,
+                                file_metadata=default_file_metadata_func,
+                                file_extractor=self.file_extractor,
+                                raise_on_error=True,
+                            ),
+                            timeout=self.timeout,
+                        )
+                    finally:
+                        self.durations[path] += time.perf_counter() - start_time
+                break
+            except ImportError:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                delay += random.uniform(0, self.backoff)
+                logger.warning(
+                    "Parsing %s failed (attempt %d/%d): %s - retrying in %.1fs",
+                    path.name,
+                    attempt,
+                    self.retries + 1,
+                    str(e) or type(e).__name__,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+
+        for doc in documents:
+            doc.excluded_embed_metadata_keys.extend(EXCLUDED_METADATA_KEYS)
+            doc.excluded_llm_metadata_keys.extend(EXCLUDED_METADATA_KEYS)
+        return documents
+
+    async def _parse_bounded(
+        self, path: Path, semaphore: asyncio.Semaphore
+    ) -> List[schema.Document]:
+        try:
+            documents = await self.parse_file(path, semaphore)
+        except Exception:
+            logger.exception("Giving up on %s", path.name)
+            self.failed.append(path)
+            return []
+        logger.debug("Parsed %s into %d documents", path.name, len(documents))
+        return documents
+
+    async def aiter_parse(self, files: Sequence[Path]) -> AsyncIterator[ParsedFile]:
+        """Parse files concurrently and yield their documents in input order"""
+        semaphore = asyncio.Semaphore(self.workers)
+        pending: Deque[Tuple[Path, asyncio.Task]] = deque()
+        try:
+            for path in files:
+                task = asyncio.create_task(self._parse_bounded(path, semaphore))
+                pending.append((path, task))
+                if len(pending) >= self.max_in_flight:
+                    done_path, done_task = pending.popleft()
+                    yield done_path, await done_task
+            while pending:
+                done_path, done_task = pending.popleft()
+                yield done_path, await done_task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def aparse(self, files: Sequence[Path]) -> List[schema.Document]:
+        """Parse files concurrently and return all documents in input order"""
+        documents: List[schema.Document] = []
+        async for _, file_documents in self.aiter_parse(files):
+            documents.extend(file_documents)
+        return documents
@@ -0,0 +1,464 @@
+"""
+Streaming parse -> chunk -> extract -> upsert pipeline
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.graph_stores.types import (
+    KG_NODES_KEY,
+    KG_RELATIONS_KEY,
+    TRIPLET_SOURCE_KEY,
+    LabelledNode,
+    PropertyGraphStore,
+    Relation,
+)
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+from bulk_writer import TAG_ENTITY_DOCUMENTS, Neo4jBulkWriter
+from checkpoint import CheckpointStore, ChunkStatus
+from embedding import EmbeddingStage
+from extraction_cache import ExtractionCache
+from parsing import ParsedFile
+from provenance import (
+    DOC_ID_KEY,
+    DOC_IDS_KEY,
+    DOC_VERSION_KEY,
+    document_id,
+    tag_chunks,
+)
+from scheduler import ExtractionScheduler
+
+logger = logging.getLogger("input_pipeline.pipeline")
+
+
+@dataclass
+class ChunkBatch:
+    """Chunks travelling through the pipeline and the files they complete"""
+
+    nodes: List[BaseNode] = field(default_factory=list)
+    files: List[Path] = field(default_factory=list)
+
+
+@dataclass
+class DocumentElements:
+    """Graph elements of a document waiting for its replacement"""
+
+    nodes: List[BaseNode] = field(default_factory=list)
+    kg_nodes: List[LabelledNode] = field(default_factory=list)
+    relations: List[Relation] = field(default_factory=list)
+    node_ids: List[str] = field(default_factory=list)
+
+
+@dataclass
+class PipelineStats:
+    """Counters of a pipeline run"""
+
+    files: int = 0
+    documents: int = 0
+    chunks: int = 0
+    entities: int = 0
+    relations: int = 0
+    # seconds per file (chunk) or per batch (extract, embed, write)
+    stage_seconds: Dict[str, List[float]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    # chunk seconds and chunk count per file
+    file_stats: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    embedding_calls: int = 0
+    embedding_texts: int = 0
+    embedding_cache_hits: int = 0
+    # previous versions of replaced documents
+    stale_chunks: int = 0
+    orphaned_entities: int = 0
+    # files without documents, e.g. failed to parse, whose previous version
+    # was kept
+    kept_files: int = 0
+    # rows handed to the graph store per kind, and its upsert calls
+    writes: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+
+class IngestionPipeline:
+    """
+    Build the knowledge graph while documents are still being parsed.
+
+    The stages run concurrently and are connected by bounded queues, so at
+    most `queue_size` batches of `batch_size` chunks wait between two stages
+    and memory stays flat regardless of the corpus size.
+
+    With a `bulk_writer` the graph elements are handed to it instead of the
+    upsert methods of the graph store; files are only reported as written
+    once the writer has flushed their rows.
+
+    With a `checkpoint` store chunks, extraction results and write status are
+    recorded, and chunks found there are neither extracted nor written again.
+    With an `extraction_cache` only chunks it does not know are sent to the
+    extractor.
+
+    Chunks and entities are embedded by the `embedding_stage`, by default one
+    without a cache batching by the embedding model's batch size.
+
+    With `document_versions`, the content hash of every file, chunks are
+    tagged with the id and version of their document, extracted relations
+    with the document and entities with all documents mentioning them. With
+    `replace_documents` as well, the elements of a document are held until
+    the document is complete and then written by the bulk writer together
+    with the removal of the previous version, in one transaction. Files
+    without documents, e.g. those that failed to parse, keep their previous
+    version and are not reported as written.
+
+    `document_paths` maps files that are a version of a document at another
+    path, e.g. the Markdown conversion of a PDF, to that path, which
+    identifies their document.
+    """
+
+    def __init__(
+        self,
+        kg_extractor: Union[TransformComponent, ExtractionScheduler],
+        graph_store: PropertyGraphStore,
+        embed_model: BaseEmbedding,
+        transformations: Optional[List[TransformComponent]] = None,
+        batch_size: int = 32,
+        queue_size: int = 4,
+        on_file_written: Optional[Callable[[Path], None]] = None,
+        bulk_writer: Optional[Neo4jBulkWriter] = None,
+        checkpoint: Optional[CheckpointStore] = None,
+        extraction_cache: Optional[ExtractionCache] = None,
+        embedding_stage: Optional[EmbeddingStage] = None,
+        document_versions: Optional[Mapping[str, str]] = None,
+        replace_documents: bool = False,
+        show_progress: bool = False,
+        document_paths: Optional[Mapping[str, str]] = None,
+    ) -> None:
+        if replace_documents and (bulk_writer is None or document_versions is None):
+            raise ValueError(
+                "Replacing documents needs a bulk writer and document versions"
+            )
+        self.kg_extractor = kg_extractor
+        self.graph_store = graph_store
+        self.embed_model = embed_model
+        self.transformations = transformations or Settings.transformations
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(1, queue_size)
+        self.on_file_written = on_file_written
+        self.bulk_writer = bulk_writer
+        self.checkpoint = checkpoint
+        self.extraction_cache = extraction_cache
+        self.embedding_stage = embedding_stage or EmbeddingStage(embed_model)
+        self.document_versions = document_versions
+        self.document_paths = document_paths or {}
+        self.replace_documents = replace_documents
+        self.show_progress = show_progress
+        self.stats = PipelineStats()
+        # node ids and files of batches the bulk writer has not flushed yet
+        self._unflushed: List[Tuple[List[str], List[Path]]] = []
+        # elements of the documents being replaced, by document id
+        self._documents: Dict[str, DocumentElements] = defaultdict(DocumentElements)
+        # files whose previous version must not be replaced
+        self._empty_files: Set[Path] = set()
+
+    async def arun(self, parsed_files: AsyncIterator[ParsedFile]) -> PipelineStats:
+        """Run all stages until the parsed files are exhausted"""
+        chunk_queue: asyncio.Queue[Optional[ChunkBatch]]
+        chunk_queue = asyncio.Queue(self.queue_size)
+        write_queue: asyncio.Queue[Optional[ChunkBatch]]
+        write_queue = asyncio.Queue(self.queue_size)
+
+        async with asyncio.TaskGroup() as group:
+            group.create_task(self._chunk_stage(parsed_files, chunk_queue))
+            group.create_task(self._extract_stage(chunk_queue, write_queue))
+            group.create_task(self._write_stage(write_queue))
+
+        if self.bulk_writer is not None:
+            start_time = time.perf_counter()
+            await asyncio.to_thread(self.bulk_writer.flush)
+            self.stats.stage_seconds["write"].append(time.perf_counter() - start_time)
+            self._batches_written()
+        if self.graph_store.supports_structured_queries:
+            await asyncio.to_thread(self.graph_store.get_schema, refresh=True)
+        return self.stats
+
+    async def _chunk_stage(
+        self,
+        parsed_files: AsyncIterator[ParsedFile],
+        out_queue: "asyncio.Queue[Optional[ChunkBatch]]",
+    ) -> None:
+        batch = ChunkBatch()
+        async for path, documents in parsed_files:
+            self.stats.files += 1
+            self.stats.documents += len(documents)
+            start_time = time.perf_counter()
+            nodes = await self._chunk(path, documents)
+            if not documents and not nodes:
+                self._empty_files.add(path)
+            if self.document_versions is not None:
+                tag_chunks(
+                    nodes,
+                    document_id(self._document_path(path)),
+                    self.document_versions.get(str(path), ""),
+                )
+            seconds = time.perf_counter() - start_time
+            self.stats.stage_seconds["chunk"].append(seconds)
+            self.stats.file_stats[str(path)] = {
+                "chunk_seconds": seconds,
+                "chunks": len(nodes),
+            }
+            for node in nodes:
+                batch.nodes.append(node)
+                if len(batch.nodes) >= self.batch_size:
+                    await out_queue.put(batch)
+                    batch = ChunkBatch()
+            batch.files.append(path)
+        if batch.nodes or batch.files:
+            await out_queue.put(batch)
+        await out_queue.put(None)
+
+    async def _chunk(
+        self, path: Path, documents: Sequence[BaseNode]
+    ) -> Sequence[BaseNode]:
+        if self.checkpoint is not None:
+            chunks = self.checkpoint.load_chunks(path)
+            if chunks:
+                logger.debug("Resuming %s from its checkpointed chunks", path.name)
+                return [node for node, status in chunks if status < ChunkStatus.WRITTEN]
+        if not documents:
+            return []
+        nodes = await asyncio.to_thread(
+            run_transformations, documents, self.transformations
+        )
+        if self.checkpoint is not None:
+            self.checkpoint.save_chunks(path, nodes)
+        return nodes
+
+    async def _extract_stage(
+        self,
+        in_queue: "asyncio.Queue[Optional[ChunkBatch]]",
+        out_queue: "asyncio.Queue[Optional[ChunkBatch]]",
+    ) -> None:
+        while (batch := await in_queue.get()) is not None:
+            # chunks resumed from a checkpoint already carry their extraction
+            pending = [
+                node
+                for node in batch.nodes
+                if KG_NODES_KEY not in node.metadata
+                and KG_RELATIONS_KEY not in node.metadata
+            ]
+            if pending:
+                start_time = time.perf_counter()
+                extracted = await self._extract(pending)
+                self.stats.stage_seconds["extract"].append(
+                    time.perf_counter() - start_time
+                )
+                if self.checkpoint is not None:
+                    self.checkpoint.save_extractions(extracted)
+                by_id = {node.id_: node for node in extracted}
+                batch.nodes = [by_id.get(node.id_, node) for node in batch.nodes]
+            await out_queue.put(batch)
+        await out_queue.put(None)
+
+    async def _extract(self, nodes: List[BaseNode]) -> List[BaseNode]:
+        if self.extraction_cache is None:
+            return list(
+                await self.kg_extractor.acall(nodes, show_progress=self.show_progress)
+            )
+        hits, misses = self.extraction_cache.lookup(nodes)
+        if not misses:
+            return hits
+        extracted = await self.kg_extractor.acall(
+            misses, show_progress=self.show_progress
+        )
+        self.extraction_cache.store(extracted)
+        return hits + list(extracted)
+
+    async def _write_stage(
+        self, in_queue: "asyncio.Queue[Optional[ChunkBatch]]"
+    ) -> None:
+        while (batch := await in_queue.get()) is not None:
+            node_ids = [node.id_ for node in batch.nodes]
+            if batch.nodes:
+                await self.write_nodes(batch.nodes)
+            if self.replace_documents:
+                for node in batch.nodes:
+                    self._documents[node.metadata[DOC_ID_KEY]].node_ids.append(node.id_)
+                for path in batch.files:
+                    if path in self._empty_files:
+                        # a failed parse must not delete the last good version
+                        logger.warning(
+                            "No documents for %s, keeping its previous version",
+                            path.name,
+                        )
+                        self.stats.kept_files += 1
+                        continue
+                    await self._replace_document(path)
+                continue
+            self._unflushed.append((node_ids, batch.files))
+            if self.bulk_writer is None or self.bulk_writer.pending == 0:
+                self._batches_written()
+
+    def _batches_written(self) -> None:
+        for node_ids, files in self._unflushed:
+            if self.checkpoint is not None and node_ids:
+                self.checkpoint.mark_written(node_ids)
+            for path in files:
+                logger.debug("Finished %s", path.name)
+                if self.on_file_written is not None:
+                    self.on_file_written(path)
+        self._unflushed = []
+
+    def _document_path(self, path: Path) -> str:
+        return self.document_paths.get(str(path), str(path))
+
+    async def _replace_document(self, path: Path) -> None:
+        assert self.bulk_writer is not None and self.document_versions is not None
+        document_path = self._document_path(path)
+        doc_id = document_id(document_path)
+        elements = self._documents.pop(doc_id, DocumentElements())
+        start_time = time.perf_counter()
+        result = await asyncio.to_thread(
+            self.bulk_writer.replace_document,
+            doc_id,
+            document_path,
+            self.document_versions[str(path)],
+            elements.nodes,
+            elements.kg_nodes,
+            elements.relations,
+        )
+        self.stats.stage_seconds["write"].append(time.perf_counter() - start_time)
+        self.stats.stale_chunks += result.chunks
+        self.stats.orphaned_entities += result.entities
+        if self.checkpoint is not None and elements.node_ids:
+            self.checkpoint.mark_written(elements.node_ids)
+        logger.debug("Finished %s", path.name)
+        if self.on_file_written is not None:
+            self.on_file_written(path)
+
+    async def write_nodes(self, nodes: List[BaseNode]) -> None:
+        """Embed chunks and extracted entities and upsert them with their relations"""
+        kg_nodes: List[LabelledNode] = []
+        kg_relations: List[Relation] = []
+        for node in nodes:
+            doc_id = node.metadata.get(DOC_ID_KEY)
+            for kg_node in node.metadata.pop(KG_NODES_KEY, []):
+                kg_node.properties[TRIPLET_SOURCE_KEY] = node.id_
+                if doc_id is not None:
+                    # the extractor copied the chunk's document, entities
+                    # belong to every document mentioning them instead
+                    kg_node.properties.pop(DOC_ID_KEY, None)
+                    kg_node.properties.pop(DOC_VERSION_KEY, None)
+                    kg_node.properties[DOC_IDS_KEY] = [doc_id]
+                kg_nodes.append(kg_node)
+            for kg_relation in node.metadata.pop(KG_RELATIONS_KEY, []):
+                kg_relation.properties[TRIPLET_SOURCE_KEY] = node.id_
+                if doc_id is not None:
+                    kg_relation.properties[DOC_ID_KEY] = doc_id
+                    kg_relation.properties[DOC_VERSION_KEY] = node.metadata.get(
+                        DOC_VERSION_KEY
+                    )
+                kg_relations.append(kg_relation)
+
+        # only embed entities the graph store does not know yet, but upsert
+        # every mention so that the MENTIONS relations of new chunks exist
+        unique_kg_nodes = {kg_node.id: kg_node for kg_node in kg_nodes}
+        existing_kg_nodes = await asyncio.to_thread(
+            self.graph_store.get, ids=list(unique_kg_nodes)
+        )
+        existing_kg_node_ids = {kg_node.id for kg_node in existing_kg_nodes}
+        new_kg_nodes = [
+            kg_node
+            for kg_node_id, kg_node in unique_kg_nodes.items()
+            if kg_node_id not in existing_kg_node_ids
+        ]
+        existing_nodes = await asyncio.to_thread(
+            self.graph_store.get_llama_nodes, [node.id_ for node in nodes]
+        )
+        existing_hashes = {node.hash for node in existing_nodes}
+        nodes = [node for node in nodes if node.hash not in existing_hashes]
+
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        texts += [str(kg_node) for kg_node in new_kg_nodes]
+        embedding_stats = self.embedding_stage.stats
+        calls, cache_hits = embedding_stats.calls, embedding_stats.cache_hits
+        start_time = time.perf_counter()
+        embeddings = await self.embedding_stage.aembed(texts)
+        self.stats.stage_seconds["embed"].append(time.perf_counter() - start_time)
+        self.stats.embedding_calls += embedding_stats.calls - calls
+        self.stats.embedding_cache_hits += embedding_stats.cache_hits - cache_hits
+        self.stats.embedding_texts += len(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        for kg_node, embedding in zip(new_kg_nodes, embeddings[len(nodes) :]):
+            kg_node.embedding = embedding
+
+        start_time = time.perf_counter()
+        await asyncio.to_thread(self._upsert, nodes, kg_nodes, kg_relations)
+        self.stats.stage_seconds["write"].append(time.perf_counter() - start_time)
+        self.stats.chunks += len(nodes)
+        self.stats.entities += len(new_kg_nodes)
+        self.stats.relations += len(kg_relations)
+
+    def _upsert(
+        self,
+        nodes: List[BaseNode],
+        kg_nodes: List[LabelledNode],
+        kg_relations: List[Relation],
+    ) -> None:
+        if self.replace_documents:
+            for node in nodes:
+                self._documents[node.metadata[DOC_ID_KEY]].nodes.append(node)
+            for kg_node in kg_nodes:
+                for doc_id in kg_node.properties.get(DOC_IDS_KEY, []):
+                    self._documents[doc_id].kg_nodes.append(kg_node)
+            for kg_relation in kg_relations:
+                self._documents[kg_relation.properties[DOC_ID_KEY]].relations.append(
+                    kg_relation
+                )
+            return
+        if self.bulk_writer is not None:
+            self.bulk_writer.add_chunks(nodes)
+            self.bulk_writer.add_entities(kg_nodes)
+            self.bulk_writer.add_relations(kg_relations)
+            return
+        if nodes:
+            self.graph_store.upsert_llama_nodes(nodes)
+            self.stats.writes["chunks"] += len(nodes)
+            self.stats.writes["upserts"] += 1
+        if kg_nodes:
+            # the upsert replaces properties, documents are added afterwards
+            doc_ids: Dict[str, Set[str]] = defaultdict(set)
+            for kg_node in kg_nodes:
+                doc_ids[kg_node.id].update(kg_node.properties.pop(DOC_IDS_KEY, []))
+            self.graph_store.upsert_nodes(kg_nodes)
+            self.stats.writes["entities"] += len(kg_nodes)
+            self.stats.writes["upserts"] += 1
+            rows = [
+                {"id": kg_node_id, "doc_ids": sorted(ids)}
+                for kg_node_id, ids in doc_ids.items()
+                if ids
+            ]
+            if rows and self.graph_store.supports_structured_queries:
+                self.graph_store.structured_query(
+                    TAG_ENTITY_DOCUMENTS, param_map={"rows": rows}
+                )
+        # important: upsert relations after nodes
+        if kg_relations:
+            self.graph_store.upsert_relations(kg_relations)
+            self.stats.writes["relations"] += len(kg_relations)
+            self.stats.writes["upserts"] += 1
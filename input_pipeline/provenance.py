@@ -0,0 +1,40 @@
+"""
+Provenance of graph elements: the source document and its version
+"""
+import hashlib
+from typing import Sequence
+
+from llama_index.core.schema import BaseNode
+
+# properties of chunks and extracted relations
+DOC_ID_KEY = "doc_id"
+DOC_VERSION_KEY = "doc_version"
+# property of entities, which several documents can mention
+DOC_IDS_KEY = "doc_ids"
+
+PROVENANCE_METADATA_KEYS = [DOC_ID_KEY, DOC_VERSION_KEY]
+
+
+def document_id(file_path: str) -> str:
+    """Stable id of a source document, derived from its path"""
+    return hashlib.sha256(file_path.encode("utf-8")).hexdigest()[:16]
+
+
+def document_version(content_hash: str, schema_hash: str, model: str) -> str:
+    """Version of the graph elements of a document, changing with any input"""
+    digest = hashlib.sha256("\0".join((content_hash, schema_hash, model)).encode())
+    return digest.hexdigest()[:16]
+
+
+def tag_chunks(nodes: Sequence[BaseNode], doc_id: str, doc_version: str) -> None:
+    """Record the document and version of chunks, hidden from embedding and LLM"""
+    for node in nodes:
+        node.metadata[DOC_ID_KEY] = doc_id
+        node.metadata[DOC_VERSION_KEY] = doc_version
+        for excluded in (
+            node.excluded_embed_metadata_keys,
+            node.excluded_llm_metadata_keys,
+        ):
+            excluded.extend(
+                key for key in PROVENANCE_METADATA_KEYS if key not in excluded
+            )
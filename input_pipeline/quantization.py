@@ -0,0 +1,88 @@
+"""
+Quantized embedding storage: float16 or int8 with a scale per vector
+"""
+from typing import Literal, Optional, Tuple, get_args
+
+import numpy as np
+
+Precision = Literal["float32", "float16", "int8"]
+PRECISIONS: Tuple[Precision, ...] = get_args(Precision)
+
+
+def bytes_per_vector(dimension: int, precision: Precision) -> int:
+    """Storage of one vector, with its scale for int8"""
+    if precision == "int8":
+        return dimension + 4
+    return dimension * np.dtype(precision).itemsize
+
+
+def quantize(
+    vectors: np.ndarray, precision: Precision
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Codes of float vectors and, for int8, the scale of every vector: the
+    components are mapped symmetrically onto -127..127 by their largest
+    absolute value
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == "float32":
+        return vectors, None
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    if precision != "int8":
+        raise ValueError(f"Unknown precision {precision}")
+    scales = np.abs(vectors).max(axis=-1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[..., None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """Float32 vectors of codes made by `quantize`"""
+    vectors = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        vectors = vectors * np.asarray(scales, dtype=np.float32)[..., None]
+    return vectors
+
+
+def cosine_top_k(
+    vectors: np.ndarray, queries: np.ndarray, top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices and cosine similarities of the `top_k` nearest vectors per query"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    query_norms = np.linalg.norm(queries, axis=1)
+    query_norms[query_norms == 0] = 1.0
+    scores = (queries @ vectors.T) / query_norms[:, None] / norms[None, :]
+    top_k = min(top_k, vectors.shape[0])
+    indices = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return (
+        np.take_along_axis(indices, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+def rescore(
+    candidates: np.ndarray,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    top_k: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Re-rank candidate indices per query (e.g. from a search over quantized
+    vectors) by their exact cosine similarity to full precision `vectors`
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    indices = np.empty((len(queries), min(top_k, candidates.shape[1])), dtype=np.int64)
+    scores = np.empty(indices.shape, dtype=np.float32)
+    for row, (query, query_candidates) in enumerate(zip(queries, candidates)):
+        local, local_scores = cosine_top_k(
+            vectors[query_candidates], query, indices.shape[1]
+        )
+        indices[row] = query_candidates[local[0]]
+        scores[row] = local_scores[0]
+    return indices, scores
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Recall and memory of float16 and int8 embeddings against float32, with and without exact rescoring
+"""
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from embedding import EmbeddingCache
+from quantization import (
+    PRECISIONS,
+    bytes_per_vector,
+    cosine_top_k,
+    dequantize,
+    quantize,
+    rescore,
+)
+
+logger = logging.getLogger("input_pipeline.quantization_benchmark")
+
+
+def synthetic_vectors(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """Vectors around random centroids, similar to embeddings of related texts"""
+    generator = np.random.default_rng(seed)
+    centroids = generator.normal(size=(max(1, count // 50), dimension))
+    assignments = generator.integers(0, len(centroids), size=count)
+    noise = generator.normal(scale=0.6, size=(count, dimension))
+    return (centroids[assignments] + noise).astype(np.float32)
+
+
+def load_vectors(args: argparse.Namespace) -> np.ndarray:
+    """Vectors of the embedding cache, synthetic ones if it is empty"""
+    if args.cache and Path(args.cache, "index.sqlite").exists():
+        cache = EmbeddingCache(args.cache, "", precision=None)
+        try:
+            vectors = cache.vectors()
+        finally:
+            cache.close()
+        if len(vectors) > args.queries:
+            logger.info("%d vectors from the cache in %s", len(vectors), args.cache)
+            return vectors
+        logger.info("%s holds too few vectors, using synthetic ones", args.cache)
+    return synthetic_vectors(args.vectors + args.queries, args.dim, args.seed)
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    """Share of the exact nearest neighbours found"""
+    hits = sum(
+        len(set(row_found) & set(row_expected))
+        for row_found, row_expected in zip(found, expected)
+    )
+    return hits / expected.size
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Measure every precision on the corpus vectors"""
+    vectors = load_vectors(args)
+    # held out vectors stand in for queries, they resemble the corpus
+    generator = np.random.default_rng(args.seed)
+    order = generator.permutation(len(vectors))
+    queries = vectors[order[: args.queries]]
+    corpus = vectors[order[args.queries :]]
+    count, dimension = corpus.shape
+    expected, _ = cosine_top_k(corpus, queries, args.top_k)
+
+    results = []
+    for precision in PRECISIONS:
+        codes, scales = quantize(corpus, precision)
+        decoded = dequantize(codes, scales)
+        start_time = time.perf_counter()
+        found, _ = cosine_top_k(decoded, queries, args.top_k)
+        search_seconds = time.perf_counter() - start_time
+        result: Dict[str, Any] = {
+            "precision": precision,
+            "vectors": count,
+            "dimension": dimension,
+            "bytes_per_vector": bytes_per_vector(dimension, precision),
+            "memory_mb": bytes_per_vector(dimension, precision) * count / 2**20,
+            f"recall@{args.top_k}": recall(found, expected),
+            "ms_per_query": search_seconds * 1000 / len(queries),
+            "rescored": {},
+        }
+        for oversample in args.oversample:
+            candidates, _ = cosine_top_k(decoded, queries, args.top_k * oversample)
+            rescored, _ = rescore(candidates, corpus, queries, args.top_k)
+            result["rescored"][oversample] = recall(rescored, expected)
+        results.append(result)
+        logger.info(
+            "%-7s %5d B/vector %8.1f MB  recall@%d %.3f  %s  %.2fms/query",
+            precision,
+            result["bytes_per_vector"],
+            result["memory_mb"],
+            args.top_k,
+            result[f"recall@{args.top_k}"],
+            ", ".join(
+                f"rescored x{oversample} {value:.3f}"
+                for oversample, value in result["rescored"].items()
+            ),
+            result["ms_per_query"],
+        )
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--cache", default="embedding_cache", help="embedding cache of the corpus"
+    )
+    arg_parser.add_argument(
+        "--vectors", type=int, default=20000, help="synthetic corpus size"
+    )
+    arg_parser.add_argument("--dim", type=int, default=1536, help="synthetic")
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--top-k", type=int, default=10)
+    arg_parser.add_argument(
+        "--oversample",
+        type=int,
+        nargs="+",
+        default=[2, 4],
+        help="candidates per result before rescoring",
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", help="also write the results to this file")
+    arguments = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    benchmark_results = main(arguments)
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as json_file:
+            json.dump(benchmark_results, json_file, indent=2)
@@ -0,0 +1,219 @@
+"""
+Rate limited, adaptively concurrent knowledge graph extraction
+"""
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+logger = logging.getLogger("input_pipeline.scheduler")
+
+# rough characters per token of English text
+CHARS_PER_TOKEN = 4
+# completion tokens budgeted per requested triplet
+TOKENS_PER_TRIPLET = 40
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    """Whether an error is a 429 of the model API"""
+    return (
+        getattr(error, "status_code", None) == 429
+        or type(error).__name__ == "RateLimitError"
+    )
+
+
+class TokenBucket:
+    """Allow `rate_per_minute` units per minute with bursts of up to a minute's worth"""
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        """Wait until `amount` units are available and take them"""
+        # a request larger than the bucket would wait forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit adjusted AIMD style: it grows by one per limit's worth
+    of fast successes and is halved on a 429 or a response slower than
+    `target_latency`, at most once per `cooldown` seconds.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = 64,
+        target_latency: float = 30.0,
+        cooldown: float = 5.0,
+    ) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._decreased = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        """Wait for a free slot"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        """Free a slot"""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        """Additive increase, or decrease if the response was too slow"""
+        if latency > self.target_latency:
+            self.on_overload(f"latency {latency:.1f}s")
+            return
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self, reason: str) -> None:
+        """Multiplicative decrease"""
+        now = time.monotonic()
+        if now - self._decreased < self.cooldown:
+            return
+        self._decreased = now
+        self.limit = max(self.minimum, self.limit / 2)
+        logger.info("Extraction concurrency down to %d (%s)", self.limit, reason)
+
+
+@dataclass
+class SchedulerStats:
+    """Requests, throttling and concurrency of the scheduler"""
+
+    requests: int = 0
+    rate_limited: int = 0
+    failed: int = 0
+    max_concurrency: int = 0
+
+
+class ExtractionScheduler:
+    """
+    Run the extraction of single chunks concurrently under a token bucket for
+    requests and one for tokens per minute, with a concurrency limit that
+    adapts to 429 responses and latency. Chunks hitting a 429 are retried
+    with backoff. A drop-in for the extractor's `acall`.
+    """
+
+    def __init__(
+        self,
+        kg_extractor: TransformComponent,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        target_latency: float = 30.0,
+        max_retries: int = 5,
+        backoff: float = 2.0,
+    ) -> None:
+        self.kg_extractor = kg_extractor
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.limit = AdaptiveLimit(
+            initial=max(min_concurrency, max_concurrency // 2),
+            minimum=min_concurrency,
+            maximum=max_concurrency,
+            target_latency=target_latency,
+        )
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = SchedulerStats()
+        self._prompt_tokens: Optional[int] = None
+
+    def estimate_tokens(self, node: BaseNode) -> int:
+        """Prompt and completion tokens an extraction of a chunk will take"""
+        max_triplets = getattr(self.kg_extractor, "max_triplets_per_chunk", 10)
+        if self._prompt_tokens is None:
+            prompt = getattr(self.kg_extractor, "extract_prompt", None)
+            self._prompt_tokens = 0
+            if prompt is not None:
+                template = prompt.format(text="", max_triplets_per_chunk=max_triplets)
+                self._prompt_tokens = len(template) // CHARS_PER_TOKEN
+        text = node.get_content(metadata_mode=MetadataMode.LLM)
+        return (
+            self._prompt_tokens
+            + len(text) // CHARS_PER_TOKEN
+            + max_triplets * TOKENS_PER_TRIPLET
+        )
+
+    async def _extract_one(self, node: BaseNode) -> BaseNode:
+        attempt = 0
+        while True:
+            if self.requests is not None:
+                await self.requests.acquire(1)
+            if self.tokens is not None:
+                await self.tokens.acquire(self.estimate_tokens(node))
+            await self.limit.acquire()
+            self.stats.max_concurrency = max(
+                self.stats.max_concurrency, self.limit.in_flight
+            )
+            start_time = time.monotonic()
+            try:
+                self.stats.requests += 1
+                (result,) = await self.kg_extractor.acall([node])
+            except Exception as e:
+                if not is_rate_limit(e) or attempt >= self.max_retries:
+                    self.stats.failed += 1
+                    raise
+                self.stats.rate_limited += 1
+                self.limit.on_overload("rate limited")
+            else:
+                self.limit.on_success(time.monotonic() - start_time)
+                return result
+            finally:
+                await self.limit.release()
+            attempt += 1
+            delay = self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff)
+            logger.debug("Rate limited, retrying %s in %.1fs", node.id_, delay)
+            await asyncio.sleep(delay)
+
+    async def acall(
+        self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any
+    ) -> List[BaseNode]:
+        """Extract triplets from chunks, results in input order"""
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(self._extract_one(node)) for node in nodes]
+        return [task.result() for task in tasks]
+
+    def log_stats(self) -> None:
+        """Log requests, throttling and concurrency"""
+        logger.info(
+            "Extraction: %d requests, %d rate limited, %d failed, "
+            "concurrency up to %d, limit now %d",
+            self.stats.requests,
+            self.stats.rate_limited,
+            self.stats.failed,
+            self.stats.max_concurrency,
+            int(self.limit.limit),
+        )
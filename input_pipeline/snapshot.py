@@ -0,0 +1,237 @@
+"""
+Export the knowledge graph to Arrow files and bulk load it back
+"""
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import neo4j
+import pyarrow as pa
+
+from bulk_writer import (
+    UPSERT_CHUNKS,
+    UPSERT_ENTITIES,
+    UPSERT_RELATIONS,
+    Neo4jBulkWriter,
+    _escape,
+)
+
+logger = logging.getLogger("input_pipeline.snapshot")
+
+# bump when the layout of the files changes
+SNAPSHOT_VERSION = 1
+
+# pages are read by id, which the uniqueness constraints index
+EXPORT_CHUNKS = """
+MATCH (c:Chunk)
+WHERE c.id > $after AND NOT c:__Entity__
+RETURN c.id AS id, c.text AS text,
+       c{.*, id: null, text: null, embedding: null} AS properties,
+       c.embedding AS embedding
+ORDER BY c.id
+LIMIT $limit
+"""
+
+EXPORT_ENTITIES = """
+MATCH (e:__Entity__)
+WHERE e.id > $after
+RETURN e.id AS id, e.name AS name,
+       [label IN labels(e) WHERE NOT label IN ['__Entity__', '__Node__', 'Chunk']][0]
+           AS label,
+       e{.*, id: null, name: null, embedding: null} AS properties,
+       e.embedding AS embedding
+ORDER BY e.id
+LIMIT $limit
+"""
+
+# relations are paged by their source node, MENTIONS included
+EXPORT_RELATIONS = """
+MATCH (s:__Node__)
+WHERE s.id > $after
+WITH s ORDER BY s.id LIMIT $limit
+OPTIONAL MATCH (s)-[r]->(t:__Node__)
+RETURN s.id AS source_id, type(r) AS label, t.id AS target_id,
+       properties(r) AS properties
+"""
+
+
+def _embedding_type(dimension: int) -> pa.DataType:
+    return pa.list_(pa.float32(), dimension)
+
+
+def snapshot_schemas(dimension: int) -> Dict[str, pa.Schema]:
+    """Arrow schema of every file, embeddings as fixed size float32 lists"""
+    return {
+        "chunks": pa.schema(
+            [
+                ("id", pa.string()),
+                ("text", pa.string()),
+                ("properties", pa.string()),
+                ("embedding", _embedding_type(dimension)),
+            ]
+        ),
+        "entities": pa.schema(
+            [
+                ("id", pa.string()),
+                ("name", pa.string()),
+                ("label", pa.string()),
+                ("properties", pa.string()),
+                ("embedding", _embedding_type(dimension)),
+            ]
+        ),
+        "relations": pa.schema(
+            [
+                ("source_id", pa.string()),
+                ("target_id", pa.string()),
+                ("label", pa.string()),
+                ("properties", pa.string()),
+            ]
+        ),
+    }
+
+
+@dataclass
+class SnapshotInfo:
+    """Contents of a snapshot, stored next to its files"""
+
+    version: int = SNAPSHOT_VERSION
+    created_at: str = field(
+        default_factory=lambda: datetime.now(timezone.utc).isoformat(timespec="seconds")
+    )
+    embedding_dimension: int = 0
+    rows: Dict[str, int] = field(default_factory=dict)
+
+
+def _pages(
+    driver: neo4j.Driver,
+    database: Optional[str],
+    query: str,
+    key: str,
+    page_size: int,
+) -> Iterator[List[Dict[str, Any]]]:
+    """Pages of a query ordered by `key`, resumed after the last key seen"""
+    after = ""
+    while True:
+        records, _, _ = driver.execute_query(
+            query, after=after, limit=page_size, database_=database
+        )
+        if not records:
+            return
+        after = max(record[key] for record in records)
+        yield [record.data() for record in records]
+
+
+def _properties(properties: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(
+        {key: value for key, value in (properties or {}).items() if value is not None}
+    )
+
+
+def export_graph(
+    driver: neo4j.Driver,
+    directory: str,
+    embedding_dimension: int,
+    database: Optional[str] = None,
+    page_size: int = 5000,
+) -> SnapshotInfo:
+    """
+    Write chunks, entities and relations with their properties and
+    embeddings to zstd compressed Arrow IPC files in `directory`, one record
+    batch per page
+    """
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    schemas = snapshot_schemas(embedding_dimension)
+    info = SnapshotInfo(embedding_dimension=embedding_dimension)
+    exports = [
+        ("chunks", EXPORT_CHUNKS, "id"),
+        ("entities", EXPORT_ENTITIES, "id"),
+        ("relations", EXPORT_RELATIONS, "source_id"),
+    ]
+    for kind, query, key in exports:
+        start_time = time.perf_counter()
+        schema = schemas[kind]
+        info.rows[kind] = 0
+        with pa.OSFile(str(path / f"{kind}.arrow"), "wb") as file, pa.ipc.new_file(
+            file, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+        ) as writer:
+            for page in _pages(driver, database, query, key, page_size):
+                rows = [
+                    {**row, "properties": _properties(row["properties"])}
+                    for row in page
+                    if kind != "relations" or row["label"] is not None
+                ]
+                for row in rows:
+                    embedding = row.get("embedding")
+                    if embedding is not None and len(embedding) != embedding_dimension:
+                        raise ValueError(
+                            f"Embedding of {row['id']} has {len(embedding)} "
+                            f"dimensions, expected {embedding_dimension}"
+                        )
+                if rows:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                info.rows[kind] += len(rows)
+        logger.info(
+            "Exported %d %s in %.1fs",
+            info.rows[kind],
+            kind,
+            time.perf_counter() - start_time,
+        )
+    with open(path / "snapshot.json", "w", encoding="utf-8") as file:
+        json.dump(asdict(info), file, indent=2)
+    return info
+
+
+def _batches(path: Path) -> Iterator[List[Dict[str, Any]]]:
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            rows = reader.get_batch(index).to_pylist()
+            for row in rows:
+                row["properties"] = json.loads(row["properties"])
+            yield rows
+
+
+def import_graph(
+    driver: neo4j.Driver,
+    directory: str,
+    database: Optional[str] = None,
+    batch_size: int = 1000,
+) -> SnapshotInfo:
+    """
+    Load a snapshot written by `export_graph` with batched UNWIND MERGE
+    statements, nodes before relations. Loading into a graph that already
+    holds the same ids updates those nodes and relations.
+    """
+    path = Path(directory)
+    with open(path / "snapshot.json", "r", encoding="utf-8") as file:
+        info = SnapshotInfo(**json.load(file))
+    if info.version != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Snapshot version {info.version} is not supported, "
+            f"expected {SNAPSHOT_VERSION}"
+        )
+
+    writer = Neo4jBulkWriter(driver, database=database, batch_size=batch_size)
+    for rows in _batches(path / "chunks.arrow"):
+        writer.write("chunks", UPSERT_CHUNKS, rows)
+    for rows in _batches(path / "entities.arrow"):
+        by_label: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            by_label.setdefault(row["label"] or "__Entity__", []).append(row)
+        for label, label_rows in by_label.items():
+            query = UPSERT_ENTITIES.format(label=_escape(label))
+            writer.write("entities", query, label_rows)
+    for rows in _batches(path / "relations.arrow"):
+        by_label = {}
+        for row in rows:
+            by_label.setdefault(row["label"], []).append(row)
+        for label, label_rows in by_label.items():
+            query = UPSERT_RELATIONS.format(label=_escape(label))
+            writer.write("relations", query, label_rows)
+    writer.log_stats()
+    return info
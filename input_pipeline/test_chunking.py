@@ -0,0 +1,65 @@
+""" Tests of the token chunker """
+
+from llama_index.core.schema import Document
+
+from chunking import TokenChunker, get_encoder
+
+# tiktoken ships no encoding of newer models offline
+MODEL = "gpt-3.5-turbo"
+
+
+def _chunker(chunk_size: int, chunk_overlap: int) -> TokenChunker:
+    return TokenChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap, model=MODEL)
+
+
+def _tokens(text: str) -> int:
+    return len(get_encoder(MODEL).encode(text))
+
+
+def test_chunks_stay_within_size_and_share_the_overlap():
+    sentences = [f"Sentence number {index} is here." for index in range(20)]
+    chunker = _chunker(chunk_size=30, chunk_overlap=8)
+    chunks = list(chunker.iter_chunks([Document(text=" ".join(sentences))]))
+
+    assert len(chunks) > 1
+    assert all(count <= 30 for count in chunker.token_counts)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # the last sentence of a chunk starts the next one
+        last_sentence = previous.text.rsplit(". ", 1)[-1]
+        assert chunk.text.startswith(last_sentence)
+        assert _tokens(last_sentence) <= 8
+    assert all(sentence in "".join(c.text for c in chunks) for sentence in sentences)
+
+
+def test_long_sentences_are_cut_at_token_boundaries():
+    chunker = _chunker(chunk_size=16, chunk_overlap=0)
+    chunks = list(chunker.iter_chunks([Document(text="word " * 100)]))
+
+    assert len(chunks) > 1
+    assert all(count <= 16 for count in chunker.token_counts)
+
+
+def test_chunks_record_the_pages_they_span():
+    pages = [
+        Document(text=f"Page {number} text. " * 2, metadata={"file_path": "a.pdf"})
+        for number in (1, 2, 3)
+    ]
+    chunks = list(_chunker(chunk_size=20, chunk_overlap=4).iter_chunks(pages))
+
+    spans = [(c.metadata["page_start"], c.metadata["page_end"]) for c in chunks]
+    assert spans == [(1, 2), (2, 3)]
+    for chunk in chunks:
+        assert chunk.metadata["file_path"] == "a.pdf"
+        assert "page_start" in chunk.excluded_llm_metadata_keys
+
+
+def test_separator_carried_over_does_not_start_a_chunk_on_its_page():
+    pages = [
+        Document(text="One two three four five six seven.\n\n", metadata={"page": 1}),
+        Document(text="Eight nine ten eleven twelve.", metadata={"page": 2}),
+    ]
+    chunks = list(_chunker(chunk_size=12, chunk_overlap=3).iter_chunks(pages))
+
+    assert chunks[-1].text.startswith("Eight")
+    assert chunks[-1].metadata["page_start"] == 2
+    assert chunks[-1].metadata["page"] == 2
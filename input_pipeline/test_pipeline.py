@@ -0,0 +1,106 @@
+"""
+Replacement of documents by the ingestion pipeline, run with `pytest` from
+the input_pipeline directory
+"""
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator, List, Sequence, Tuple
+
+from llama_index.core import Document
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.graph_stores import SimplePropertyGraphStore
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, TransformComponent
+
+from bulk_writer import ReplaceResult
+from parsing import ParsedFile
+from pipeline import IngestionPipeline
+from provenance import DOC_ID_KEY, document_id
+
+
+class NoExtraction(TransformComponent):
+    """Extractor leaving chunks as they are"""
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs) -> Sequence[BaseNode]:
+        return nodes
+
+
+class RecordingWriter:
+    """Bulk writer recording the documents it replaces"""
+
+    pending = 0
+
+    def __init__(self) -> None:
+        self.replaced: List[Tuple[str, str, int]] = []
+        self.nodes: List[BaseNode] = []
+
+    def replace_document(
+        self, doc_id, file_path, doc_version=None, nodes=(), kg_nodes=(), relations=()
+    ) -> ReplaceResult:
+        self.replaced.append((doc_id, file_path, len(nodes)))
+        self.nodes.extend(nodes)
+        return ReplaceResult(chunks=0, entities=0)
+
+    def flush(self) -> None:
+        pass
+
+
+async def _parsed(files: List[ParsedFile]) -> AsyncIterator[ParsedFile]:
+    for parsed_file in files:
+        yield parsed_file
+
+
+def _pipeline(writer: RecordingWriter, **kwargs) -> IngestionPipeline:
+    return IngestionPipeline(
+        NoExtraction(),
+        SimplePropertyGraphStore(),
+        MockEmbedding(embed_dim=8),
+        transformations=[SentenceSplitter()],
+        bulk_writer=writer,  # type: ignore [arg-type]
+        replace_documents=True,
+        **kwargs,
+    )
+
+
+def test_failed_parse_keeps_previous_version() -> None:
+    good, failed = Path("good.pdf"), Path("failed.pdf")
+    writer = RecordingWriter()
+    written: List[Path] = []
+    pipeline = _pipeline(
+        writer,
+        on_file_written=written.append,
+        document_versions={str(good): "v2", str(failed): "v2"},
+    )
+    stats = asyncio.run(
+        pipeline.arun(
+            _parsed(
+                [
+                    (good, [Document(text="Acme Corp makes anvils.")]),
+                    # what the parsing stage yields once all attempts failed
+                    (failed, []),
+                ]
+            )
+        )
+    )
+
+    assert [file_path for _, file_path, _ in writer.replaced] == [str(good)]
+    assert written == [good]
+    assert stats.kept_files == 1
+
+
+def test_markdown_file_replaces_the_document_of_its_pdf() -> None:
+    markdown, pdf = Path("markdown/report.md"), "pdfs/report.pdf"
+    writer = RecordingWriter()
+    pipeline = _pipeline(
+        writer,
+        document_versions={str(markdown): "v2"},
+        document_paths={str(markdown): pdf},
+    )
+    asyncio.run(
+        pipeline.arun(_parsed([(markdown, [Document(text="Acme Corp makes anvils.")])]))
+    )
+
+    assert [(doc_id, file_path) for doc_id, file_path, _ in writer.replaced] == [
+        (document_id(pdf), pdf)
+    ]
+    assert {node.metadata[DOC_ID_KEY] for node in writer.nodes} == {document_id(pdf)}
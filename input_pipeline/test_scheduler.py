@@ -0,0 +1,97 @@
+""" Tests of the token bucket and the adaptive concurrency limit """
+
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import AdaptiveLimit, TokenBucket
+
+
+class FakeClock:
+    """Monotonic clock advanced by the sleeps of the code under test"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(scheduler.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_then_waits_for_the_rate(clock):
+    bucket = TokenBucket(rate_per_minute=60)
+
+    async def run() -> None:
+        await bucket.acquire(60)
+        assert not clock.sleeps
+        await bucket.acquire(3)
+
+    asyncio.run(run())
+    assert sum(clock.sleeps) == pytest.approx(3.0)
+
+
+def test_token_bucket_caps_requests_at_its_capacity(clock):
+    bucket = TokenBucket(rate_per_minute=60)
+
+    asyncio.run(bucket.acquire(1000))
+    assert not clock.sleeps
+    assert bucket.tokens == 0
+
+
+def test_adaptive_limit_grows_by_one_per_limit_of_successes(clock):
+    limit = AdaptiveLimit(initial=4, maximum=5, target_latency=10.0)
+    for _ in range(4):
+        limit.on_success(1.0)
+    # about one more slot after a limit's worth of successes
+    assert 4.5 < limit.limit < 5
+    for _ in range(20):
+        limit.on_success(1.0)
+    assert limit.limit == 5
+
+
+def test_adaptive_limit_halves_once_per_cooldown(clock):
+    limit = AdaptiveLimit(initial=16, minimum=2, cooldown=5.0, target_latency=10.0)
+    limit.on_overload("429")
+    limit.on_overload("429")
+    assert limit.limit == 8
+    limit.on_success(30.0)  # too slow, but within the cooldown
+    assert limit.limit == 8
+    clock.now += 5.0
+    limit.on_success(30.0)
+    assert limit.limit == 4
+    for _ in range(3):
+        clock.now += 5.0
+        limit.on_overload("429")
+    assert limit.limit == 2
+
+
+def test_adaptive_limit_bounds_the_requests_in_flight():
+    limit = AdaptiveLimit(initial=2)
+    peak = 0
+
+    async def request() -> None:
+        nonlocal peak
+        await limit.acquire()
+        peak = max(peak, limit.in_flight)
+        await asyncio.sleep(0.01)
+        await limit.release()
+
+    async def run() -> None:
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+    assert limit.in_flight == 0
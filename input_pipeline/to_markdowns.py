@@ -2,15 +2,22 @@
 """
 Convert all pdf documents in a directory to markdown
 """
+import asyncio
 import logging
+import os
+import tempfile
 import time
 import pathlib
+from dataclasses import dataclass, field
+from typing import List
 
-from llama_index.core import SimpleDirectoryReader, schema
 from llama_parse import LlamaParse, ResultType  # type: ignore [import-untyped]
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from manifest import IngestManifest, schema_sha256
+from parsing import ParsingStage, list_files
+
 
 # Settings
 class ModelSettings(BaseSettings):
@@ -23,7 +30,13 @@ class ModelSettings(BaseSettings):
     )
     llama_cloud_api_key: SecretStr
     logging_level: str = "INFO"
+    markdown_manifest_path: str = "markdown_manifest.json"
     markdown_path: str
+    parse_backoff: float = 2.0
+    parse_max_in_flight: int = 8
+    parse_retries: int = 3
+    parse_timeout: float = 900.0
+    parse_workers: int = 4
     pdf_path: str
 
 
@@ -50,27 +63,130 @@ logging.getLogger("llama_index").setLevel(logging.INFO)
 parser = LlamaParse(
     result_type=ResultType.MD,
     split_by_page=False,  # force to split by page
+    ignore_errors=False,  # let the parsing stage retry failed files
     api_key=settings.llama_cloud_api_key.get_secret_value(),
 )
 
+# a changed conversion invalidates all markdown files
+CONVERSION_HASH = schema_sha256({"result_type": "markdown", "split_by_page": False})
+
+
+@dataclass
+class ConversionSummary:
+    """Files of a conversion run"""
+
+    converted: List[pathlib.Path] = field(default_factory=list)
+    skipped: List[pathlib.Path] = field(default_factory=list)
+    failed: List[pathlib.Path] = field(default_factory=list)
+
+
+def markdown_file(pdf_file: pathlib.Path) -> pathlib.Path:
+    """Markdown file a pdf file is converted to"""
+    return pathlib.Path(settings.markdown_path) / f"{pdf_file.stem}.md"
+
+
+def is_up_to_date(pdf_file: pathlib.Path) -> bool:
+    """Whether the markdown file is newer than its pdf file"""
+    try:
+        return markdown_file(pdf_file).stat().st_mtime >= pdf_file.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def write_atomic(path: pathlib.Path, text: str) -> None:
+    """Write a file through a temporary file, readers never see partial content"""
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, mode="w", encoding="utf-8") as f:
+            f.write(text)
+        # mkstemp creates files only the owner can read
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+async def convert(
+    pdf_files: List[pathlib.Path], manifest: IngestManifest
+) -> ConversionSummary:
+    """Convert pdf files to markdown, skipping those that did not change"""
+    summary = ConversionSummary()
+    candidates = []
+    for pdf_file in pdf_files:
+        if is_up_to_date(pdf_file):
+            summary.skipped.append(pdf_file)
+        else:
+            candidates.append(pdf_file)
+    # a touched pdf with the same content does not need a new conversion
+    changes = manifest.diff(candidates, CONVERSION_HASH, "llama-parse")
+    for pdf_file in changes.unchanged:
+        if markdown_file(pdf_file).exists():
+            summary.skipped.append(pdf_file)
+        else:
+            changes.new.append(pdf_file)
+
+    parsing_stage = ParsingStage(
+        {".pdf": parser},
+        workers=settings.parse_workers,
+        max_in_flight=settings.parse_max_in_flight,
+        retries=settings.parse_retries,
+        backoff=settings.parse_backoff,
+        timeout=settings.parse_timeout,
+    )
+    async for pdf_file, documents in parsing_stage.aiter_parse(changes.to_ingest):
+        if not documents:
+            summary.failed.append(pdf_file)
+            continue
+        markdown_file_name = markdown_file(pdf_file)
+        logging.debug(
+            "Converted %s in %.1fs",
+            pdf_file.name,
+            parsing_stage.durations.get(pdf_file, 0.0),
+        )
+        write_atomic(markdown_file_name, "\n\n".join(doc.text for doc in documents))
+        manifest.record(
+            pdf_file,
+            changes.content_hashes[str(pdf_file)],
+            CONVERSION_HASH,
+            "llama-parse",
+        )
+        summary.converted.append(pdf_file)
+
+    if summary.converted:
+        durations = [parsing_stage.durations[path] for path in summary.converted]
+        logging.info(
+            "Conversion took %.1fs per file on average, %.1fs at most",
+            sum(durations) / len(durations),
+            max(durations),
+        )
+    return summary
+
 
 def main():
     """Main function"""
 
     logging.debug("Converting pdf files to markdown")
-    file_extractor = {".pdf": parser}
-    documents: list[schema.Document] = []  # type: ignore [annotation-unchecked]
-    documents = SimpleDirectoryReader(
-        settings.pdf_path, file_extractor=file_extractor
-    ).load_data()
-    for doc in documents:
-        file_name: str = doc.metadata["file_name"]  # type: ignore [annotation-unchecked]
-        logging.debug("Converting %s", file_name)
-        base_name: str = pathlib.Path(file_name).stem  # type: ignore [annotation-unchecked]
-        markdown_file_name: str  # type: ignore [annotation-unchecked]
-        markdown_file_name = settings.markdown_path + f"/{base_name}.md"
-        with open(markdown_file_name, mode="w", encoding="utf-8") as f:
-            f.write(doc.text)
+    pathlib.Path(settings.markdown_path).mkdir(parents=True, exist_ok=True)
+    manifest = IngestManifest(settings.markdown_manifest_path)
+    start_time = time.perf_counter()
+    try:
+        summary = asyncio.run(
+            convert(list_files(settings.pdf_path, [".pdf"]), manifest)
+        )
+    finally:
+        manifest.save()
+    logging.info(
+        "Converted %d, skipped %d and failed %d files in %.1fs",
+        len(summary.converted),
+        len(summary.skipped),
+        len(summary.failed),
+        time.perf_counter() - start_time,
+    )
+    if summary.failed:
+        logging.error(
+            "Failed to convert %s", ", ".join(path.name for path in summary.failed)
+        )
 
     logging.debug("Done")
 
@@ -1,40 +1,61 @@
 """ GraphRAG researcher module"""
 
+from functools import cache
 from textwrap import dedent
 
 from llama_index.core.chat_engine.types import ChatMessage
+from llama_index.core.tools import FunctionTool
 
 from app.agents import FunctionCallingAgentConfig, WorkflowConfig
 from app.agents.single import FunctionCallingAgent
+from app.config import settings
 from app.engine.tools.property_graph import (
     CypherQueryRetriever,
+    HybridGraphRetriever,
     KeywordSynonymRetriever,
-    PropertyGraphTool,
     VectorSimilarityRetriever,
 )
+from app.providers import providers
 
-from app.config import graph_store, vector_store, llm
 
-
-def _get_research_tools() -> list[PropertyGraphTool]:
+@cache
+def _get_research_tools() -> tuple[FunctionTool, ...]:
     """
     Researcher takes responsibility for retrieving information
     using property graph querying strategies.
+    The tools are built once per process and shared by all researchers.
     """
 
-    tools = [
-        KeywordSynonymRetriever(graph_store, vector_store, llm),
-        VectorSimilarityRetriever(graph_store, vector_store, llm),
-        CypherQueryRetriever(graph_store, vector_store, llm),
-    ]
-    return tools
+    graph_store, vector_store, llm, embed_model = (
+        providers.get(name)
+        for name in ("graph_store", "vector_store", "llm", "embed_model")
+    )
+    clients = (graph_store, vector_store, llm, embed_model)
+    # the agent workflow calls the tools with acall, i.e. their aretrieve
+    if settings.hybrid_retrieval:
+        hybrid = HybridGraphRetriever(
+            graph_store,
+            vector_store,
+            llm,
+            embed_model,
+            fusion=settings.retrieval_fusion,
+            rrf_k=settings.retrieval_rrf_k,
+            top_k=settings.top_k,
+            max_context_tokens=settings.retrieval_context_tokens,
+        )
+        return (hybrid.to_tool(),)
+    return (
+        KeywordSynonymRetriever(*clients).to_tool(),
+        VectorSimilarityRetriever(*clients).to_tool(),
+        CypherQueryRetriever(*clients).to_tool(),
+    )
 
 
 def create_researcher(chat_history: list[ChatMessage]):
     """
     Researcher is an agent that takes responsibility for using tools to complete a given task, focusing exclusively on property graph querying strategies.
     """
-    tools = _get_research_tools()
+    tools = list(_get_research_tools())
     return FunctionCallingAgent(
         name="graph_rag_researcher",
         workflow_config=WorkflowConfig(verbose=True, num_concurrent_runs=1),
@@ -1,13 +1,13 @@
 """ Configuration settings for the web service """
 
-from llama_index.core import Settings
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.graph_stores.neo4j import Neo4jPGStore  # type: ignore [import-untyped]
-from llama_index.llms.azure_openai import AzureOpenAI
-from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
+from typing import Any, Literal, Optional
+
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# clients created on first use or by the warm-up of the application lifespan
+PROVIDED = ("neo4j", "graph_store", "vector_store", "llm", "embed_model")
+
 
 # Settings
 class ModelSettings(BaseSettings):
@@ -33,51 +33,41 @@ class ModelSettings(BaseSettings):
     embedding_dimension: int
     conversation_starters: str
     environment: str = "dev"
+    # one fused retriever tool for the graph researcher instead of three
+    hybrid_retrieval: bool = True
     llama_cloud_api_key: SecretStr
     llm_temperature: float
     logging_level: str = "INFO"
+    # seconds to wait for a connection from the pool
+    neo4j_connection_acquisition_timeout: float = 60.0
+    neo4j_connection_timeout: float = 30.0  # seconds to establish a connection
+    # seconds a connection may be idle before it is checked, None for never
+    neo4j_liveness_check_timeout: Optional[float] = None
+    neo4j_max_connection_lifetime: float = 3600.0  # seconds
+    # connections per worker and driver, keep workers x 2 x size below the
+    # connection limit of the server
+    neo4j_max_connection_pool_size: int = 100
     neo4j_password: SecretStr
     neo4j_uri: str
     neo4j_username: str
+    # expected quantization of the vector indexes the input pipeline creates
+    neo4j_vector_quantization: bool = True
+    retrieval_context_tokens: int = 3000  # token budget of the fused context
+    retrieval_fusion: Literal["rrf", "weighted"] = "rrf"
+    retrieval_rrf_k: int = 60
     top_k: int
+    # vector index candidates per result ranked by exact similarity, 1 for none
+    vector_rescore_oversample: int = 4
 
 
 settings = ModelSettings()  # type: ignore [call-arg]
 
-# graph store instance
-graph_store = Neo4jPGStore(
-    username=settings.neo4j_username,
-    password=settings.neo4j_password.get_secret_value(),
-    url=settings.neo4j_uri,
-    embedding_dimension=1536,
-)
-
-# vector store instance
-vector_store = Neo4jVectorStore(
-    username=settings.neo4j_username,
-    password=settings.neo4j_password.get_secret_value(),
-    url=settings.neo4j_uri,
-    embedding_dimension=1536,
-)
-
-# language model instance
-llm = AzureOpenAI(
-    engine=settings.azure_openai_engine,
-    model=settings.azure_openai_llm_deployment,
-    temperature=settings.llm_temperature,
-    azure_endpoint=settings.azure_openai_endpoint,
-    api_key=settings.azure_openai_api_key.get_secret_value(),
-    api_version=settings.azure_openai_api_version,
-)
 
-# embedding model
-embed_model = AzureOpenAIEmbedding(
-    model=settings.azure_openai_embedding_model,
-    deployment_name=settings.azure_openai_embedding_deployment,
-    azure_endpoint=settings.azure_openai_endpoint,
-    api_key=settings.azure_openai_api_key.get_secret_value(),
-    api_version=settings.azure_openai_api_version,
-)
+def __getattr__(name: str) -> Any:
+    """The clients of app.providers, e.g. the graph store or the LLM"""
+    if name in PROVIDED:
+        # imported here, app.providers depends on the settings of this module
+        from app.providers import providers  # pylint: disable=import-outside-toplevel
 
-Settings.llm = llm
-Settings.embed_model = embed_model
+        return providers.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
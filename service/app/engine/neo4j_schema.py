@@ -0,0 +1,69 @@
+"""
+Read-only check of the Neo4j indexes the service queries
+
+The input pipeline owns the schema: input_pipeline/neo4j_schema.py creates the
+constraints and indexes and recreates vector indexes whose options changed.
+The service only reports indexes that are missing, not online or built with
+other options, so its workers never drop an index another one is using.
+"""
+import logging
+from typing import Dict, List, Optional
+
+import neo4j
+
+logger = logging.getLogger("uvicorn")
+
+# indexes of input_pipeline/neo4j_schema.py the retrievers depend on
+INDEXES = ["entity_name", "entity_name_text"]
+VECTOR_INDEXES = ["entity", "chunk"]
+
+SHOW_INDEXES = """
+SHOW INDEXES
+YIELD name, type, state, options
+RETURN name, type, state, options
+"""
+
+
+def check_schema(
+    driver: neo4j.Driver,
+    database: Optional[str] = None,
+    embedding_dimension: int = 1536,
+    quantization: Optional[bool] = None,
+) -> List[str]:
+    """
+    Log a warning for every index the retrievers depend on that is missing,
+    not online or, for vector indexes, has another dimension or quantization
+    than configured, and return these problems. Run the input pipeline to
+    create or recreate the indexes.
+    """
+    records, _, _ = driver.execute_query(SHOW_INDEXES, database_=database)
+    states = {record["name"]: record for record in records}
+    problems = []
+    for name in INDEXES + VECTOR_INDEXES:
+        state = states.get(name)
+        if state is None:
+            problems.append(f"index {name} is missing")
+            continue
+        if state["state"] != "ONLINE":
+            problems.append(f"index {name} is {state['state']}")
+        if name not in VECTOR_INDEXES:
+            continue
+        config: Dict = (state["options"] or {}).get("indexConfig") or {}
+        dimension = config.get("vector.dimensions")
+        if dimension != embedding_dimension:
+            problems.append(
+                f"vector index {name} has {dimension} dimensions, "
+                f"embeddings have {embedding_dimension}"
+            )
+        quantized = config.get("vector.quantization.enabled")
+        if quantization is not None and quantized is not None:
+            if quantized != quantization:
+                problems.append(
+                    f"vector index {name} has quantization "
+                    f"{'enabled' if quantized else 'disabled'}"
+                )
+    for problem in problems:
+        logger.warning("Neo4j schema: %s, run the input pipeline", problem)
+    if not problems:
+        logger.info("Neo4j indexes %s are online", ", ".join(INDEXES + VECTOR_INDEXES))
+    return problems
@@ -1,7 +1,17 @@
+import asyncio
+import logging
+import re
+from abc import ABC, abstractmethod
+from functools import cached_property
+from typing import Callable, Literal, Optional
+
 from llama_index.core.indices.property_graph import (
     LLMSynonymRetriever,
     VectorContextRetriever,
 )
+from llama_index.core.indices.property_graph.sub_retrievers.base import (
+    BasePGRetriever,
+)
 from llama_index.core.schema import (
     NodeWithScore,
     QueryBundle,
@@ -9,63 +19,263 @@ from llama_index.core.schema import (
 
 from llama_index.core.indices.property_graph import CypherTemplateRetriever
 from llama_index.core.bridge.pydantic import BaseModel, Field
+from llama_index.core.tools import FunctionTool
+from llama_index.core.utils import get_tokenizer
 
 from textwrap import dedent
-from app.config import settings
 
+logger = logging.getLogger("uvicorn")
+
+
+class CypherQueryParams(BaseModel):
+    """Parameters for a cypher query."""
+
+    names: list[str] = Field(
+        description="A list of possible entity names or keywords related to the query."
+    )
+
+
+MENTIONS_QUERY = dedent(
+    """
+    MATCH (c:Chunk)-[:MENTIONS]->(o:__Entity__)
+    WHERE o.name IN $names
+    RETURN c.text, o.name, o.label;
+    """
+)
+
+
+class PropertyGraphTool(ABC):
+    """Long-lived retrieval tool on the graph and vector store"""
+
+    description = ""
 
-class PropertyGraphTool:
-    def __init__(self, graph_store, vector_store, llm):
+    def __init__(self, graph_store, vector_store, llm, embed_model=None):
         self.graph_store = graph_store
         self.vector_store = vector_store
         self.llm = llm
+        self.embed_model = embed_model
 
-    def retrieve(self, query) -> list[NodeWithScore]:
-        raise NotImplementedError("Subclasses must implement the retrieve method.")
+    @property
+    def name(self) -> str:
+        """Tool name, e.g. keyword_synonym_retriever"""
+        return re.sub(r"(?<!^)(?=[A-Z])", "_", type(self).__name__).lower()
 
+    @abstractmethod
+    def retrieve(self, query: str) -> list[NodeWithScore]:
+        """Nodes of the graph relevant to the query"""
 
-class KeywordSynonymRetriever(PropertyGraphTool):
-    def retrieve(self, query) -> list[NodeWithScore]:
-        """Use this function to get content from the graph by keyword synonyms."""
-        sub_retriever = LLMSynonymRetriever(self.graph_store, llm=self.llm)
-        query_bundle = QueryBundle(query_str=query)
-        return sub_retriever.retrieve_from_graph(query_bundle)
+    @abstractmethod
+    async def aretrieve(self, query: str) -> list[NodeWithScore]:
+        """Nodes of the graph relevant to the query, without blocking"""
+
+    def to_tool(self) -> FunctionTool:
+        """Function tool for agents, called with `aretrieve` by async agents"""
+        return FunctionTool.from_defaults(
+            fn=self.retrieve,
+            async_fn=self.aretrieve,
+            name=self.name,
+            description=f"{self.name}(query: str)\n{self.description}",
+        )
+
+
+class SubRetrieverTool(PropertyGraphTool):
+    """
+    Tool on one sub-retriever: the sub-retriever, with its prompts and store
+    handles, is built on first use and reused by every query
+    """
+
+    @abstractmethod
+    def build_sub_retriever(self) -> BasePGRetriever:
+        """The sub-retriever of the tool"""
+
+    @cached_property
+    def sub_retriever(self) -> BasePGRetriever:
+        return self.build_sub_retriever()
+
+    def retrieve(self, query: str) -> list[NodeWithScore]:
+        return self.sub_retriever.retrieve_from_graph(QueryBundle(query_str=query))
+
+    async def aretrieve(self, query: str) -> list[NodeWithScore]:
+        """
+        Retrieve without blocking the event loop: natively async if the graph
+        store has async queries, else in a worker thread
+        """
+        if not getattr(self.graph_store, "supports_async_queries", False):
+            return await asyncio.to_thread(self.retrieve, query)
+        return await self.sub_retriever.aretrieve_from_graph(
+            QueryBundle(query_str=query)
+        )
 
 
-class VectorSimilarityRetriever(PropertyGraphTool):
-    def retrieve(self, query) -> list[NodeWithScore]:
-        """Use this function to get content from the graph by vector similarity."""
-        sub_retriever = VectorContextRetriever(
+class KeywordSynonymRetriever(SubRetrieverTool):
+    description = "Use this function to get content from the graph by keyword synonyms."
+
+    def build_sub_retriever(self) -> BasePGRetriever:
+        return LLMSynonymRetriever(self.graph_store, llm=self.llm)
+
+
+class VectorSimilarityRetriever(SubRetrieverTool):
+    description = (
+        "Use this function to get content from the graph by vector similarity."
+    )
+
+    def build_sub_retriever(self) -> BasePGRetriever:
+        return VectorContextRetriever(
             self.graph_store,
             vector_store=self.vector_store,
-            embed_model=settings.EMBEDDING_MODEL,
+            embed_model=self.embed_model,
         )
-        query_bundle = QueryBundle(query_str=query)
-        return sub_retriever.retrieve_from_graph(query_bundle)
 
 
-class CypherQueryRetriever(PropertyGraphTool):
-    def retrieve(self, query) -> list[NodeWithScore]:
-        class Params(BaseModel):
-            """Parameters for a cypher query."""
+class CypherQueryRetriever(SubRetrieverTool):
+    description = (
+        "Use this function to get the text of chunks mentioning entities "
+        "named in the query."
+    )
+
+    def build_sub_retriever(self) -> BasePGRetriever:
+        return CypherTemplateRetriever(
+            self.graph_store,
+            # the output class, annotated as an instance of it
+            CypherQueryParams,  # type: ignore [arg-type]
+            MENTIONS_QUERY,
+            llm=self.llm,
+        )
+
+
+class HybridGraphRetriever(PropertyGraphTool):
+    """
+    Runs the keyword synonym, vector similarity and Cypher retrievers
+    concurrently and fuses their results into one context, so the agent
+    needs one tool call instead of one per strategy.
+
+    Nodes found by several retrievers are counted once, ranked by reciprocal
+    rank fusion (`rrf`: sum of weight / (rrf_k + rank)) or by the weighted sum
+    of their min-max normalized scores (`weighted`, 0.5 for lists whose scores
+    are all equal). The best nodes are kept up to `top_k` and
+    `max_context_tokens`.
+    """
+
+    description = (
+        "Use this function to get content from the graph by keyword synonyms, "
+        "vector similarity and the entities named in the query at once."
+    )
 
-            names: list[str] = Field(
-                description="A list of possible entity names or keywords related to the query."
+    def __init__(
+        self,
+        graph_store,
+        vector_store,
+        llm,
+        embed_model=None,
+        retrievers: Optional[list[PropertyGraphTool]] = None,
+        fusion: Literal["rrf", "weighted"] = "rrf",
+        weights: Optional[dict[str, float]] = None,
+        rrf_k: int = 60,
+        top_k: int = 10,
+        max_context_tokens: int = 3000,
+        tokenizer: Optional[Callable[[str], list]] = None,
+    ):
+        super().__init__(graph_store, vector_store, llm, embed_model)
+        if fusion not in ("rrf", "weighted"):
+            raise ValueError(f"Unknown fusion {fusion}, use rrf or weighted")
+        self.retrievers = retrievers or [
+            retriever(graph_store, vector_store, llm, embed_model)
+            for retriever in (
+                KeywordSynonymRetriever,
+                VectorSimilarityRetriever,
+                CypherQueryRetriever,
             )
+        ]
+        self.fusion = fusion
+        self.weights = weights or {}
+        self.rrf_k = rrf_k
+        self.top_k = top_k
+        self.max_context_tokens = max_context_tokens
+        self.tokenizer = tokenizer or get_tokenizer()
 
-        cypher_query = dedent(
-            """
-        MATCH (c:Chunk)-[:MENTIONS]->(o) 
-        WHERE o.name IN $names
-        RETURN c.text, o.name, o.label;
-        """
+    def retrieve(self, query: str) -> list[NodeWithScore]:
+        results = []
+        for retriever in self.retrievers:
+            try:
+                results.append(retriever.retrieve(query))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("%s failed: %s", retriever.name, e)
+                results.append([])
+        return self.fuse(results)
+
+    async def aretrieve(self, query: str) -> list[NodeWithScore]:
+        results = await asyncio.gather(
+            *(retriever.aretrieve(query) for retriever in self.retrievers),
+            return_exceptions=True,
+        )
+        for retriever, result in zip(self.retrievers, results):
+            if isinstance(result, Exception):
+                logger.warning("%s failed: %s", retriever.name, result)
+        return self.fuse(
+            [[] if isinstance(result, BaseException) else result for result in results]
         )
 
-        sub_retriever = CypherTemplateRetriever(
-            self.graph_store,
-            Params,
-            cypher_query,
-            llm=settings.llm,
+    def fuse(self, results: list[list[NodeWithScore]]) -> list[NodeWithScore]:
+        """One ranking of the results of the retrievers, within the budget"""
+        fused: dict[str, NodeWithScore] = {}
+        scores: dict[str, float] = {}
+        # the Cypher retriever creates new ids for the same text
+        keys_by_text: dict[str, str] = {}
+        for retriever, nodes in zip(self.retrievers, results):
+            weight = self.weights.get(retriever.name, 1.0)
+            seen: set[str] = set()
+            for node, score in zip(nodes, self._scores(nodes)):
+                key = keys_by_text.setdefault(
+                    node.node.get_content(), node.node.node_id
+                )
+                if key in seen:
+                    continue
+                seen.add(key)
+                fused.setdefault(key, node)
+                scores[key] = scores.get(key, 0.0) + weight * score
+
+        ranked = sorted(fused, key=lambda key: scores[key], reverse=True)
+        context: list[NodeWithScore] = []
+        tokens = 0
+        for key in ranked[: self.top_k]:
+            node_tokens = len(self.tokenizer(fused[key].node.get_content()))
+            if context and tokens + node_tokens > self.max_context_tokens:
+                break
+            tokens += node_tokens
+            context.append(NodeWithScore(node=fused[key].node, score=scores[key]))
+        return context
+
+    def _scores(self, nodes: list[NodeWithScore]) -> list[float]:
+        if self.fusion == "rrf":
+            return [1 / (self.rrf_k + rank) for rank in range(1, len(nodes) + 1)]
+        # retrievers without scores rank their nodes in order
+        raw = [
+            node.score if node.score is not None else 1 / rank
+            for rank, node in enumerate(nodes, start=1)
+        ]
+        low, high = min(raw, default=0.0), max(raw, default=0.0)
+        if high == low:
+            # nothing to normalize against, e.g. the one node of the Cypher
+            # retriever, which should not outweigh the best of another list
+            return [0.5] * len(raw)
+        return [(score - low) / (high - low) for score in raw]
+
+    @staticmethod
+    def context(nodes: list[NodeWithScore]) -> str:
+        """The text of the nodes as one context"""
+        return "\n\n".join(node.node.get_content() for node in nodes)
+
+    def search(self, query: str) -> str:
+        return self.context(self.retrieve(query))
+
+    async def asearch(self, query: str) -> str:
+        return self.context(await self.aretrieve(query))
+
+    def to_tool(self) -> FunctionTool:
+        """Function tool returning the fused context as text"""
+        return FunctionTool.from_defaults(
+            fn=self.search,
+            async_fn=self.asearch,
+            name=self.name,
+            description=f"{self.name}(query: str)\n{self.description}",
         )
-        query_bundle = QueryBundle(query_str=query)
-        return sub_retriever.retrieve_from_graph(query_bundle)
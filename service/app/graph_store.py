@@ -0,0 +1,186 @@
+""" Neo4j property graph store with exact rescoring of vector index results """
+
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import neo4j
+from llama_index.core.graph_stores.types import EntityNode, LabelledNode, Triplet
+from llama_index.core.graph_stores.utils import value_sanitize
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from llama_index.graph_stores.neo4j import Neo4jPGStore  # type: ignore [import-untyped]
+from llama_index.graph_stores.neo4j.neo4j_property_graph import (  # type: ignore [import-untyped]
+    remove_empty_values,
+)
+
+# candidates from the entity index, ranked again by the cosine similarity of
+# the embeddings stored on the nodes (float32 unless the input pipeline read
+# them back from a float16 or int8 embedding cache)
+RESCORED_VECTOR_QUERY = """
+CALL db.index.vector.queryNodes('entity', $candidates, $embedding)
+YIELD node
+WITH node, vector.similarity.cosine(node.embedding, $embedding) AS score
+ORDER BY score DESC
+LIMIT $limit
+RETURN node.id AS name,
+[l IN labels(node) WHERE NOT l IN ['__Entity__', '__Node__'] | l][0] AS type,
+node{.*, embedding: Null, name: Null, id: Null} AS properties,
+score
+"""
+
+
+# errors of queries Neo4j only runs in an implicit transaction, e.g. CALL IN
+# TRANSACTIONS, which the sync structured_query retries in a session: codes
+# and the messages that tell them apart from other errors with these codes
+IMPLICIT_TRANSACTION_ERRORS = {
+    "Neo.DatabaseError.Statement.ExecutionFailed": ("in an implicit transaction",),
+    "Neo.DatabaseError.Transaction.TransactionStartFailed": (
+        "in an implicit transaction",
+    ),
+    "Neo.ClientError.Statement.SemanticError": (
+        "in an open transaction is not possible",
+        "tried to execute in an explicit transaction",
+    ),
+}
+
+
+def needs_implicit_transaction(error: neo4j.exceptions.Neo4jError) -> bool:
+    """Whether a query failed because it only runs in an implicit transaction"""
+    messages = IMPLICIT_TRANSACTION_ERRORS.get(error.code or "", ())
+    return any(message in (error.message or "") for message in messages)
+
+
+class RescoringNeo4jPGStore(Neo4jPGStore):
+    """
+    Neo4j property graph store taking `oversample` times the requested
+    entities from the (quantized) vector index and returning the best of
+    them by their exact cosine similarity, so quantization of the index does
+    not change the ranking of the results.
+
+    Structured and vector queries have native async versions on the async
+    driver; the other async methods, which the base store runs synchronously
+    on the event loop, run in a worker thread.
+
+    The store uses the drivers it is given, e.g. those the vector store
+    shares, instead of opening its own.
+    """
+
+    supports_async_queries = True
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self,
+        driver: neo4j.Driver,
+        async_driver: neo4j.AsyncDriver,
+        database: Optional[str] = "neo4j",
+        oversample: int = 4,
+        refresh_schema: bool = True,
+        sanitize_query_output: bool = True,
+        enhanced_schema: bool = False,
+    ) -> None:
+        # Neo4jPGStore.__init__ without the drivers it opens, and without the
+        # constraints and the entity vector index, which the input pipeline
+        # creates with their options
+        self.sanitize_query_output = sanitize_query_output
+        self.enhanced_schema = enhanced_schema
+        self._driver = driver
+        self._async_driver = async_driver
+        self._database = database
+        self.structured_schema = {}
+        if refresh_schema:
+            self.refresh_schema()
+        self.verify_version()
+        self.oversample = oversample
+
+    def _rescored_params(self, query: VectorStoreQuery) -> Dict[str, Any]:
+        return {
+            "embedding": query.query_embedding,
+            "candidates": query.similarity_top_k * self.oversample,
+            "limit": query.similarity_top_k,
+        }
+
+    def _rescoring(self, query: VectorStoreQuery) -> bool:
+        # filtered queries scan the stored embeddings and are exact already
+        return not query.filters and self._supports_vector_index and self.oversample > 1
+
+    @staticmethod
+    def _rescored_result(
+        data: Optional[List[Dict[str, Any]]]
+    ) -> Tuple[List[LabelledNode], List[float]]:
+        nodes: List[LabelledNode] = []
+        scores: List[float] = []
+        for record in data or []:
+            nodes.append(
+                EntityNode(
+                    name=record["name"],
+                    label=record["type"],
+                    properties=remove_empty_values(record["properties"]),
+                )
+            )
+            scores.append(record["score"])
+        return nodes, scores
+
+    def vector_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> Tuple[List[LabelledNode], List[float]]:
+        if not self._rescoring(query):
+            return super().vector_query(query, **kwargs)
+        return self._rescored_result(
+            self.structured_query(
+                RESCORED_VECTOR_QUERY, param_map=self._rescored_params(query)
+            )
+        )
+
+    async def avector_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> Tuple[List[LabelledNode], List[float]]:
+        if not self._rescoring(query):
+            return await asyncio.to_thread(super().vector_query, query, **kwargs)
+        return self._rescored_result(
+            await self.astructured_query(
+                RESCORED_VECTOR_QUERY, param_map=self._rescored_params(query)
+            )
+        )
+
+    async def astructured_query(
+        self, query: str, param_map: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        try:
+            records, _, _ = await self._async_driver.execute_query(
+                query, parameters_=param_map or {}, database_=self._database
+            )
+        except neo4j.exceptions.Neo4jError as e:
+            if not needs_implicit_transaction(e):
+                raise
+            return await asyncio.to_thread(self.structured_query, query, param_map)
+        result = [record.data() for record in records]
+        if self.sanitize_query_output:
+            return [value_sanitize(value) for value in result]
+        return result
+
+    async def aget(
+        self,
+        properties: Optional[dict] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[LabelledNode]:
+        return await asyncio.to_thread(self.get, properties, ids)
+
+    async def aget_triplets(
+        self,
+        entity_names: Optional[List[str]] = None,
+        relation_names: Optional[List[str]] = None,
+        properties: Optional[dict] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[Triplet]:
+        return await asyncio.to_thread(
+            self.get_triplets, entity_names, relation_names, properties, ids
+        )
+
+    async def aget_rel_map(
+        self,
+        graph_nodes: List[LabelledNode],
+        depth: int = 2,
+        limit: int = 30,
+        ignore_rels: Optional[List[str]] = None,
+    ) -> List[Triplet]:
+        return await asyncio.to_thread(
+            self.get_rel_map, graph_nodes, depth, limit, ignore_rels
+        )
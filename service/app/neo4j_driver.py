@@ -0,0 +1,172 @@
+"""
+Neo4j drivers shared by the graph and vector stores, with pool metrics
+
+The driver has no public pool statistics, so the metrics read its private
+pool (`_pool`, its `connections` and `acquire`). They are written against
+the neo4j version pinned in requirements.txt and Pipfile, and
+test_neo4j_driver.py fails when an upgrade changes the pool; until then a
+changed pool disables the metrics with a warning.
+"""
+
+import functools
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import neo4j
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger("uvicorn")
+
+POOL_CONNECTIONS = Gauge(
+    "neo4j_pool_connections",
+    "Connections of the Neo4j driver pool",
+    ["driver", "state"],
+)
+POOL_UTILIZATION = Gauge(
+    "neo4j_pool_utilization",
+    "Share of the maximum Neo4j connection pool size in use",
+    ["driver"],
+)
+ACQUISITION_SECONDS = Histogram(
+    "neo4j_connection_acquisition_seconds",
+    "Time waited for a connection from the Neo4j driver pool",
+    ["driver"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0),
+)
+ACQUISITION_ERRORS = Counter(
+    "neo4j_connection_acquisition_errors",
+    "Connections the Neo4j driver pool could not hand out, e.g. on timeout",
+    ["driver"],
+)
+
+
+def instrumentable_pool(driver: Any) -> Optional[Any]:
+    """The private pool of a driver, if it has the connections and acquire we read"""
+    pool = getattr(driver, "_pool", None)
+    if not isinstance(getattr(pool, "connections", None), dict) or not callable(
+        getattr(pool, "acquire", None)
+    ):
+        return None
+    return pool
+
+
+def pool_stats(pool: Any, max_size: int) -> Dict[str, float]:
+    """Connections in use and idle of a driver pool"""
+    connections = [
+        connection
+        for address_connections in list(pool.connections.values())
+        for connection in list(address_connections)
+    ]
+    in_use = sum(1 for connection in connections if connection.in_use)
+    return {
+        "in_use": in_use,
+        "idle": len(connections) - in_use,
+        "max_size": max_size,
+        "utilization": in_use / max_size if max_size else 0.0,
+    }
+
+
+def _time_acquisition(driver: Any, pool: Any, name: str) -> None:
+    """Measure the time connections are waited for"""
+    acquire = pool.acquire
+    histogram = ACQUISITION_SECONDS.labels(name)
+    errors = ACQUISITION_ERRORS.labels(name)
+
+    if isinstance(driver, neo4j.AsyncDriver):
+
+        @functools.wraps(acquire)
+        async def timed_async(*args: Any, **kwargs: Any) -> Any:
+            start_time = time.perf_counter()
+            try:
+                return await acquire(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start_time)
+
+        pool.acquire = timed_async
+        return
+
+    @functools.wraps(acquire)
+    def timed(*args: Any, **kwargs: Any) -> Any:
+        start_time = time.perf_counter()
+        try:
+            return acquire(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+
+    pool.acquire = timed
+
+
+class Neo4jDrivers:
+    """
+    The sync and async driver of a worker, passed to its graph and vector
+    stores instead of a connection pool per store. The pools are bounded by
+    `max_connection_pool_size`, so the connections of all workers together
+    stay below the connection limit of the server.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        username: str,
+        password: str,
+        max_connection_pool_size: int = 100,
+        connection_acquisition_timeout: float = 60.0,
+        max_connection_lifetime: float = 3600.0,
+        connection_timeout: float = 30.0,
+        liveness_check_timeout: Optional[float] = None,
+    ) -> None:
+        self.max_connection_pool_size = max_connection_pool_size
+        config: Dict[str, Any] = {
+            "auth": (username, password),
+            "max_connection_pool_size": max_connection_pool_size,
+            "connection_acquisition_timeout": connection_acquisition_timeout,
+            "max_connection_lifetime": max_connection_lifetime,
+            "connection_timeout": connection_timeout,
+            "liveness_check_timeout": liveness_check_timeout,
+        }
+        self.driver = neo4j.GraphDatabase.driver(uri, **config)
+        self.async_driver = neo4j.AsyncGraphDatabase.driver(uri, **config)
+        # pools of the drivers whose metrics are collected
+        self._pools: Dict[str, Any] = {}
+        for name, driver in (("sync", self.driver), ("async", self.async_driver)):
+            pool = instrumentable_pool(driver)
+            if pool is None:
+                logger.warning(
+                    "Neo4j %s driver pool changed, its metrics are disabled", name
+                )
+                continue
+            self._pools[name] = pool
+            _time_acquisition(driver, pool, name)
+            for state in ("in_use", "idle"):
+                POOL_CONNECTIONS.labels(name, state).set_function(
+                    functools.partial(self._stat, pool, state)
+                )
+            POOL_UTILIZATION.labels(name).set_function(
+                functools.partial(self._stat, pool, "utilization")
+            )
+
+    def _stat(self, pool: Any, stat: str) -> float:
+        return pool_stats(pool, self.max_connection_pool_size)[stat]
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Pool statistics of the sync and async driver"""
+        return {
+            name: pool_stats(pool, self.max_connection_pool_size)
+            for name, pool in self._pools.items()
+        }
+
+    def verify_connectivity(self) -> None:
+        """Raise if the server can not be reached"""
+        self.driver.verify_connectivity()
+
+    async def aclose(self) -> None:
+        """Close the drivers"""
+        await self.async_driver.close()
+        self.driver.close()
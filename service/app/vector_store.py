@@ -0,0 +1,48 @@
+""" Neo4j vector store on a shared driver """
+
+from typing import Any, Dict
+
+import neo4j
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
+from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
+
+
+class SharedDriverNeo4jVectorStore(Neo4jVectorStore):
+    """
+    Neo4j vector store using the driver it is given, e.g. the one the graph
+    store shares, instead of opening its own. It does not create its index,
+    the input pipeline does (input_pipeline/neo4j_schema.py).
+    """
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self,
+        driver: neo4j.Driver,
+        embedding_dimension: int,
+        database: str = "neo4j",
+        index_name: str = "chunk",
+        node_label: str = "Chunk",
+        embedding_node_property: str = "embedding",
+        text_node_property: str = "text",
+        distance_strategy: str = "cosine",
+        retrieval_query: str = "",
+    ) -> None:
+        if distance_strategy not in ["cosine", "euclidean"]:
+            raise ValueError("distance_strategy must be either 'euclidean' or 'cosine'")
+        # Neo4jVectorStore.__init__ without the driver it opens, without
+        # hybrid search and without creating a missing index
+        fields: Dict[str, Any] = {
+            "distance_strategy": distance_strategy,
+            "index_name": index_name,
+            "keyword_index_name": "keyword",
+            "hybrid_search": False,
+            "node_label": node_label,
+            "embedding_node_property": embedding_node_property,
+            "text_node_property": text_node_property,
+            "retrieval_query": retrieval_query,
+            "embedding_dimension": embedding_dimension,
+        }
+        BasePydanticVectorStore.__init__(self, **fields)
+        self._driver = driver
+        self._database = database
+        self._verify_version()
+        self.retrieve_existing_index()
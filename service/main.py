@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 """ main routine to start the FastAPI server """
 
+import asyncio
 import logging
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
 from app.api.routers import api_router
 from app.observability import init_observability
 from app.config import ModelSettings
+from app.providers import providers
+from app.engine.neo4j_schema import check_schema
 
 
 settings = ModelSettings()  # type: ignore [call-arg]
@@ -34,13 +38,46 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("llama_index").setLevel(logging.INFO)
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """
+    Create the clients in parallel and check the indexes of the graph, which
+    the input pipeline creates, before serving, close the clients on shutdown
+    """
+    async with providers.lifespan():
+        graph_store = await providers.aget("graph_store")
+        await asyncio.to_thread(
+            check_schema,
+            graph_store.client,
+            embedding_dimension=settings.embedding_dimension,
+            quantization=settings.neo4j_vector_quantization,
+        )
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 metrics = init_observability(app)
 # static information as metric
 metrics.info("app_info", "Llamaindex KnowledgeGraph web service", version="1.0.1")
 
 
+@app.get("/healthz")
+async def healthz():
+    """Status of the clients, 503 when one of them fails its probe"""
+    checks = await providers.health()
+    healthy = all(check["status"] != "error" for check in checks.values())
+    return JSONResponse(
+        {
+            "status": "ok" if healthy else "error",
+            "startup_seconds": providers.startup_seconds,
+            "providers": checks,
+            "neo4j_pools": (await providers.aget("neo4j")).stats(),
+        },
+        status_code=200 if healthy else 503,
+    )
+
+
 ENVIRONMENT = settings.environment or "dev"
 logger = logging.getLogger("uvicorn")
 
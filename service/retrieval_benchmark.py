@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Setup overhead of the property graph tools per query: sub-retrievers built
+for every query, as before, against the long-lived ones, on an in-memory
+graph with mock LLM and embedding model
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+from functools import partial
+from textwrap import dedent
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.bridge.pydantic import BaseModel, Field
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.graph_stores import SimplePropertyGraphStore
+from llama_index.core.graph_stores.types import EntityNode, Relation
+from llama_index.core.indices.property_graph import CypherTemplateRetriever
+from llama_index.core.llms import MockLLM
+from llama_index.core.indices.property_graph.sub_retrievers.base import (
+    BasePGRetriever,
+)
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from app.engine.tools.property_graph import (
+    CypherQueryParams,
+    CypherQueryRetriever,
+    KeywordSynonymRetriever,
+    SubRetrieverTool,
+    VectorSimilarityRetriever,
+)
+
+logger = logging.getLogger("retrieval_benchmark")
+
+
+class BenchmarkGraphStore(SimplePropertyGraphStore):
+    """In-memory graph answering vector and Cypher queries with fixed results"""
+
+    supports_structured_queries: bool = True
+    supports_vector_queries: bool = True
+
+    def structured_query(
+        self, query: str, param_map: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        names = (param_map or {}).get("names", [])
+        return [{"c.text": f"about {name}", "o.name": name} for name in names]
+
+    def vector_query(self, query, **kwargs):
+        nodes = self.get()[: query.similarity_top_k]
+        return nodes, [1.0] * len(nodes)
+
+
+class BenchmarkLLM(MockLLM):
+    """Mock LLM returning entity names for the Cypher parameters"""
+
+    def structured_predict(self, output_cls, prompt, **prompt_args):
+        return CypherQueryParams(names=["entity_0", "entity_1"])
+
+
+def build_graph(entities: int) -> BenchmarkGraphStore:
+    """Chain of entities, each related to the next"""
+    graph_store = BenchmarkGraphStore()
+    nodes = [
+        EntityNode(name=f"entity_{index}", label="Organization")
+        for index in range(entities)
+    ]
+    graph_store.upsert_nodes(nodes)
+    graph_store.upsert_relations(
+        [
+            Relation(label="RELATED_TO", source_id=first.id, target_id=second.id)
+            for first, second in zip(nodes, nodes[1:])
+        ]
+    )
+    return graph_store
+
+
+def legacy_cypher_sub_retriever(tool: SubRetrieverTool) -> CypherTemplateRetriever:
+    """Sub-retriever as CypherQueryRetriever built it for every query"""
+
+    class Params(BaseModel):
+        """Parameters for a cypher query."""
+
+        names: list[str] = Field(
+            description="A list of possible entity names or keywords related to the query."
+        )
+
+    cypher_query = dedent(
+        """
+    MATCH (c:Chunk)-[:MENTIONS]->(o:__Entity__)
+    WHERE o.name IN $names
+    RETURN c.text, o.name, o.label;
+    """
+    )
+    return CypherTemplateRetriever(
+        tool.graph_store,
+        Params,  # type: ignore [arg-type]
+        cypher_query,
+        llm=tool.llm,
+    )
+
+
+def retrieve(sub_retriever: BasePGRetriever, query: str) -> List[NodeWithScore]:
+    """Nodes of a query"""
+    return sub_retriever.retrieve_from_graph(QueryBundle(query_str=query))
+
+
+def build_and_retrieve(
+    build: Callable[[], BasePGRetriever], query: str
+) -> List[NodeWithScore]:
+    """Nodes of a query, from a sub-retriever built for it"""
+    return retrieve(build(), query)
+
+
+def per_call_ms(function: Callable[[], Any], iterations: int) -> List[float]:
+    """Milliseconds of every call"""
+    timings = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return timings
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Measure the setup and the query of every tool"""
+    graph_store = build_graph(args.entities)
+    llm = BenchmarkLLM(max_tokens=16)
+    embed_model = MockEmbedding(embed_dim=args.dim)
+    query = "How is entity_0 related to entity_1?"
+
+    results = []
+    for tool_class in (
+        KeywordSynonymRetriever,
+        VectorSimilarityRetriever,
+        CypherQueryRetriever,
+    ):
+        tool = tool_class(graph_store, None, llm, embed_model)
+        build: Callable[[], BasePGRetriever] = tool.build_sub_retriever
+        if tool_class is CypherQueryRetriever:
+            build = partial(legacy_cypher_sub_retriever, tool)
+        per_query = per_call_ms(
+            partial(build_and_retrieve, build, query), args.iterations
+        )
+        reused = per_call_ms(
+            partial(retrieve, tool.sub_retriever, query), args.iterations
+        )
+        setup = per_call_ms(build, args.iterations)
+        result: Dict[str, Any] = {
+            "tool": tool.name,
+            "setup_ms": statistics.median(setup),
+            "per_query_build_ms": statistics.median(per_query),
+            "reused_ms": statistics.median(reused),
+        }
+        result["overhead_removed"] = (
+            1 - result["reused_ms"] / result["per_query_build_ms"]
+            if result["per_query_build_ms"]
+            else 0.0
+        )
+        results.append(result)
+        logger.info(
+            "%-28s setup %.3fms  built per query %.3fms  reused %.3fms  (-%.0f%%)",
+            result["tool"],
+            result["setup_ms"],
+            result["per_query_build_ms"],
+            result["reused_ms"],
+            result["overhead_removed"] * 100,
+        )
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--entities", type=int, default=200)
+    arg_parser.add_argument("--dim", type=int, default=64, help="mock embeddings")
+    arg_parser.add_argument("--iterations", type=int, default=200)
+    arg_parser.add_argument("--json", help="also write the results to this file")
+    arguments = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    benchmark_results = main(arguments)
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as json_file:
+            json.dump(benchmark_results, json_file, indent=2)
@@ -0,0 +1,66 @@
+""" Tests of the Neo4j pool metrics against the pinned neo4j driver """
+
+import asyncio
+
+import neo4j
+import pytest
+from neo4j.exceptions import ServiceUnavailable
+from prometheus_client import REGISTRY
+
+from app.neo4j_driver import Neo4jDrivers, instrumentable_pool, pool_stats
+
+# nothing listens here, so connections fail fast without a server
+UNREACHABLE = "bolt://127.0.0.1:1"
+
+
+@pytest.fixture
+def drivers():
+    drivers = Neo4jDrivers(
+        UNREACHABLE,
+        "neo4j",
+        "password",
+        max_connection_pool_size=4,
+        connection_acquisition_timeout=1.0,
+        connection_timeout=0.5,
+    )
+    yield drivers
+    asyncio.run(drivers.aclose())
+
+
+def test_driver_pools_have_the_internals_the_metrics_read():
+    driver = neo4j.GraphDatabase.driver(UNREACHABLE, auth=("neo4j", "password"))
+    async_driver = neo4j.AsyncGraphDatabase.driver(
+        UNREACHABLE, auth=("neo4j", "password")
+    )
+    try:
+        assert instrumentable_pool(driver) is not None
+        assert instrumentable_pool(async_driver) is not None
+    finally:
+        driver.close()
+        asyncio.run(async_driver.close())
+
+
+def test_pool_stats_of_an_unused_pool(drivers):
+    assert set(drivers.stats()) == {"sync", "async"}
+    assert pool_stats(instrumentable_pool(drivers.driver), 4) == {
+        "in_use": 0,
+        "idle": 0,
+        "max_size": 4,
+        "utilization": 0.0,
+    }
+
+
+def _acquisition_errors() -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "neo4j_connection_acquisition_errors_total", {"driver": "sync"}
+        )
+        or 0.0
+    )
+
+
+def test_failed_acquisitions_are_counted(drivers):
+    before = _acquisition_errors()
+    with pytest.raises(ServiceUnavailable):
+        drivers.verify_connectivity()
+    assert _acquisition_errors() > before
@@ -0,0 +1,109 @@
+""" Tests of the fusion of the hybrid graph retriever """
+
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from app.engine.tools.property_graph import HybridGraphRetriever, PropertyGraphTool
+
+
+class StaticRetriever(PropertyGraphTool):
+    """Tool returning fixed nodes"""
+
+    def __init__(self, nodes: list[NodeWithScore]) -> None:
+        super().__init__(None, None, None)
+        self.nodes = nodes
+
+    def retrieve(self, query: str) -> list[NodeWithScore]:
+        return self.nodes
+
+    async def aretrieve(self, query: str) -> list[NodeWithScore]:
+        return self.nodes
+
+
+def _nodes(*texts_and_scores) -> list[NodeWithScore]:
+    return [
+        NodeWithScore(node=TextNode(text=text), score=score)
+        for text, score in texts_and_scores
+    ]
+
+
+def _hybrid(*results: list[NodeWithScore], **kwargs) -> HybridGraphRetriever:
+    return HybridGraphRetriever(
+        None,
+        None,
+        None,
+        retrievers=[StaticRetriever(nodes) for nodes in results],
+        tokenizer=str.split,
+        **kwargs,
+    )
+
+
+def _texts(nodes: list[NodeWithScore]) -> list[str]:
+    return [node.node.get_content() for node in nodes]
+
+
+def test_rrf_ranks_nodes_found_by_several_retrievers_first():
+    hybrid = _hybrid(
+        _nodes(("a", 0.9), ("b", 0.8), ("c", 0.7)),
+        _nodes(("c", None), ("d", None)),
+        rrf_k=60,
+    )
+    fused = hybrid.retrieve("query")
+
+    assert _texts(fused) == ["c", "a", "b", "d"]
+    assert fused[0].score == pytest.approx(1 / 63 + 1 / 61)
+    assert fused[1].score == pytest.approx(1 / 61)
+
+
+def test_rrf_weights_retrievers_by_name():
+    class FavouriteRetriever(StaticRetriever):
+        """Tool whose results weigh double"""
+
+    hybrid = HybridGraphRetriever(
+        None,
+        None,
+        None,
+        retrievers=[
+            StaticRetriever(_nodes(("a", None))),
+            FavouriteRetriever(_nodes(("b", None))),
+        ],
+        weights={"favourite_retriever": 2.0},
+        tokenizer=str.split,
+    )
+    fused = hybrid.retrieve("query")
+
+    assert _texts(fused) == ["b", "a"]
+    assert [node.score for node in fused] == pytest.approx([2 / 61, 1 / 61])
+
+
+def test_weighted_fusion_normalizes_the_scores_of_each_list():
+    hybrid = _hybrid(
+        _nodes(("a", 10.0), ("b", 5.0), ("c", 0.0)),
+        _nodes(("b", 0.3), ("d", 0.1)),
+        fusion="weighted",
+    )
+    fused = {node.node.get_content(): node.score for node in hybrid.retrieve("q")}
+
+    assert fused == pytest.approx({"a": 1.0, "b": 1.5, "c": 0.0, "d": 0.0})
+
+
+def test_weighted_fusion_scores_lists_of_equal_scores_in_the_middle():
+    hybrid = _hybrid(
+        _nodes(("a", 0.9), ("b", 0.1)), _nodes(("c", 0.4)), fusion="weighted"
+    )
+    fused = {node.node.get_content(): node.score for node in hybrid.retrieve("q")}
+
+    assert fused == pytest.approx({"a": 1.0, "c": 0.5, "b": 0.0})
+
+
+def test_fused_context_stays_within_top_k_and_token_budget():
+    nodes = _nodes(*((f"word{index} " * 10, None) for index in range(5)))
+    assert len(_hybrid(nodes, top_k=3).retrieve("q")) == 3
+    assert len(_hybrid(nodes, max_context_tokens=25).retrieve("q")) == 2
+    # the best node is kept even if it alone exceeds the budget
+    assert len(_hybrid(nodes, max_context_tokens=5).retrieve("q")) == 1
+
+
+def test_unknown_fusion_is_rejected():
+    with pytest.raises(ValueError):
+        _hybrid([], fusion="max")
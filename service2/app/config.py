@@ -1,11 +1,8 @@
 """ Configuration settings for the web service """
 
 import logging
-from llama_index.core import Settings
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.graph_stores.neo4j import Neo4jPGStore  # type: ignore [import-untyped]
-from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
-from llama_index.llms.azure_openai import AzureOpenAI
+from typing import Any
+
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -46,42 +43,19 @@ class ModelSettings(BaseSettings):
 
 settings = ModelSettings()  # type: ignore [call-arg]
 
-# graph store instance
-graph_store = Neo4jPGStore(
-    username=settings.neo4j_username,
-    password=settings.neo4j_password.get_secret_value(),
-    url=settings.neo4j_uri,
-)
+# clients created on first use or by the warm-up of the application lifespan
+PROVIDED = ("graph_store", "vector_store", "llm", "embed_model")
 
-# vector store instance
-vector_store = Neo4jVectorStore(
-    username=settings.neo4j_username,
-    password=settings.neo4j_password.get_secret_value(),
-    url=settings.neo4j_uri,
-    embedding_dimension=1536,
-)
 
-# language model instance
-llm = AzureOpenAI(
-    engine=settings.azure_openai_engine,
-    model=settings.azure_openai_llm_deployment,
-    temperature=settings.llm_temperature,
-    azure_endpoint=settings.azure_openai_endpoint,
-    api_key=settings.azure_openai_api_key.get_secret_value(),
-    api_version=settings.azure_openai_api_version,
-)
+def __getattr__(name: str) -> Any:
+    """The graph store, vector store, LLM and embedding model from app.providers"""
+    if name in PROVIDED:
+        # imported here, app.providers depends on the settings of this module
+        from app.providers import providers  # pylint: disable=import-outside-toplevel
 
-# embedding model
-embed_model = AzureOpenAIEmbedding(
-    model=settings.azure_openai_embedding_model,
-    deployment_name=settings.azure_openai_embedding_deployment,
-    azure_endpoint=settings.azure_openai_endpoint,
-    api_key=settings.azure_openai_api_key.get_secret_value(),
-    api_version=settings.azure_openai_api_version,
-)
+        return providers.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-Settings.llm = llm
-Settings.embed_model = embed_model
 
 # Obtain a named logger
 logger = logging.getLogger("chast_service")
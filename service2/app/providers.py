@@ -0,0 +1,205 @@
+""" Lazily created clients of the web service, with warm-up, health probes and shutdown """
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+from llama_index.core import Settings
+from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+from llama_index.graph_stores.neo4j import Neo4jPGStore  # type: ignore [import-untyped]
+from llama_index.llms.azure_openai import AzureOpenAI
+from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
+
+from app.config import ModelSettings, logger, settings
+
+
+@dataclass
+class Provider:
+    """How to create, probe and close one client"""
+
+    factory: Callable[[], Any]
+    close: Optional[Callable[[Any], None]] = None
+    # raises if the client can not serve, e.g. verify_connectivity
+    probe: Optional[Callable[[Any], None]] = None
+
+
+class ProviderRegistry:
+    """
+    Clients created on first use, or all at once and in parallel by
+    `warm_up`, instead of as side effects of importing the configuration.
+    Every client is created once, also when requested from several threads.
+    """
+
+    def __init__(self) -> None:
+        self._providers: Dict[str, Provider] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        # seconds each client took to create
+        self.startup_seconds: Dict[str, float] = {}
+
+    def register(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        close: Optional[Callable[[Any], None]] = None,
+        probe: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        """Add a client, replacing one of the same name that was not created yet"""
+        if name in self._instances:
+            raise ValueError(f"Provider {name} is already in use")
+        self._providers[name] = Provider(factory, close, probe)
+        self._locks[name] = threading.Lock()
+
+    @property
+    def names(self) -> List[str]:
+        """Names of the registered clients"""
+        return list(self._providers)
+
+    def get(self, name: str) -> Any:
+        """The client of a name, created on first use"""
+        if name in self._instances:
+            return self._instances[name]
+        if name not in self._providers:
+            raise KeyError(f"No provider {name}")
+        with self._locks[name]:
+            if name not in self._instances:
+                start_time = time.perf_counter()
+                instance = self._providers[name].factory()
+                self.startup_seconds[name] = time.perf_counter() - start_time
+                logger.info("Created %s in %.2fs", name, self.startup_seconds[name])
+                self._instances[name] = instance
+        return self._instances[name]
+
+    async def aget(self, name: str) -> Any:
+        """The client of a name, created in a worker thread on first use"""
+        if name in self._instances:
+            return self._instances[name]
+        return await asyncio.to_thread(self.get, name)
+
+    async def warm_up(self, names: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """Create clients in parallel and return the seconds each took"""
+        names = list(names if names is not None else self._providers)
+        start_time = time.perf_counter()
+        results = await asyncio.gather(
+            *(self.aget(name) for name in names), return_exceptions=True
+        )
+        errors = [
+            (name, result)
+            for name, result in zip(names, results)
+            if isinstance(result, BaseException)
+        ]
+        for name, error in errors:
+            logger.error("Could not create %s: %s", name, error)
+        if errors:
+            raise errors[0][1]
+        logger.info(
+            "Created %s in %.2fs", ", ".join(names), time.perf_counter() - start_time
+        )
+        return {name: self.startup_seconds.get(name, 0.0) for name in names}
+
+    async def _probe(self, name: str, timeout: float) -> Dict[str, Any]:
+        if name not in self._instances:
+            return {"status": "not started"}
+        probe = self._providers[name].probe
+        if probe is None:
+            return {"status": "ok"}
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                asyncio.to_thread(probe, self._instances[name]), timeout
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            return {"status": "error", "error": str(e) or type(e).__name__}
+        return {
+            "status": "ok",
+            "latency_ms": (time.perf_counter() - start_time) * 1000,
+        }
+
+    async def health(self, timeout: float = 5.0) -> Dict[str, Dict[str, Any]]:
+        """Probe the created clients in parallel"""
+        results = await asyncio.gather(
+            *(self._probe(name, timeout) for name in self._providers)
+        )
+        return dict(zip(self._providers, results))
+
+    async def aclose(self) -> None:
+        """Close the created clients, the last created first"""
+        for name in reversed(list(self._instances)):
+            instance = self._instances.pop(name)
+            close = self._providers[name].close
+            if close is None:
+                continue
+            try:
+                await asyncio.to_thread(close, instance)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not close %s: %s", name, e)
+
+    @asynccontextmanager
+    async def lifespan(self) -> AsyncIterator["ProviderRegistry"]:
+        """Warm up all clients, and close them on exit"""
+        try:
+            await self.warm_up()
+            yield self
+        finally:
+            await self.aclose()
+
+
+def _llm(config: ModelSettings) -> AzureOpenAI:
+    llm = AzureOpenAI(
+        engine=config.azure_openai_engine,
+        model=config.azure_openai_llm_deployment,
+        temperature=config.llm_temperature,
+        azure_endpoint=config.azure_openai_endpoint,
+        api_key=config.azure_openai_api_key.get_secret_value(),
+        api_version=config.azure_openai_api_version,
+    )
+    Settings.llm = llm
+    return llm
+
+
+def _embed_model(config: ModelSettings) -> AzureOpenAIEmbedding:
+    embed_model = AzureOpenAIEmbedding(
+        model=config.azure_openai_embedding_model,
+        deployment_name=config.azure_openai_embedding_deployment,
+        azure_endpoint=config.azure_openai_endpoint,
+        api_key=config.azure_openai_api_key.get_secret_value(),
+        api_version=config.azure_openai_api_version,
+    )
+    Settings.embed_model = embed_model
+    return embed_model
+
+
+def create_registry(config: ModelSettings) -> ProviderRegistry:
+    """Registry of the graph and vector stores, the LLM and the embedding model"""
+    registry = ProviderRegistry()
+    registry.register(
+        "graph_store",
+        lambda: Neo4jPGStore(
+            username=config.neo4j_username,
+            password=config.neo4j_password.get_secret_value(),
+            url=config.neo4j_uri,
+        ),
+        close=lambda store: store.close(),
+        probe=lambda store: store.client.verify_connectivity(),
+    )
+    registry.register(
+        "vector_store",
+        lambda: Neo4jVectorStore(
+            username=config.neo4j_username,
+            password=config.neo4j_password.get_secret_value(),
+            url=config.neo4j_uri,
+            embedding_dimension=1536,
+        ),
+        close=lambda store: store.client.close(),
+        probe=lambda store: store.client.verify_connectivity(),
+    )
+    # the Azure OpenAI clients connect on their first request
+    registry.register("llm", lambda: _llm(config))
+    registry.register("embed_model", lambda: _embed_model(config))
+    return registry
+
+
+providers = create_registry(settings)
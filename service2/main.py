@@ -2,24 +2,49 @@
 """ main routine to start the FastAPI server """
 
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse
 
 # from app.api.routers import api_router
 from app.observability import init_observability
 from app.config import ModelSettings
+from app.providers import providers
 
 
 settings = ModelSettings()  # type: ignore [call-arg]
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Create the clients in parallel before serving, close them on shutdown"""
+    async with providers.lifespan():
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 init_observability(app)
 
+
+@app.get("/healthz")
+async def healthz():
+    """Status of the clients, 503 when one of them fails its probe"""
+    checks = await providers.health()
+    healthy = all(check["status"] != "error" for check in checks.values())
+    return JSONResponse(
+        {
+            "status": "ok" if healthy else "error",
+            "startup_seconds": providers.startup_seconds,
+            "providers": checks,
+        },
+        status_code=200 if healthy else 503,
+    )
+
+
 ENVIRONMENT = settings.environment or "dev"
 logger = logging.getLogger("uvicorn")
 